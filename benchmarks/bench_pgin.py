@@ -0,0 +1,345 @@
+"""
+Benchmarks of pgin's own hot paths against a disposable local PostgreSQL.
+
+Generates synthetic migration projects of the requested sizes, then times
+init, sync, status, a full deploy, revert --to HEAD~N, tag operations and
+plan parsing. Every operation reports wall time, throughput in changes
+per second, database round trips and Python memory.
+
+    python benchmarks/bench_pgin.py --sizes 100,1000,10000
+    python benchmarks/bench_pgin.py --sizes 100,1000 --save-baseline
+
+By default a throwaway cluster is created with initdb/pg_ctl found on PATH
+(or under --pgbin) and removed afterwards. --no-cluster runs against an already
+running server instead; the benchmark databases are then dropped at the end.
+--socket-dir connects over a Unix-domain socket instead of TCP; with the
+throwaway cluster '-' picks the cluster's own socket directory.
+
+Results are compared against the stored baseline; an operation slower than
+the baseline by more than --threshold, or doing more round trips, is a
+regression and the run exits with 1.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import getpass
+import tempfile
+import tracemalloc
+import subprocess
+import click
+from click.testing import CliRunner
+from tabulate import tabulate
+
+ROOTDIR = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+sys.path.insert(0, ROOTDIR)
+
+from pgin.dba import DBAdmin  # noqa
+from pgin.lib import metrics  # noqa
+from pgin.lib.profiling import peak_rss, MB  # noqa
+from pgin.scripts import pgin  # noqa
+
+BASELINE_FILE = os.path.join(ROOTDIR, 'benchmarks', 'baseline.json')
+MIGRATION_DIR = 'dbmigration'
+
+DEPLOY_FIRST = '''from pgin.lib.basemigration import Basemigration
+
+
+class {cls}(Basemigration):
+
+    def __call__(self):
+        try:
+            self.cursor.execute("""CREATE TABLE IF NOT EXISTS bench_log (id integer PRIMARY KEY)""")
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+'''
+
+REVERT_FIRST = '''from pgin.lib.basemigration import Basemigration
+
+
+class {cls}(Basemigration):
+
+    def __call__(self):
+        try:
+            self.cursor.execute("""DROP TABLE IF EXISTS bench_log""")
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+'''
+
+DEPLOY = '''from pgin.lib.basemigration import Basemigration
+
+
+class {cls}(Basemigration):
+
+    def __call__(self):
+        try:
+            self.cursor.execute("""INSERT INTO bench_log (id) VALUES (%s)""", [{ind}])
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+'''
+
+REVERT = '''from pgin.lib.basemigration import Basemigration
+
+
+class {cls}(Basemigration):
+
+    def __call__(self):
+        try:
+            self.cursor.execute("""DELETE FROM bench_log WHERE id = %s""", [{ind}])
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+'''
+# ==============================================================
+
+
+class DisposableCluster:
+    """
+    A PostgreSQL cluster living in a temporary directory
+    """
+
+    def __init__(self, port, user, pgbin=None):
+        self.port = port
+        self.user = user
+        self.pgbin = pgbin
+        self.topdir = tempfile.mkdtemp(prefix='pgin-bench-pg-')
+        self.datadir = os.path.join(self.topdir, 'data')
+    # _____________________________
+
+    def binary(self, name):
+        if self.pgbin:
+            return os.path.join(self.pgbin, name)
+
+        path = shutil.which(name)
+        if path is None:
+            raise click.ClickException("{} not found, use --pgbin or --no-cluster".format(name))
+        return path
+    # _____________________________
+
+    def start(self):
+        subprocess.check_call(
+            [self.binary('initdb'), '-D', self.datadir, '-U', self.user, '-A', 'trust', '--no-sync'],
+            stdout=subprocess.DEVNULL
+        )
+        options = "-p {} -k {} -c listen_addresses=localhost -c fsync=off -c synchronous_commit=off".format(
+            self.port, self.topdir)
+        subprocess.check_call(
+            [self.binary('pg_ctl'), '-D', self.datadir, '-o', options, '-l', os.path.join(self.topdir, 'log'),
+             '-w', 'start'],
+            stdout=subprocess.DEVNULL
+        )
+    # _____________________________
+
+    def stop(self):
+        subprocess.call(
+            [self.binary('pg_ctl'), '-D', self.datadir, '-m', 'immediate', 'stop'],
+            stdout=subprocess.DEVNULL
+        )
+        shutil.rmtree(self.topdir, ignore_errors=True)
+# ==============================================================
+
+
+def generate_project(topdir, project, size):
+    """
+    Plan file and deploy/revert scripts of *size* changes
+    """
+    home = os.path.join(topdir, MIGRATION_DIR, project)
+    for d in ['deploy', 'revert']:
+        os.makedirs(os.path.join(home, d))
+        pgin.turn_to_python_package(os.path.join(home, d))
+    pgin.turn_to_python_package(home)
+
+    plan = []
+    for ind in range(size):
+        name = 'change_{:06d}'.format(ind)
+        cls = name.capitalize()
+        deploy_tmpl, revert_tmpl = (DEPLOY_FIRST, REVERT_FIRST) if ind == 0 else (DEPLOY, REVERT)
+
+        with open(os.path.join(home, 'deploy', '{}.py'.format(name)), 'w') as fw:
+            fw.write(deploy_tmpl.format(cls=cls, ind=ind))
+        with open(os.path.join(home, 'revert', '{}.py'.format(name)), 'w') as fw:
+            fw.write(revert_tmpl.format(cls=cls, ind=ind))
+
+        plan.append({'changeid': pgin.generate_changeid(), 'name': name, 'msg': 'synthetic change {}'.format(ind)})
+
+    with open(os.path.join(home, pgin.PLAN_FILE), 'w') as fw:
+        for line in plan:
+            fw.write('{}\n'.format(json.dumps(line)))
+
+    return home
+# _____________________________________________
+
+
+def measure(name, size, func):
+    metrics.registry.reset()
+    tracemalloc.start()
+    started = time.perf_counter()
+
+    ok = func()
+
+    elapsed = time.perf_counter() - started
+    traced_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    statements = metrics.query_duration.total()
+    commits = metrics.commits.total()
+    connections = metrics.connections.total()
+
+    return {
+        'op': name,
+        'size': size,
+        'ok': ok,
+        'seconds': elapsed,
+        'changes_per_sec': size / elapsed if elapsed else None,
+        'round_trips': statements + commits + connections,
+        'statements': statements,
+        'commits': commits,
+        'connections': connections,
+        'traced_peak_mb': traced_peak / MB,
+        'peak_rss_mb': peak_rss() / MB,
+    }
+# _____________________________________________
+
+
+def run_size(runner, topdir, user, size, revert_depth, logfile):
+    project = 'pgin_bench_{}'.format(size)
+    home = generate_project(topdir, project, size)
+    conf_file = os.path.join(home, pgin.CONF_FILE)
+    plan_file = os.path.join(home, pgin.PLAN_FILE)
+    results = []
+
+    def invoke(*args):
+        def run():
+            result = runner.invoke(pgin.cli, ['--log-file', logfile] + list(args), catch_exceptions=True)
+            if result.exit_code not in (0, None):
+                click.echo(result.output, err=True)
+                return False
+            return True
+        return run
+
+    results.append(measure('plan parse', size, lambda: bool(pgin.plan_file_entries(plan_file))))
+    results.append(measure('init', size, invoke('init', '-p', project, '-u', user, '-d', topdir)))
+    os.environ['PGIN_CONF'] = conf_file
+
+    for name, args in [
+            ('sync', ['sync']),
+            ('status', ['status']),
+            ('deploy', ['deploy', '--no-analyze']),
+            ('status deployed', ['status']),
+            ('tag add', ['tag', 'add', '-t', 'bench', '-m', 'benchmark tag']),
+            ('tag list', ['tag', 'list']),
+            ('tag remove', ['tag', 'remove', '-y', '-t', 'bench']),
+            ('revert HEAD~{}'.format(revert_depth), ['revert', '-y', '--to', 'HEAD~{}'.format(revert_depth)])]:
+        results.append(measure(name, size, invoke(*args)))
+
+    return project, results
+# _____________________________________________
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for r in results:
+        key = '{}@{}'.format(r['op'], r['size'])
+        base = baseline.get(key)
+        if base is None:
+            continue
+
+        if r['seconds'] > base['seconds'] * (1 + threshold):
+            regressions.append((key, 'seconds', base['seconds'], r['seconds']))
+        if r['round_trips'] > base['round_trips']:
+            regressions.append((key, 'round trips', base['round_trips'], r['round_trips']))
+
+    return regressions
+# _____________________________________________
+
+
+@click.command()
+@click.option('--sizes', default='100,1000', help="Comma separated numbers of changes")
+@click.option('--revert-depth', type=int, default=10, help="N of revert --to HEAD~N")
+@click.option('--port', type=int, default=54329, help="Port of the disposable (or running) server")
+@click.option('--user', default=getpass.getuser(), help="DB user")
+@click.option('--pgbin', type=click.Path(file_okay=False), help="Directory of initdb and pg_ctl")
+@click.option('--no-cluster', is_flag=True, help="Use an already running server on --port")
+@click.option('--socket-dir', help="Connect over the Unix socket in this directory, '-' for the throwaway cluster's")
+@click.option('--baseline', default=BASELINE_FILE, type=click.Path(dir_okay=False))
+@click.option('--save-baseline', is_flag=True, help="Store these results as the new baseline")
+@click.option('--threshold', type=float, default=0.2, help="Allowed slowdown against the baseline, 0.2 = 20%")
+@click.option('--output', type=click.Path(dir_okay=False), help="Write the raw results as JSON")
+def main(sizes, revert_depth, port, user, pgbin, no_cluster, socket_dir, baseline, save_baseline, threshold,
+         output):
+    cluster = None if no_cluster else DisposableCluster(port, user, pgbin)
+
+    # The default connection profile picks these up
+    os.environ['PGIN_DB_PORT'] = str(port)
+    if socket_dir == '-' and cluster is not None:
+        socket_dir = cluster.topdir
+    if socket_dir:
+        os.environ['PGIN_DB_SOCKET_DIR'] = socket_dir
+    topdir = tempfile.mkdtemp(prefix='pgin-bench-')
+    logfile = os.path.join(topdir, 'pgin.log')
+    runner = CliRunner()
+    results = []
+    projects = []
+
+    try:
+        if cluster is not None:
+            cluster.start()
+
+        for size in [int(s) for s in sizes.split(',')]:
+            click.echo("Benchmarking {} changes".format(size))
+            project, size_results = run_size(runner, topdir, user, size, revert_depth, logfile)
+            projects.append(project)
+            results.extend(size_results)
+    finally:
+        if cluster is not None:
+            cluster.stop()
+        else:
+            for project in projects:
+                DBAdmin(dbname=project, dbuser=user).dropdb()
+        shutil.rmtree(topdir, ignore_errors=True)
+
+    click.echo(tabulate(
+        [(r['op'], r['size'], r['ok'], r['seconds'], r['changes_per_sec'], r['round_trips'],
+          r['traced_peak_mb'], r['peak_rss_mb']) for r in results],
+        headers=['Operation', 'Changes', 'OK', 'Seconds', 'Changes/s', 'Round Trips', 'Traced Peak (MB)',
+                 'Peak RSS (MB)'],
+        floatfmt=".2f"
+    ))
+
+    if output:
+        with open(output, 'w') as fw:
+            json.dump(results, fw, indent=2)
+
+    if save_baseline:
+        with open(baseline, 'w') as fw:
+            json.dump({'{}@{}'.format(r['op'], r['size']): r for r in results}, fw, indent=2, sort_keys=True)
+        click.echo("Baseline saved to {}".format(baseline))
+        return
+
+    if not os.path.exists(baseline):
+        return
+
+    with open(baseline) as fp:
+        regressions = compare(results, json.load(fp), threshold)
+
+    if regressions:
+        click.echo('')
+        click.echo(click.style("Regressions against {}:".format(baseline), fg='red'))
+        click.echo(tabulate(regressions, headers=['Operation', 'Measure', 'Baseline', 'Now'], floatfmt=".2f"))
+        sys.exit(1)
+
+    if not all(r['ok'] for r in results):
+        sys.exit(1)
+# _____________________________________________
+
+
+if __name__ == '__main__':
+    main()
@@ -1,29 +1,83 @@
+import time
+import uuid
 import logging
 import datetime
 import psycopg2
+from psycopg2 import errorcodes
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT, AsIs
+from pgin.lib.cursors import MeteredConnection, MeteredCursor
+from pgin.lib.profiles import load_profile, reconnecting
+from pgin.lib.tracing import traced
 # ==============================================================
 
+# Bookkeeping tables of the meta schema, created by pgin.scripts.pgin.create_pgin_metaschema
+META_TABLES = ('plan', 'changes', 'tags', 'steps', 'phases', 'validations', 'wal', 'sizes')
+# ==============================================================
 
-class DBAdmin:
 
-    DBHOST = 'localhost'
-    DBPORT = 5432
-    # _____________________________
+class DBAdmin:
 
-    def __init__(self, dbname, dbuser):
+    def __init__(self, dbname, dbuser, profile=None):
         execid = 'pgin'
         self.logger = logging.getLogger(execid)
         self.dbname = dbname
         self.dbuser = dbuser
         self.meta_schema = 'pgin_%s' % dbname
+        self.profile = profile if profile is not None else load_profile()
+
+        self.dburi_admin = self.profile.dsn('template1', dbuser)
+        self.dburi = self.profile.dsn(dbname, dbuser)
+
+        self.conn = None
+        self.cursor = None
+        self.connected_dsn = None
+        self.search_path = None
+        self.lock_timeout = None
+    # __________________________________________
 
-        self.db_uri_tmpl = 'postgresql://{dbuser}@{dbhost}:{dbport}/{dbname}'
-        self.dburi_admin = self.db_uri_tmpl.format(
-            dbuser=dbuser, dbhost=self.DBHOST, dbport=self.DBPORT, dbname='template1')
-        self.dburi = self.db_uri_tmpl.format(dbuser=dbuser, dbhost=self.DBHOST, dbport=self.DBPORT, dbname=dbname)
+    def connect(self, dsn=None, autocommit=False, readonly=False):
+        """
+        Opens the DBAdmin connection, to the project DB unless *dsn* is given
+        """
+        self.connected_dsn = dsn or self.dburi
+        self.conn = self.connectdb(self.connected_dsn)
+        if autocommit or readonly:
+            self.conn.set_session(readonly=readonly or None, autocommit=autocommit)
+        self.cursor = self.conn.cursor(cursor_factory=MeteredCursor)
+        return self
     # __________________________________________
 
+    def reconnect(self):
+        """
+        Replaces a broken connection, restoring the session settings pgin made on it.
+        A transaction open on the broken connection is lost.
+        """
+        if getattr(self.conn, 'dry_run', False):
+            raise psycopg2.InterfaceError("Connection lost in a dry run, its transaction is gone")
+
+        autocommit = self.conn.autocommit
+        readonly = self.conn.readonly
+        attempts = self.profile.reconnect_attempts
+
+        for attempt in range(attempts + 1):
+            try:
+                self.connect(self.connected_dsn, autocommit, readonly)
+                break
+            except psycopg2.OperationalError:
+                if attempt >= attempts:
+                    raise
+                self.logger.warning("Reconnect to %s failed (%d/%d)", self.dbname, attempt + 1, attempts)
+                time.sleep(self.profile.reconnect_backoff * (attempt + 1))
+
+        self.logger.info("Reconnected to %s, backend %s", self.dbname, self.conn.get_backend_pid())
+        if self.search_path is not None:
+            self.set_search_path(self.search_path)
+        if self.lock_timeout is not None:
+            self.set_lock_timeout(self.lock_timeout)
+    # __________________________________________
+
+    @traced('bookkeeping')
+    @reconnecting
     def apply_change(self, changeid, change):
         query = """
             INSERT INTO %s.changes
@@ -34,11 +88,106 @@ class DBAdmin:
             DO NOTHING
         """
         params = [AsIs(self.meta_schema), changeid, change, datetime.datetime.utcnow()]
+        self.cursor.execute(query, params)
 
+        # Leftovers of an interrupted revert
+        query = """
+            DELETE FROM %s.steps
+            WHERE changeid = %s
+            AND direction = 'revert'
+        """
+        params = [AsIs(self.meta_schema), changeid]
+        self.cursor.execute(query, params)
+
+        self.conn.commit()
+    # _____________________________
+
+    @traced('bookkeeping')
+    @reconnecting
+    def apply_phase(self, changeid, phase):
+        query = """
+            INSERT INTO %s.phases
+            (changeid, phase, completed)
+            VALUES
+            (%s, %s, %s)
+            ON CONFLICT DO NOTHING
+        """
+        params = [AsIs(self.meta_schema), changeid, phase, datetime.datetime.utcnow()]
         self.cursor.execute(query, params)
         self.conn.commit()
     # _____________________________
 
+    @traced('bookkeeping')
+    @reconnecting
+    def queue_validation(self, changeid, relation, constraint):
+        """
+        A constraint added NOT VALID by *changeid*, to be validated later
+        """
+        query = """
+            INSERT INTO %s.validations
+            (changeid, relation, constraint_name, queued)
+            VALUES
+            (%s, %s, %s, %s)
+            ON CONFLICT (relation, constraint_name) DO UPDATE
+            SET changeid = EXCLUDED.changeid, queued = EXCLUDED.queued, validated = NULL
+        """
+        params = [AsIs(self.meta_schema), changeid, relation, constraint, datetime.datetime.utcnow()]
+        self.cursor.execute(query, params)
+        self.conn.commit()
+    # _____________________________
+
+    @traced('bookkeeping')
+    def record_wal(self, changeid, direction, phase, seconds, wal):
+        """
+        WAL generated by a run of a change: *wal* holds wal_bytes,
+        and wal_records and wal_fpi where pg_stat_wal has them.
+        Not retried on reconnect, a run committed unnoticed would count twice.
+        """
+        query = """
+            INSERT INTO %s.wal
+            (changeid, direction, phase, recorded, seconds, wal_bytes, wal_records, wal_fpi)
+            VALUES
+            (%s, %s, %s, %s, %s, %s, %s, %s)
+        """
+        params = [
+            AsIs(self.meta_schema), changeid, direction, phase, datetime.datetime.utcnow(), seconds,
+            wal.get('wal_bytes'), wal.get('wal_records'), wal.get('wal_fpi')
+        ]
+        self.cursor.execute(query, params)
+        self.conn.commit()
+    # _____________________________
+
+    @traced('bookkeeping')
+    def record_sizes(self, changeid, direction, phase, before, after):
+        """
+        Size and dead tuple deltas of the relations a change touched,
+        from fetch_relation_sizes() before and after it.
+        A relation missing on one side counts as empty there.
+        Not retried on reconnect, like record_wal().
+        """
+        query = """
+            INSERT INTO %s.sizes
+            (changeid, direction, phase, recorded, relation, table_before, table_after,
+             indexes_before, indexes_after, dead_before, dead_after, live_after)
+            VALUES
+            (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        """
+        recorded = datetime.datetime.utcnow()
+        empty = {'table_bytes': 0, 'index_bytes': 0, 'dead': 0, 'live': 0}
+        for relation in sorted(set(before) | set(after)):
+            b = before.get(relation, empty)
+            a = after.get(relation, empty)
+            params = [
+                AsIs(self.meta_schema), changeid, direction, phase, recorded, relation,
+                b['table_bytes'], a['table_bytes'], b['index_bytes'], a['index_bytes'], b['dead'], a['dead'], a['live']
+            ]
+            self.cursor.execute(query, params)
+
+        self.conn.commit()
+    # _____________________________
+
+    @traced('bookkeeping')
+    @reconnecting
     def apply_planned(self, changeid, change, msg):
         query = """
             INSERT INTO %s.plan
@@ -54,6 +203,8 @@ class DBAdmin:
         self.conn.commit()
     # _____________________________
 
+    @traced('bookkeeping')
+    @reconnecting
     def apply_tag(self, changeid, tag, msg):
         query = """
             UPDATE %s.plan
@@ -75,7 +226,11 @@ class DBAdmin:
         self.conn.commit()
     # _____________________________
 
-    def createdb(self):
+    def createdb(self, template=None):
+        """
+        With *template* the new DB is a file level copy of that database,
+        which must have no other sessions connected.
+        """
         self.logger.debug("Creating DB %s with owner %s", self.dbname, self.dbuser)
 
         try:
@@ -86,6 +241,10 @@ class DBAdmin:
             # Create DB
             query = """CREATE DATABASE %(dbname)s WITH OWNER %(user)s"""
             params = {'dbname': AsIs(self.dbname), 'user': AsIs(self.dbuser)}
+            if template is not None:
+                self.logger.debug("Cloning DB %s from template %s", self.dbname, template)
+                query += """ TEMPLATE %(template)s"""
+                params['template'] = AsIs(template)
             admin_cursor.execute(query, params)
 
         except psycopg2.ProgrammingError as pe:
@@ -100,6 +259,38 @@ class DBAdmin:
             admin_conn.close()
     # ___________________________________________
 
+    def cancel_backend(self, pid):
+        query = """SELECT pg_cancel_backend(%s)"""
+        params = [pid]
+        self.cursor.execute(query, params)
+    # ___________________________________________
+
+    def meta_schema_outdated(self):
+        """
+        True if the meta schema lacks tables or the changes deploy sequence
+        added by later pgin versions. False without a meta schema at all.
+        """
+        query = """
+            SELECT
+                to_regnamespace(%(schema)s) IS NOT NULL AS found,
+                bool_and(to_regclass(%(schema)s || '.' || t) IS NOT NULL) AS tables,
+                EXISTS (
+                    SELECT 1
+                    FROM information_schema.columns
+                    WHERE table_schema = %(schema)s
+                    AND table_name = 'changes'
+                    AND column_name = 'seq'
+                ) AS seq
+            FROM unnest(%(tables)s::text[]) AS t
+        """
+        params = {'schema': self.meta_schema, 'tables': list(META_TABLES)}
+
+        self.cursor.execute(query, params)
+        found, tables, seq = self.cursor.fetchone()
+        self.conn.commit()
+        return found and not (tables and seq)
+    # ___________________________________________
+
     def create_meta_schema(self):
         query = """
             CREATE SCHEMA IF NOT EXISTS %s
@@ -115,12 +306,67 @@ class DBAdmin:
                changeid uuid PRIMARY KEY,
                name VARCHAR(256) UNIQUE REFERENCES %(meta_schema)s.plan(name) ON UPDATE CASCADE,
                applied TIMESTAMP WITHOUT TIME ZONE DEFAULT NULL,
+               seq BIGSERIAL NOT NULL,
                FOREIGN KEY(changeid) REFERENCES %(meta_schema)s.plan(changeid)
            )
         """
         params = {'meta_schema': AsIs(self.meta_schema)}
         self.cursor.execute(query, params)
         self.conn.commit()
+        self.add_changes_seq()
+    # _____________________________
+
+    def add_changes_seq(self):
+        """
+        Deploy sequence for changes tables created before it existed.
+        Existing rows are numbered in the order they were applied.
+        """
+
+        query = """
+            SELECT 1
+            FROM information_schema.columns
+            WHERE table_schema = %s
+            AND table_name = 'changes'
+            AND column_name = 'seq'
+        """
+        params = [self.meta_schema]
+        self.cursor.execute(query, params)
+
+        if self.cursor.fetchone() is None:
+            query = """
+                ALTER TABLE %(meta_schema)s.changes ADD COLUMN seq BIGINT;
+                CREATE SEQUENCE %(meta_schema)s.changes_seq_seq OWNED BY %(meta_schema)s.changes.seq;
+
+                UPDATE %(meta_schema)s.changes c
+                SET seq = o.seq
+                FROM (
+                    SELECT
+                        changeid,
+                        row_number() OVER (ORDER BY applied, name) AS seq
+                    FROM %(meta_schema)s.changes
+                ) o
+                WHERE c.changeid = o.changeid;
+
+                SELECT setval(
+                    '%(meta_schema)s.changes_seq_seq',
+                    COALESCE(MAX(seq), 0) + 1,
+                    false
+                )
+                FROM %(meta_schema)s.changes;
+
+                ALTER TABLE %(meta_schema)s.changes
+                    ALTER COLUMN seq SET DEFAULT nextval('%(meta_schema)s.changes_seq_seq'),
+                    ALTER COLUMN seq SET NOT NULL;
+            """
+            params = {'meta_schema': AsIs(self.meta_schema)}
+            self.cursor.execute(query, params)
+
+        query = """
+            CREATE UNIQUE INDEX IF NOT EXISTS changes_seq_idx ON %s.changes(seq)
+        """
+        params = [AsIs(self.meta_schema)]
+        self.cursor.execute(query, params)
+        self.conn.commit()
     # _____________________________
 
     def create_plan_table(self):
@@ -140,6 +386,91 @@ class DBAdmin:
         self.conn.commit()
     # _____________________________
 
+    def create_steps_table(self):
+        query = """
+           CREATE TABLE IF NOT EXISTS %(meta_schema)s.steps (
+               changeid uuid REFERENCES %(meta_schema)s.plan(changeid) ON UPDATE CASCADE ON DELETE CASCADE,
+               direction VARCHAR(10),
+               step VARCHAR(256),
+               completed TIMESTAMP WITHOUT TIME ZONE DEFAULT NULL,
+               PRIMARY KEY(changeid, direction, step)
+           )
+        """
+        params = {'meta_schema': AsIs(self.meta_schema)}
+        self.cursor.execute(query, params)
+        self.conn.commit()
+    # _____________________________
+
+    def create_phases_table(self):
+        query = """
+           CREATE TABLE IF NOT EXISTS %(meta_schema)s.phases (
+               changeid uuid REFERENCES %(meta_schema)s.plan(changeid) ON UPDATE CASCADE ON DELETE CASCADE,
+               phase VARCHAR(20),
+               completed TIMESTAMP WITHOUT TIME ZONE DEFAULT NULL,
+               PRIMARY KEY(changeid, phase)
+           )
+        """
+        params = {'meta_schema': AsIs(self.meta_schema)}
+        self.cursor.execute(query, params)
+        self.conn.commit()
+    # _____________________________
+
+    def create_validations_table(self):
+        query = """
+           CREATE TABLE IF NOT EXISTS %(meta_schema)s.validations (
+               changeid uuid REFERENCES %(meta_schema)s.plan(changeid) ON UPDATE CASCADE ON DELETE CASCADE,
+               relation TEXT,
+               constraint_name TEXT,
+               queued TIMESTAMP WITHOUT TIME ZONE DEFAULT NULL,
+               validated TIMESTAMP WITHOUT TIME ZONE DEFAULT NULL,
+               PRIMARY KEY(relation, constraint_name)
+           )
+        """
+        params = {'meta_schema': AsIs(self.meta_schema)}
+        self.cursor.execute(query, params)
+        self.conn.commit()
+    # _____________________________
+
+    def create_wal_table(self):
+        query = """
+           CREATE TABLE IF NOT EXISTS %(meta_schema)s.wal (
+               changeid uuid REFERENCES %(meta_schema)s.plan(changeid) ON UPDATE CASCADE ON DELETE CASCADE,
+               direction VARCHAR(10),
+               phase VARCHAR(20),
+               recorded TIMESTAMP WITHOUT TIME ZONE DEFAULT NULL,
+               seconds DOUBLE PRECISION,
+               wal_bytes BIGINT,
+               wal_records BIGINT,
+               wal_fpi BIGINT
+           )
+        """
+        params = {'meta_schema': AsIs(self.meta_schema)}
+        self.cursor.execute(query, params)
+        self.conn.commit()
+    # _____________________________
+
+    def create_sizes_table(self):
+        query = """
+           CREATE TABLE IF NOT EXISTS %(meta_schema)s.sizes (
+               changeid uuid REFERENCES %(meta_schema)s.plan(changeid) ON UPDATE CASCADE ON DELETE CASCADE,
+               direction VARCHAR(10),
+               phase VARCHAR(20),
+               recorded TIMESTAMP WITHOUT TIME ZONE DEFAULT NULL,
+               relation TEXT,
+               table_before BIGINT,
+               table_after BIGINT,
+               indexes_before BIGINT,
+               indexes_after BIGINT,
+               dead_before BIGINT,
+               dead_after BIGINT,
+               live_after BIGINT
+           )
+        """
+        params = {'meta_schema': AsIs(self.meta_schema)}
+        self.cursor.execute(query, params)
+        self.conn.commit()
+    # _____________________________
+
     def create_tags_table(self):
         query = """
            CREATE TABLE IF NOT EXISTS %s.tags (
@@ -155,8 +486,18 @@ class DBAdmin:
         self.conn.commit()
     # _____________________________
 
+    def drop_meta_schema(self):
+        query = """
+            DROP SCHEMA IF EXISTS %s CASCADE
+        """
+        params = [AsIs(self.meta_schema)]
+        self.cursor.execute(query, params)
+        self.conn.commit()
+    # _____________________________
+
+    @traced('db')
     def connectdb(self, dburi):
-        return psycopg2.connect(dburi)
+        return psycopg2.connect(dburi, connection_factory=MeteredConnection)
     # ___________________________
 
     def drop_other_connections(self, dbname):
@@ -193,6 +534,31 @@ class DBAdmin:
             admin_conn.close()
     # ___________________________
 
+    @reconnecting
+    def fetch_blocked_by(self, pid):
+        """
+        Sessions waiting on a lock held or requested by backend *pid*
+        """
+
+        query = """
+            SELECT
+                pid,
+                wait_event_type,
+                EXTRACT(EPOCH FROM (now() - state_change)) AS waiting
+            FROM pg_stat_activity
+            WHERE %s = ANY(pg_blocking_pids(pid))
+        """
+        params = [pid]
+
+        self.cursor.execute(query, params)
+        fetch = self.cursor.fetchall()
+        if fetch is None:
+            return []
+
+        return [dict(f) for f in fetch]
+    # ___________________________
+
+    @reconnecting
     def fetch_change_deployed(self, changeid):
 
         query = '''
@@ -210,16 +576,129 @@ class DBAdmin:
         return dict(fetch)['deployed']
     # _____________________________
 
-    def fetch_deployed_changes(self, offset=0, limit=None):
+    @reconnecting
+    def fetch_backend_progress(self, pid):
+        """
+        One row describing what backend *pid* is doing right now.
+        Progress columns are NULL unless the backend is reported
+        by one of the pg_stat_progress_* views.
+        """
+
+        query = """
+            SELECT
+                a.state,
+                a.wait_event_type,
+                a.wait_event,
+                EXTRACT(EPOCH FROM (now() - a.query_start)) AS running,
+                left(a.query, 120) AS query,
+                p.command,
+                p.phase,
+                p.relid::regclass::text AS relation,
+                p.unit,
+                p.units_total,
+                p.units_done
+            FROM pg_stat_activity a
+            LEFT JOIN (
+                SELECT
+                    pid,
+                    command,
+                    phase,
+                    relid,
+                    CASE WHEN blocks_total > 0 THEN 'blocks' ELSE 'tuples' END AS unit,
+                    CASE WHEN blocks_total > 0 THEN blocks_total ELSE tuples_total END AS units_total,
+                    CASE WHEN blocks_total > 0 THEN blocks_done ELSE tuples_done END AS units_done
+                FROM pg_stat_progress_create_index
+                UNION ALL
+                SELECT
+                    pid,
+                    command,
+                    phase,
+                    relid,
+                    'blocks',
+                    heap_blks_total,
+                    heap_blks_scanned
+                FROM pg_stat_progress_cluster
+                UNION ALL
+                SELECT
+                    pid,
+                    'VACUUM',
+                    phase,
+                    relid,
+                    'blocks',
+                    heap_blks_total,
+                    heap_blks_scanned
+                FROM pg_stat_progress_vacuum
+            ) p ON p.pid = a.pid
+            WHERE a.pid = %s
+        """
+        params = [pid]
+
+        self.cursor.execute(query, params)
+        fetch = self.cursor.fetchone()
+        if fetch is None:
+            return
+
+        return dict(fetch)
+    # _____________________________
+
+    @reconnecting
+    def fetch_current_wal_lsn(self):
+        query = """SELECT pg_current_wal_lsn()::text AS lsn"""
+        params = ()
+
+        self.cursor.execute(query, params)
+        return self.cursor.fetchone()['lsn']
+    # ___________________________
+
+    @reconnecting
+    def fetch_wal_counters(self, flush=False):
+        """
+        Cluster wide pg_stat_wal counters, {} before PostgreSQL 14.
+        Backends report them up to a second late; with *flush*, on 15+,
+        this backend reports its own first.
+        """
+        if self.conn.server_version < 140000:
+            return {}
+
+        if flush and self.conn.server_version >= 150000:
+            self.cursor.execute("""SELECT pg_stat_force_next_flush()""")
+            self.conn.commit()
+
+        query = """
+            SELECT
+                wal_records,
+                wal_fpi
+            FROM pg_stat_wal
+        """
+        params = ()
+
+        self.cursor.execute(query, params)
+        return dict(self.cursor.fetchone())
+    # ___________________________
+
+    @reconnecting
+    def fetch_wal_bytes_since(self, lsn):
+        query = """SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), %s::pg_lsn)::bigint AS wal_bytes"""
+        params = [lsn]
+
+        self.cursor.execute(query, params)
+        return self.cursor.fetchone()['wal_bytes']
+    # ___________________________
+
+    def fetch_deployed_changes(self, limit=None):
+        """
+        Deployed changes, the last deployed first.
+        A backward scan of changes_seq_idx, stopping after *limit* rows.
+        """
         query = """
             SELECT
                 changeid,
-                name
+                name,
+                seq
             FROM %s.changes
-            ORDER BY applied DESC
-            OFFSET %s
+            ORDER BY seq DESC
         """
-        params = [AsIs(self.meta_schema), offset]
+        params = [AsIs(self.meta_schema)]
 
         if limit:
             query += 'LIMIT %s'
@@ -233,6 +712,34 @@ class DBAdmin:
         return [dict(f) for f in fetch]
     # ___________________________
 
+    def fetch_deployed_changes_since(self, change):
+        """
+        Changes deployed after *change* and *change* itself, the last deployed first.
+        Empty if *change* is not deployed.
+        """
+        query = """
+            SELECT
+                changeid,
+                name,
+                seq
+            FROM %(meta_schema)s.changes
+            WHERE seq >= (
+                SELECT seq
+                FROM %(meta_schema)s.changes
+                WHERE name = %(change)s
+            )
+            ORDER BY seq DESC
+        """
+        params = {'meta_schema': AsIs(self.meta_schema), 'change': change}
+
+        self.cursor.execute(query, params)
+        fetch = self.cursor.fetchall()
+        if fetch is None:
+            return []
+
+        return [dict(f) for f in fetch]
+    # ___________________________
+
     def fetch_last_deployed_change(self):
         query = """
             SELECT
@@ -241,7 +748,7 @@ class DBAdmin:
                 applied
 
             FROM %s.changes
-            ORDER BY applied DESC
+            ORDER BY seq DESC
             LIMIT 1
         """
         params = [AsIs(self.meta_schema)]
@@ -254,6 +761,239 @@ class DBAdmin:
         return dict(fetch)
     # ___________________________
 
+    def fetch_phases(self):
+        """
+        {changeid hex: set of completed phases}
+        """
+        query = """
+            SELECT
+                changeid,
+                phase
+            FROM %s.phases
+        """
+        params = [AsIs(self.meta_schema)]
+
+        self.cursor.execute(query, params)
+        phases = {}
+        for row in self.cursor.fetchall():
+            phases.setdefault(uuid.UUID(str(row['changeid'])).hex, set()).add(row['phase'])
+
+        return phases
+    # ___________________________
+
+    def fetch_pending_validations(self, relation=None):
+        """
+        Constraints added NOT VALID and not validated yet, the first queued first
+        """
+        query = """
+            SELECT
+                v.relation,
+                v.constraint_name,
+                v.queued,
+                p.name
+            FROM %(meta_schema)s.validations v
+            JOIN %(meta_schema)s.plan p USING (changeid)
+            WHERE v.validated IS NULL
+            AND (%(relation)s IS NULL OR v.relation = %(relation)s)
+            ORDER BY v.queued
+        """
+        params = {'meta_schema': AsIs(self.meta_schema), 'relation': relation}
+
+        self.cursor.execute(query, params)
+        fetch = self.cursor.fetchall()
+        if fetch is None:
+            return []
+
+        return [dict(f) for f in fetch]
+    # ___________________________
+
+    def fetch_expanded_changes(self):
+        """
+        Changes whose expand phase ran but which are not fully deployed,
+        the last expanded first
+        """
+        query = """
+            SELECT
+                p.changeid,
+                p.name
+            FROM %(meta_schema)s.phases ph
+            JOIN %(meta_schema)s.plan p USING (changeid)
+            WHERE ph.phase = 'expand'
+            AND NOT EXISTS (
+                SELECT 1
+                FROM %(meta_schema)s.changes c
+                WHERE c.changeid = ph.changeid
+            )
+            ORDER BY ph.completed DESC
+        """
+        params = {'meta_schema': AsIs(self.meta_schema)}
+
+        self.cursor.execute(query, params)
+        fetch = self.cursor.fetchall()
+        if fetch is None:
+            return []
+
+        return [dict(f) for f in fetch]
+    # ___________________________
+
+    def fetch_deployment_snapshot(self):
+        """
+        Every planned change with its deployment state, in one query.
+        Deployed changes come first, in deploy order.
+        """
+        query = """
+            SELECT
+                p.changeid,
+                p.name,
+                p.msg,
+                p.tag,
+                p.tagmsg,
+                c.applied,
+                c.seq,
+                c.seq IS NOT NULL AS deployed,
+                ARRAY(
+                    SELECT ph.phase
+                    FROM %(meta_schema)s.phases ph
+                    WHERE ph.changeid = p.changeid
+                    ORDER BY ph.completed
+                ) AS phases
+            FROM %(meta_schema)s.plan p
+            LEFT JOIN %(meta_schema)s.changes c USING (changeid)
+            ORDER BY c.seq NULLS LAST, p.planned, p.name
+        """
+        params = {'meta_schema': AsIs(self.meta_schema)}
+
+        self.cursor.execute(query, params)
+        fetch = self.cursor.fetchall()
+        if fetch is None:
+            return []
+
+        return [dict(f) for f in fetch]
+    # ___________________________
+
+    def fetch_wal_by_tag(self):
+        """
+        WAL of the deployed changes, totalled per tag in deploy order.
+        A change belongs to the first tag at or after it; the latest
+        deploy of every change and phase counts.
+        """
+        query = """
+            WITH latest AS (
+                SELECT DISTINCT ON (w.changeid, w.phase)
+                    w.changeid,
+                    w.seconds,
+                    w.wal_bytes,
+                    w.wal_records,
+                    w.wal_fpi
+                FROM %(meta_schema)s.wal w
+                WHERE w.direction = 'deploy'
+                ORDER BY w.changeid, w.phase, w.recorded DESC
+            ), deployed AS (
+                SELECT
+                    c.changeid,
+                    c.seq,
+                    (
+                        SELECT p.tag
+                        FROM %(meta_schema)s.changes tc
+                        JOIN %(meta_schema)s.plan p USING (changeid)
+                        WHERE p.tag IS NOT NULL
+                        AND tc.seq >= c.seq
+                        ORDER BY tc.seq
+                        LIMIT 1
+                    ) AS tag
+                FROM %(meta_schema)s.changes c
+            )
+            SELECT
+                d.tag,
+                count(DISTINCT d.changeid) AS changes,
+                sum(l.seconds) AS seconds,
+                sum(l.wal_bytes)::bigint AS wal_bytes,
+                sum(l.wal_records)::bigint AS wal_records,
+                sum(l.wal_fpi)::bigint AS wal_fpi
+            FROM latest l
+            JOIN deployed d USING (changeid)
+            GROUP BY d.tag
+            ORDER BY min(d.seq)
+        """
+        params = {'meta_schema': AsIs(self.meta_schema)}
+
+        self.cursor.execute(query, params)
+        fetch = self.cursor.fetchall()
+        if fetch is None:
+            return []
+
+        return [dict(f) for f in fetch]
+    # ___________________________
+
+    def fetch_relation_sizes(self, relations):
+        """
+        {relation: {'table_bytes', 'index_bytes', 'dead', 'live'}} of those of *relations*
+        that exist: table and index bytes, TOAST included in the table,
+        and dead/live tuples from pg_stat_user_tables.
+        Leaves the transaction of the deploy connection open, it may hold a change.
+        """
+        if not relations:
+            return {}
+
+        # statistics read earlier in the transaction are cached
+        self.cursor.execute("""SELECT pg_stat_clear_snapshot()""")
+
+        query = """
+            SELECT
+                r.name AS relation,
+                pg_table_size(r.oid) AS table_bytes,
+                pg_indexes_size(r.oid) AS index_bytes,
+                COALESCE(s.n_dead_tup, 0) AS dead,
+                COALESCE(s.n_live_tup, 0) AS live
+            FROM (
+                SELECT name, to_regclass(name) AS oid
+                FROM unnest(%s::text[]) AS name
+            ) r
+            LEFT JOIN pg_stat_user_tables s ON s.relid = r.oid
+            WHERE r.oid IS NOT NULL
+        """
+        params = [list(relations)]
+
+        self.cursor.execute(query, params)
+        return {r['relation']: dict(r) for r in self.cursor.fetchall()}
+    # ___________________________
+
+    def fetch_size_deltas(self, limit=50):
+        """
+        Relations grown the most by the latest deploy of each change
+        """
+        query = """
+            SELECT *
+            FROM (
+                SELECT DISTINCT ON (s.changeid, s.phase, s.relation)
+                    p.name,
+                    s.phase,
+                    s.relation,
+                    s.table_before,
+                    s.table_after,
+                    s.indexes_before,
+                    s.indexes_after,
+                    s.dead_before,
+                    s.dead_after,
+                    s.live_after
+                FROM %(meta_schema)s.sizes s
+                JOIN %(meta_schema)s.plan p USING (changeid)
+                WHERE s.direction = 'deploy'
+                ORDER BY s.changeid, s.phase, s.relation, s.recorded DESC
+            ) latest
+            ORDER BY (table_after - table_before) + (indexes_after - indexes_before) DESC
+            LIMIT %(limit)s
+        """
+        params = {'meta_schema': AsIs(self.meta_schema), 'limit': limit}
+
+        self.cursor.execute(query, params)
+        fetch = self.cursor.fetchall()
+        if fetch is None:
+            return []
+
+        return [dict(f) for f in fetch]
+    # ___________________________
+
     def fetch_deployed_changeid_by_name(self, change):
         query = """
             SELECT changeid
@@ -302,6 +1042,75 @@ class DBAdmin:
         return dict(fetch)['change']
     # ___________________________
 
+    def fetch_relation_lock_holders(self, relation, modes):
+        """
+        Sessions holding, or queued for, a lock on *relation* in one of *modes*
+        """
+
+        query = """
+            SELECT
+                l.pid,
+                l.mode,
+                l.granted,
+                a.usename,
+                a.application_name,
+                a.state,
+                EXTRACT(EPOCH FROM (now() - a.xact_start)) AS xact_age,
+                EXTRACT(EPOCH FROM (now() - a.state_change)) AS state_age,
+                left(a.query, 120) AS query
+            FROM pg_locks l
+            JOIN pg_stat_activity a ON a.pid = l.pid
+            WHERE l.locktype = 'relation'
+            AND l.relation = to_regclass(%s)
+            AND l.mode = ANY(%s)
+            AND l.pid <> pg_backend_pid()
+            ORDER BY a.xact_start
+        """
+        params = [relation, list(modes)]
+
+        self.cursor.execute(query, params)
+        fetch = self.cursor.fetchall()
+        if fetch is None:
+            return []
+
+        return [dict(f) for f in fetch]
+    # ___________________________
+
+    @reconnecting
+    def fetch_replication_lag(self):
+        """
+        Replay lag of the slowest streaming replica, as seen from the primary
+        """
+
+        query = """
+            SELECT
+                max(pg_wal_lsn_diff(pg_current_wal_lsn(), replay_lsn))::float8 AS bytes,
+                max(EXTRACT(EPOCH FROM replay_lag)) AS seconds
+            FROM pg_stat_replication
+        """
+        params = ()
+
+        self.cursor.execute(query, params)
+        return dict(self.cursor.fetchone())
+    # ___________________________
+
+    @reconnecting
+    def fetch_standby_replay_lag(self, primary_lsn):
+        """
+        Run on a standby: how far its replay is behind *primary_lsn*
+        """
+
+        query = """
+            SELECT
+                pg_wal_lsn_diff(%s::pg_lsn, pg_last_wal_replay_lsn())::float8 AS bytes,
+                NULL::float AS seconds
+        """
+        params = [primary_lsn]
+
+        self.cursor.execute(query, params)
+        return dict(self.cursor.fetchone())
+    # ___________________________
+
     def fetch_tags(self):
         query = """
             SELECT
@@ -346,6 +1155,26 @@ class DBAdmin:
         self.conn.commit()
     # ___________________________
 
+    def try_lock_relation(self, relation, mode):
+        """
+        Takes a lock on *relation* with NOWAIT and releases it right away.
+        Must run inside a transaction; False if the lock is not available.
+        """
+
+        self.cursor.execute("""SAVEPOINT pgin_try_lock""")
+        try:
+            query = """LOCK TABLE %s IN %s MODE NOWAIT"""
+            params = (AsIs(relation), AsIs(mode))
+            self.cursor.execute(query, params)
+            return True
+        except psycopg2.OperationalError as e:
+            if e.pgcode != errorcodes.LOCK_NOT_AVAILABLE:
+                raise
+            return False
+        finally:
+            self.cursor.execute("""ROLLBACK TO SAVEPOINT pgin_try_lock""")
+    # _____________________________
+
     def set_search_path(self, schema):
         query = """
             SET search_path=%s,public
@@ -353,6 +1182,25 @@ class DBAdmin:
         params = (AsIs(schema),)
         self.cursor.execute(query, params)
         self.conn.commit()
+        self.search_path = schema
+    # _____________________________
+
+    @reconnecting
+    def set_lock_timeout(self, timeout):
+        """
+        Session level lock_timeout, committed on its own
+        so a rolled back change does not reset it.
+        """
+        if timeout is None:
+            query = """RESET lock_timeout"""
+            params = ()
+        else:
+            query = """SET lock_timeout = %s"""
+            params = (str(timeout),)
+
+        self.cursor.execute(query, params)
+        self.conn.commit()
+        self.lock_timeout = timeout
     # _____________________________
 
     def show_search_path(self):
@@ -365,15 +1213,98 @@ class DBAdmin:
         return fetch['search_path']
     # _____________________________
 
+    def relation_exists(self, relation):
+        query = """SELECT to_regclass(%s) IS NOT NULL AS found"""
+        params = [relation]
+
+        self.cursor.execute(query, params)
+        return self.cursor.fetchone()['found']
+    # _____________________________
+
+    @traced('bookkeeping')
+    @reconnecting
     def remove_change(self, changeid):
         query = """
             DELETE FROM %s.changes
             WHERE changeid = %s
         """
         params = [AsIs(self.meta_schema), changeid]
+        self.cursor.execute(query, params)
+
+        query = """
+            DELETE FROM %s.steps
+            WHERE changeid = %s
+        """
+        self.cursor.execute(query, params)
+
+        query = """
+            DELETE FROM %s.phases
+            WHERE changeid = %s
+        """
+        self.cursor.execute(query, params)
+
+        query = """
+            DELETE FROM %s.validations
+            WHERE changeid = %s
+        """
+        self.cursor.execute(query, params)
+
+        self.conn.commit()
+    # _____________________________
+
+    @traced('bookkeeping')
+    @reconnecting
+    def remove_phase(self, changeid, phase):
+        query = """
+            DELETE FROM %s.phases
+            WHERE changeid = %s
+            AND phase = %s
+        """
+        params = [AsIs(self.meta_schema), changeid, phase]
+        self.cursor.execute(query, params)
+        self.conn.commit()
+    # _____________________________
+
+    def recreate_schema(self, schema):
+        """
+        Drops *schema* with everything in it and creates it empty
+        """
+        query = """
+            DROP SCHEMA IF EXISTS %(schema)s CASCADE;
+            CREATE SCHEMA %(schema)s AUTHORIZATION %(user)s;
+        """
+        params = {'schema': AsIs(schema), 'user': AsIs(self.dbuser)}
+        self.cursor.execute(query, params)
+        self.conn.commit()
+    # _____________________________
+
+    def rename_meta_schema_from(self, dbname):
+        """
+        A DB cloned from another pgin project DB carries the meta schema
+        of that project. Renames it to this project meta schema, if there is one.
+        """
+        source = 'pgin_%s' % dbname
+        if source == self.meta_schema:
+            return False
 
+        query = """
+            SELECT 1
+            FROM information_schema.schemata
+            WHERE schema_name = %s
+        """
+        params = [source]
+        self.cursor.execute(query, params)
+        if self.cursor.fetchone() is None:
+            return False
+
+        self.drop_meta_schema()
+        query = """
+            ALTER SCHEMA %s RENAME TO %s
+        """
+        params = [AsIs(source), AsIs(self.meta_schema)]
         self.cursor.execute(query, params)
         self.conn.commit()
+        return True
     # _____________________________
 
     def remove_change_from_plan(self, change):
@@ -387,6 +1318,7 @@ class DBAdmin:
         self.conn.commit()
     # _____________________________
 
+    @reconnecting
     def remove_tag(self, change):
         query = """
             UPDATE %s.plan
@@ -414,6 +1346,33 @@ class DBAdmin:
         self.conn.commit()
     # _____________________________
 
+    @traced('validate')
+    def validate_constraint(self, relation, constraint):
+        """
+        VALIDATE CONSTRAINT scans *relation* under SHARE UPDATE EXCLUSIVE only:
+        reads and writes go on. Marked validated in the same transaction.
+        """
+        query = """
+            ALTER TABLE %s VALIDATE CONSTRAINT %s
+        """
+        params = [AsIs(relation), AsIs(constraint)]
+        try:
+            self.cursor.execute(query, params)
+
+            query = """
+                UPDATE %s.validations
+                SET validated = %s
+                WHERE relation = %s
+                AND constraint_name = %s
+            """
+            params = [AsIs(self.meta_schema), datetime.datetime.utcnow(), relation, constraint]
+            self.cursor.execute(query, params)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+    # _____________________________
+
     def revoke_connect_from_db(self):
         conn = None
         cursor = None
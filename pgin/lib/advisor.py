@@ -0,0 +1,255 @@
+import re
+from pgin.lib.cursors import MeteredCursor
+# ==============================================================
+
+# Schemas left out of the advice: catalogs and pgin meta schemas
+EXCLUDED_SCHEMAS = r"^(pg_catalog|information_schema|pg_toast|pgin_.*)$"
+
+# Longest change name proposed, leaving room in class and index names
+NAME_LENGTH = 50
+# ==============================================================
+
+
+class IndexAdvisor:
+    """
+    Reads the workload statistics of the connected database and
+    proposes index changes:
+
+    * foreign keys no index starts with: deletes and updates of the
+      referenced rows scan the referencing table
+    * indexes never scanned since the statistics were reset
+    * indexes duplicating another one or a leading prefix of it
+    * tables read mostly by sequential scans, with the statements of
+      pg_stat_statements touching them when the extension is installed;
+      these need a human to pick the columns
+
+    Usage counts are per server: an index unused on the primary
+    may serve queries on a standby.
+    """
+
+    def __init__(self, conn, min_rows=10000, min_index_bytes=1024 * 1024):
+        self.conn = conn
+        self.cursor = conn.cursor(cursor_factory=MeteredCursor)
+        self.min_rows = min_rows
+        self.min_index_bytes = min_index_bytes
+    # _____________________________
+
+    def fetch(self, query, params=None):
+        self.cursor.execute(query, params)
+        rows = [dict(r) for r in self.cursor.fetchall()]
+        self.conn.commit()
+        return rows
+    # _____________________________
+
+    def stats_since(self):
+        query = """
+            SELECT stats_reset
+            FROM pg_stat_database
+            WHERE datname = current_database()
+        """
+        rows = self.fetch(query)
+        return rows[0]['stats_reset'] if rows else None
+    # _____________________________
+
+    def unindexed_foreign_keys(self):
+        query = """
+            SELECT
+                c.conrelid::regclass::text AS relation,
+                c.conname AS constraint_name,
+                array_agg(a.attname::text ORDER BY k.ord) AS columns,
+                s.n_live_tup AS rows
+            FROM pg_constraint c
+            JOIN pg_namespace n ON n.oid = c.connamespace
+            CROSS JOIN LATERAL unnest(c.conkey) WITH ORDINALITY AS k(attnum, ord)
+            JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = k.attnum
+            LEFT JOIN pg_stat_user_tables s ON s.relid = c.conrelid
+            WHERE c.contype = 'f'
+            AND n.nspname !~ %(excluded)s
+            AND NOT EXISTS (
+                SELECT 1
+                FROM pg_index i
+                WHERE i.indrelid = c.conrelid
+                AND i.indpred IS NULL
+                AND (i.indkey::int2[])[0:array_length(c.conkey, 1) - 1] @> c.conkey
+                AND (i.indkey::int2[])[0:array_length(c.conkey, 1) - 1] <@ c.conkey
+            )
+            GROUP BY c.conrelid, c.conname, s.n_live_tup
+            ORDER BY s.n_live_tup DESC NULLS LAST
+        """
+        return self.fetch(query, {'excluded': EXCLUDED_SCHEMAS})
+    # _____________________________
+
+    def unused_indexes(self):
+        """
+        Never scanned, not enforcing a constraint and not supporting a foreign key
+        """
+        query = """
+            SELECT
+                s.relid::regclass::text AS relation,
+                s.indexrelid::regclass::text AS index,
+                pg_relation_size(s.indexrelid) AS bytes,
+                pg_get_indexdef(s.indexrelid) AS definition
+            FROM pg_stat_user_indexes s
+            JOIN pg_index i ON i.indexrelid = s.indexrelid
+            WHERE s.idx_scan = 0
+            AND s.schemaname !~ %(excluded)s
+            AND NOT i.indisunique
+            AND NOT i.indisprimary
+            AND NOT i.indisreplident
+            AND i.indisvalid
+            AND pg_relation_size(s.indexrelid) >= %(min_bytes)s
+            AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = s.indexrelid)
+            AND NOT EXISTS (
+                SELECT 1
+                FROM pg_constraint f
+                WHERE f.conrelid = i.indrelid
+                AND f.contype = 'f'
+                AND (i.indkey::int2[])[0:array_length(f.conkey, 1) - 1] @> f.conkey
+            )
+            ORDER BY bytes DESC
+        """
+        return self.fetch(query, {'excluded': EXCLUDED_SCHEMAS, 'min_bytes': self.min_index_bytes})
+    # _____________________________
+
+    def redundant_indexes(self):
+        """
+        Plain indexes whose key columns and operator classes are the same as,
+        or a leading prefix of, another index of the same method on the table.
+        Of two identical indexes the one not backing a constraint, else the newer, is proposed.
+        """
+        query = """
+            SELECT
+                a.indrelid::regclass::text AS relation,
+                a.indexrelid::regclass::text AS index,
+                b.indexrelid::regclass::text AS covered_by,
+                pg_relation_size(a.indexrelid) AS bytes,
+                pg_get_indexdef(a.indexrelid) AS definition
+            FROM pg_index a
+            JOIN pg_index b ON b.indrelid = a.indrelid AND b.indexrelid <> a.indexrelid
+            JOIN pg_class ca ON ca.oid = a.indexrelid
+            JOIN pg_class cb ON cb.oid = b.indexrelid
+            JOIN pg_namespace n ON n.oid = ca.relnamespace
+            WHERE ca.relam = cb.relam
+            AND n.nspname !~ %(excluded)s
+            AND a.indpred IS NULL AND b.indpred IS NULL
+            AND a.indexprs IS NULL AND b.indexprs IS NULL
+            AND a.indisvalid AND b.indisvalid
+            AND a.indnkeyatts <= b.indnkeyatts
+            AND (a.indkey::int2[])[0:a.indnkeyatts - 1] = (b.indkey::int2[])[0:a.indnkeyatts - 1]
+            AND (a.indclass::oid[])[0:a.indnkeyatts - 1] = (b.indclass::oid[])[0:a.indnkeyatts - 1]
+            -- a unique index is only redundant next to an identical unique one
+            AND (NOT a.indisunique OR (b.indisunique AND a.indnkeyatts = b.indnkeyatts))
+            AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = a.indexrelid)
+            AND (
+                a.indnkeyatts < b.indnkeyatts
+                OR EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = b.indexrelid)
+                OR a.indexrelid > b.indexrelid
+            )
+            ORDER BY bytes DESC
+        """
+        rows = self.fetch(query, {'excluded': EXCLUDED_SCHEMAS})
+
+        # an index covered by several others is proposed once
+        redundant = {}
+        for row in rows:
+            redundant.setdefault(row['index'], row)
+
+        return list(redundant.values())
+    # _____________________________
+
+    def seq_scanned_tables(self):
+        query = """
+            SELECT
+                relid::regclass::text AS relation,
+                relname,
+                seq_scan,
+                COALESCE(idx_scan, 0) AS idx_scan,
+                seq_tup_read,
+                n_live_tup AS rows
+            FROM pg_stat_user_tables
+            WHERE n_live_tup >= %(min_rows)s
+            AND schemaname !~ %(excluded)s
+            AND seq_scan > COALESCE(idx_scan, 0)
+            AND seq_tup_read / GREATEST(seq_scan, 1) >= %(min_rows)s
+            ORDER BY seq_tup_read DESC
+            LIMIT 20
+        """
+        tables = self.fetch(query, {'min_rows': self.min_rows, 'excluded': EXCLUDED_SCHEMAS})
+
+        statements = self.top_statements()
+        for table in tables:
+            pattern = re.compile(r'\b{}\b'.format(re.escape(table['relname'])), re.I)
+            table['statements'] = [s for s in statements if pattern.search(s['query'])][:3]
+
+        return tables
+    # _____________________________
+
+    def top_statements(self, limit=100):
+        """
+        The statements taking the most time, if pg_stat_statements is installed
+        """
+        if not self.fetch("""SELECT to_regclass('pg_stat_statements') IS NOT NULL AS found""")[0]['found']:
+            return []
+
+        total = 'total_exec_time' if self.conn.server_version >= 130000 else 'total_time'
+        query = """
+            SELECT
+                query,
+                calls,
+                {total} AS total_ms,
+                {total} / GREATEST(calls, 1) AS mean_ms
+            FROM pg_stat_statements
+            WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database())
+            ORDER BY {total} DESC
+            LIMIT %(limit)s
+        """.format(total=total)
+        return self.fetch(query, {'limit': limit})
+    # _____________________________
+
+    def proposals(self):
+        """
+        Changes to scaffold: {'name', 'msg', 'indexes' or 'drop_indexes'}
+        """
+        proposals = []
+        for fk in self.unindexed_foreign_keys():
+            columns = fk['columns']
+            index = index_name_for(fk['relation'], columns)
+            proposals.append({
+                'name': change_name('index', fk['relation'], *columns),
+                'msg': "Index foreign key {} of {}".format(fk['constraint_name'], fk['relation']),
+                'indexes': [{'name': index, 'table': fk['relation'], 'columns': ', '.join(columns)}],
+            })
+
+        dropped = set()
+        for why, rows in [('never scanned', self.unused_indexes()), ('redundant', self.redundant_indexes())]:
+            for row in rows:
+                if row['index'] in dropped:
+                    continue
+                dropped.add(row['index'])
+                msg = "Drop {} index {}".format(why, row['index'])
+                if row.get('covered_by'):
+                    msg += ", covered by {}".format(row['covered_by'])
+                proposals.append({
+                    'name': change_name('drop', row['index']),
+                    'msg': msg,
+                    'drop_indexes': [{'name': row['index'], 'table': row['relation'], 'definition': row['definition']}],
+                })
+
+        return proposals
+# ==============================================================
+
+
+def change_name(*parts):
+    name = re.sub(r'[^a-z0-9]+', '_', '_'.join(parts).lower()).strip('_')
+    return name[:NAME_LENGTH].rstrip('_')
+# _____________________________
+
+
+def index_name_for(relation, columns):
+    """
+    An index is created in the schema of its table, under an unqualified name
+    """
+    table = relation.rpartition('.')[2]
+    name = re.sub(r'[^a-z0-9]+', '_', '{}_{}'.format(table, '_'.join(columns)).lower()).strip('_')
+    return '{}_idx'.format(name[:59])
+# ==============================================================
@@ -0,0 +1,149 @@
+import time
+import queue
+import logging
+import threading
+import psycopg2
+from psycopg2 import errorcodes
+from psycopg2.extensions import AsIs
+from pgin.lib.cursors import MeteredCursor
+from pgin.lib.tracing import tracer
+# ==============================================================
+
+# A relation is analyzed once a deploy modified this many rows of it...
+ANALYZE_MIN_ROWS = 1000
+# ... or this fraction of its live rows
+ANALYZE_FRACTION = 0.1
+
+# Backends report table statistics up to a second after a transaction ends
+STATS_FLUSH_DELAY = 1.5
+# ==============================================================
+
+
+def modification_counts(conn):
+    """
+    {relation: (n_mod_since_analyze, n_live_tup)} of every user table.
+    Relations are schema qualified: the analyzing connections may have another search_path.
+    """
+    cursor = conn.cursor(cursor_factory=MeteredCursor)
+    try:
+        cursor.execute("""SELECT pg_stat_clear_snapshot()""")
+        query = """
+            SELECT
+                quote_ident(schemaname) || '.' || quote_ident(relname),
+                n_mod_since_analyze,
+                n_live_tup
+            FROM pg_stat_user_tables
+        """
+        cursor.execute(query)
+        counts = {r[0]: (r[1], r[2]) for r in cursor.fetchall()}
+        conn.commit()
+        return counts
+    finally:
+        cursor.close()
+# _____________________________
+
+
+def touched_relations(before, after):
+    """
+    Relations modified enough between the *before* and *after* modification_counts
+    to make their statistics stale, the most modified first.
+    Relations created in between count from zero.
+    """
+    touched = []
+    for relation, (mods, live) in after.items():
+        old_mods, old_live = before.get(relation, (0, 0))
+        # an ANALYZE in between resets the counter
+        delta = mods - old_mods if mods >= old_mods else mods
+        if delta <= 0:
+            continue
+        if delta >= ANALYZE_MIN_ROWS or delta >= ANALYZE_FRACTION * max(old_live, 1):
+            touched.append((delta, relation))
+
+    return [relation for _, relation in sorted(touched, reverse=True)]
+# ==============================================================
+
+
+class ParallelAnalyzer:
+    """
+    ANALYZEs relations on up to *parallelism* connections opened with
+    *connect*, within *budget* seconds in total: each ANALYZE gets the
+    remaining time as its statement_timeout and the relations not reached
+    are left to autovacuum.
+    """
+
+    def __init__(self, connect, parallelism=2, budget=60.0):
+        self.logger = logging.getLogger('pgin')
+        self.connect = connect
+        self.parallelism = parallelism
+        self.budget = budget
+        self.deadline = None
+        self.results = []
+        self.lock = threading.Lock()
+    # _____________________________
+
+    def remaining(self):
+        return self.deadline - time.perf_counter()
+    # _____________________________
+
+    def analyze(self, relations):
+        self.deadline = time.perf_counter() + self.budget
+        todo = queue.Queue()
+        for relation in relations:
+            todo.put(relation)
+
+        workers = [
+            threading.Thread(target=self.worker, args=(todo,), name='pgin-analyze-%d' % i, daemon=True)
+            for i in range(min(self.parallelism, len(relations)))
+        ]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+
+        while not todo.empty():
+            self.record(todo.get_nowait(), 'skipped')
+
+        return self.results
+    # _____________________________
+
+    def worker(self, todo):
+        conn = None
+        try:
+            conn = self.connect()
+            conn.autocommit = True
+            cursor = conn.cursor(cursor_factory=MeteredCursor)
+
+            while self.remaining() > 0:
+                try:
+                    relation = todo.get_nowait()
+                except queue.Empty:
+                    return
+                self.analyze_relation(cursor, relation)
+        except psycopg2.Error as e:
+            self.logger.warning("Analyze worker failed: %s", e)
+        finally:
+            if conn is not None:
+                conn.close()
+    # _____________________________
+
+    def analyze_relation(self, cursor, relation):
+        started = time.perf_counter()
+        cursor.execute("""SET statement_timeout = %s""", [max(int(self.remaining() * 1000), 1)])
+        try:
+            with tracer.span('analyze {}'.format(relation), 'analyze'):
+                cursor.execute("""ANALYZE %s""", [AsIs(relation)])
+            status = 'analyzed'
+        except psycopg2.Error as e:
+            if e.pgcode == errorcodes.QUERY_CANCELED:
+                status = 'timeout'
+            else:
+                self.logger.warning("ANALYZE %s failed: %s", relation, e)
+                status = 'failed'
+
+        self.record(relation, status, time.perf_counter() - started)
+    # _____________________________
+
+    def record(self, relation, status, seconds=0.0):
+        with self.lock:
+            self.results.append({'relation': relation, 'status': status, 'seconds': seconds})
+# ==============================================================
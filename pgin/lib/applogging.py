@@ -1,8 +1,59 @@
 import os
 import sys
+import copy
+import json
+import queue
+import atexit
 import logging
-from lib import utils
+import logging.handlers
+from pgin.lib.helpers import create_directory
 logger = None
+listener = None
+
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+# ======================================
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """
+    One JSON object per record.
+    Structured data passed as extra={'event': {...}} is kept under the 'event' key.
+    """
+
+    def format(self, record):
+        entry = {
+            'ts': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'process': record.process,
+            'thread': record.threadName,
+            'module': record.module,
+            'func': record.funcName,
+            'msg': record.getMessage(),
+        }
+
+        event = getattr(record, 'event', None)
+        if event is not None:
+            entry['event'] = event
+
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, default=str)
+# ======================================
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler.prepare() formats the message on the logging thread.
+    Here the record is queued as is, so both formatting and I/O
+    happen on the listener thread.
+    Log arguments must therefore not be mutated after the call.
+    """
+
+    def prepare(self, record):
+        return copy.copy(record)
 # ======================================
 
 
@@ -16,48 +67,73 @@ def set_handler_console(logger_name, out_to='stderr'):
 # ___________________________________________
 
 
-def set_handler_file(logger_name, logpath):
-
-    logformat = '%(asctime)s %(process)d %(levelname)-10s %(module)s %(funcName)-4s %(message)s'
+def set_handler_file(logger_name, logpath, max_bytes=LOG_MAX_BYTES, backup_count=LOG_BACKUP_COUNT):
 
-    utils.create_directory(os.path.dirname(logpath))
-    handler = logging.FileHandler(logpath)
+    create_directory(os.path.dirname(logpath))
+    handler = logging.handlers.RotatingFileHandler(logpath, maxBytes=max_bytes, backupCount=backup_count)
     handler.set_name('%s-file' % logger_name)
 
     handler.setLevel(logging.DEBUG)
-    handler.setFormatter(logging.Formatter(logformat))
+    handler.setFormatter(JsonLinesFormatter())
 
     return handler
 # ____________________________________________
 
 
 def set_logger(logger_name, logpath, log_to_console=False, parent_logger=None):
+    """
+    The logger itself only puts records on a queue.
+    A QueueListener thread formats them and writes them to the handlers.
+    """
 
     global logger
+    global listener
+
     logger = logging.getLogger(logger_name)
+    clean_logger(logger)
 
-    # Debug logger
     logger.propagate = False
     logger.setLevel(logging.DEBUG)
+
+    # Debug logger
     file_handler = set_handler_file(logger_name=logger_name, logpath=logpath)
-    logger.addHandler(file_handler)
+    handlers = [file_handler]
     logger.path = file_handler.baseFilename
 
     # Console logger
     if log_to_console:
-        console_handler = set_handler_console(logger_name=logger_name)
-        logger.addHandler(console_handler)
+        handlers.append(set_handler_console(logger_name=logger_name))
+
+    if parent_logger is not None:
+        handlers.extend(parent_logger.handlers)
 
-    if parent_logger is None:
-        return logger
+    log_queue = queue.Queue(-1)
+    logger.addHandler(DeferredQueueHandler(log_queue))
 
-    for parent_lh in parent_logger.handlers:
-        logger.addHandler(parent_lh)
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.owned_handlers = handlers[:2 if log_to_console else 1]
+    listener.start()
 
     return logger
 # ____________________________________________
 
 
+def stop_listener():
+    """
+    Flushes queued records. Registered with atexit.
+    """
+    global listener
+
+    if listener is None:
+        return
+
+    listener.stop()
+    for h in listener.owned_handlers:
+        h.close()
+    listener = None
+# ____________________________________________
+
+
 def clean_logger(lg):
     for h in lg.handlers[:]:
         if hasattr(h, 'connection'):
@@ -65,5 +141,10 @@ def clean_logger(lg):
         h.close()
         lg.removeHandler(h)
 
+    stop_listener()
     lg = None
+# ____________________________________________
+
+
+atexit.register(stop_listener)
 # ====================================================
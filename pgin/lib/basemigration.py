@@ -1,12 +1,414 @@
-import psycopg2
+import datetime
+from psycopg2.extensions import AsIs
+from pgin.lib.cursors import StatementCursor
+from pgin.lib.indexes import ConcurrentIndexBuilder, drop_index_concurrently, index_name
+from pgin.lib.partitions import PartitionMaintainer
+from pgin.lib.phases import backfill_sql, dual_write_trigger_sql, drop_dual_write_trigger_sql
+from pgin.lib.rewrite import ShadowRewrite
 # ============================
 
 
 class Basemigration:
-    def __init__(self, project, project_user, conf, conn, logger):
+    """
+    Base of deploy and revert migrations.
+
+    A migration either implements __call__ itself, or lists method names in *steps*.
+    Every completed step is recorded in the meta-schema steps table,
+    so after a failure the next run resumes from the first incomplete one.
+    With step_isolation = 'transaction' each step commits on its own.
+    With 'savepoint' the whole change is a single transaction, each step
+    under a savepoint; on failure the steps completed so far are still committed.
+
+    A migration listing *indexes* instead builds them with CREATE INDEX
+    CONCURRENTLY on deploy, and drops them with DROP INDEX CONCURRENTLY
+    on revert, e.g.
+
+        indexes = [
+            {'name': 'orders_customer_idx', 'table': 'orders', 'columns': 'customer_id'},
+            {'name': 'items_sku_uq', 'table': 'items', 'columns': 'sku', 'unique': True},
+        ]
+        maintenance_work_mem = '1GB'
+
+    *drop_indexes* works the other way round: dropped on deploy, rebuilt
+    on revert from their 'definition', as pg_get_indexdef() returns it.
+
+    A zero-downtime change lists *phases* = ('expand', 'contract') and
+    implements a method per phase: expand adds the new structures, a
+    dual-write trigger and the backfill while the old application version
+    still runs; contract drops the old structures once it is gone.
+    The revert counterpart implements the same methods, undoing each phase.
+    """
+
+    # Overrides deploy --lock-timeout for this change, e.g. '1s'
+    lock_timeout = None
+
+    steps = None
+    step_isolation = 'transaction'
+
+    phases = None
+
+    indexes = None
+    # Indexes dropped on deploy and rebuilt on revert, specs with a 'definition'
+    drop_indexes = None
+    # Connections building indexes of different tables at the same time
+    index_parallelism = 2
+    maintenance_work_mem = None
+    max_parallel_maintenance_workers = None
+    # lock_timeout of the index builds, which wait for every older transaction; None waits as long as it takes
+    build_lock_timeout = None
+
+    # Partition maintenance specs, see pgin.lib.partitions.PartitionMaintainer
+    partitions = None
+
+    # Statements run outside a transaction on deploy, e.g. VACUUM or REINDEX CONCURRENTLY
+    maintenance = None
+
+    def __init__(
+            self,
+            project,
+            project_user,
+            conf,
+            conn,
+            logger,
+            throttle=None,
+            changeid=None,
+            direction=None,
+            explain=False,
+            connect=None):
+
         self.project = project
         self.project_user = project_user
         self.conf = conf
         self.logger = logger
         self.conn = conn
-        self.cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        self.cursor = conn.cursor(cursor_factory=StatementCursor)
+        self.cursor.explain = explain
+        self.throttle = throttle
+        self.changeid = changeid
+        self.direction = direction
+        self.meta_schema = 'pgin_%s' % project
+        # Opens another connection to the project DB
+        self.connect = connect
+        self.index_builds = []
+        self.rewrites = []
+        # Constraints added NOT VALID, queued for validation by pgin
+        self.validations = []
+        self.partition_actions = []
+        # Set by pgin before running a change split into phases
+        self.phase = None
+    # _____________________________
+
+    def __call__(self):
+        if self.phase is not None:
+            getattr(self, self.phase)()
+            return
+
+        if (self.indexes or self.drop_indexes) and not self.steps:
+            created, dropped = self.indexes, self.drop_indexes
+            if self.direction == 'revert':
+                created, dropped = dropped, created
+            if dropped:
+                self.drop_indexes_concurrently(dropped)
+            if created:
+                self.create_indexes_concurrently(created)
+            return
+
+        if self.partitions and not self.steps:
+            if self.direction == 'revert':
+                self.logger.info("Partition maintenance is not undone on revert")
+            else:
+                self.maintain_partitions()
+            return
+
+        if self.maintenance and not self.steps:
+            if self.direction == 'revert':
+                self.logger.info("Maintenance is not undone on revert")
+            else:
+                self.run_maintenance()
+            return
+
+        if not self.steps:
+            raise NotImplementedError(
+                "%s defines neither __call__, steps, indexes, partitions nor maintenance" % type(self).__name__)
+
+        self.run_steps()
+    # _____________________________
+
+    def rebind(self, conn):
+        """
+        Carries on over a new connection after the old one was lost
+        """
+        cursor = conn.cursor(cursor_factory=StatementCursor)
+        for attr in ['rows', 'explain', 'statements', 'explains']:
+            setattr(cursor, attr, getattr(self.cursor, attr))
+        self.conn = conn
+        self.cursor = cursor
+    # _____________________________
+
+    def completed_steps(self):
+        query = """
+            SELECT step
+            FROM %s.steps
+            WHERE changeid = %s
+            AND direction = %s
+        """
+        params = [AsIs(self.meta_schema), self.changeid, self.direction]
+
+        self.cursor.execute(query, params)
+        return {r['step'] for r in self.cursor.fetchall()}
+    # _____________________________
+
+    def record_step(self, step):
+        query = """
+            INSERT INTO %s.steps
+            (changeid, direction, step, completed)
+            VALUES
+            (%s, %s, %s, %s)
+            ON CONFLICT DO NOTHING
+        """
+        params = [AsIs(self.meta_schema), self.changeid, self.direction, step, datetime.datetime.utcnow()]
+
+        self.cursor.execute(query, params)
+    # _____________________________
+
+    def run_steps(self):
+        savepoints = self.step_isolation == 'savepoint'
+        completed = self.completed_steps()
+
+        for step in self.steps:
+            if step in completed:
+                self.logger.info("Step %s.%s already completed, skipping", type(self).__name__, step)
+                continue
+
+            if savepoints:
+                self.cursor.execute("""SAVEPOINT pgin_step""")
+
+            try:
+                getattr(self, step)()
+                self.record_step(step)
+                if savepoints:
+                    self.cursor.execute("""RELEASE SAVEPOINT pgin_step""")
+                else:
+                    self.conn.commit()
+            except Exception:
+                if savepoints:
+                    self.cursor.execute("""ROLLBACK TO SAVEPOINT pgin_step""")
+                    self.conn.commit()
+                else:
+                    self.conn.rollback()
+                raise
+
+        self.conn.commit()
+    # _____________________________
+
+    def create_indexes_concurrently(self, indexes=None):
+        """
+        Builds *indexes* (default: the class attribute) outside a transaction.
+        Commits whatever the migration did on its connection so far.
+        """
+        builder = ConcurrentIndexBuilder(
+            self.conn,
+            connect=self.connect,
+            parallelism=self.index_parallelism,
+            settings={
+                'maintenance_work_mem': self.maintenance_work_mem,
+                'max_parallel_maintenance_workers': self.max_parallel_maintenance_workers,
+                'lock_timeout': self.build_lock_timeout,
+            }
+        )
+        self.index_builds.extend(builder.build(indexes or self.indexes))
+        return self.index_builds
+    # _____________________________
+
+    def drop_indexes_concurrently(self, indexes=None):
+        """
+        DROP INDEX CONCURRENTLY IF EXISTS for *indexes*, names or specs
+        """
+        self.conn.commit()
+        autocommit = self.conn.autocommit
+        self.conn.autocommit = True
+        try:
+            for index in indexes or self.indexes:
+                drop_index_concurrently(self.cursor, index_name(index))
+                self.index_builds.append({'index': index_name(index), 'status': 'dropped'})
+        finally:
+            self.conn.autocommit = autocommit
+    # _____________________________
+
+    def maintain_partitions(self, partitions=None):
+        """
+        Pre-creates future partitions and detaches expired ones,
+        for every spec of *partitions* or the class attribute
+        """
+        for spec in partitions or self.partitions:
+            self.partition_actions.extend(PartitionMaintainer(self.conn, spec).run())
+        return self.partition_actions
+    # _____________________________
+
+    def run_maintenance(self, statements=None):
+        """
+        Runs *statements* (default: the class attribute) one by one in autocommit,
+        as VACUUM and the CONCURRENTLY commands require.
+        Commits whatever the migration did on its connection so far.
+        """
+        if getattr(self.conn, 'dry_run', False):
+            raise RuntimeError("Maintenance statements cannot run in a dry run")
+
+        self.conn.commit()
+        autocommit = self.conn.autocommit
+        self.conn.autocommit = True
+        try:
+            for statement in statements or self.maintenance:
+                self.logger.info("Running %s", statement)
+                self.cursor.execute(statement)
+        finally:
+            self.conn.autocommit = autocommit
+    # _____________________________
+
+    def create_dual_write_trigger(self, table, old, new, forward=None, backward=None):
+        """
+        Keeps column *old* and its replacement *new* of *table* in step on every write.
+        *forward*/*backward* are SQL expressions over NEW, e.g. 'lower(NEW.email)'.
+        """
+        try:
+            self.cursor.execute(dual_write_trigger_sql(table, old, new, forward, backward))
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+    # _____________________________
+
+    def drop_dual_write_trigger(self, table, old, new):
+        try:
+            self.cursor.execute(drop_dual_write_trigger_sql(table, old, new))
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+    # _____________________________
+
+    def backfill(self, table, assignments, where, key='id', batch_size=10000):
+        """
+        UPDATE *table* SET *assignments* in committed batches of *batch_size* rows
+        matching *where*, throttled on replication lag. Rows locked by the application
+        are skipped first and picked up by a final, waiting pass.
+        *where* has to stop matching a row once it is updated, e.g. 'new IS NULL AND old IS NOT NULL'.
+        Returns the number of rows updated.
+        """
+        rows = self.run_batched(backfill_sql(table, assignments, where, key, batch_size))
+        rows += self.run_batched(backfill_sql(table, assignments, where, key, batch_size, skip_locked=False))
+        self.logger.info("Backfilled %d rows of %s", rows, table)
+        return rows
+    # _____________________________
+
+    def add_constraint_not_valid(self, table, name, definition):
+        """
+        ALTER TABLE *table* ADD CONSTRAINT *name* *definition* NOT VALID, in the change
+        transaction: only new and updated rows are checked, so the lock is held
+        for milliseconds instead of a full scan. *definition* is a CHECK or FOREIGN KEY clause.
+
+        pgin queues the constraint and validates it after the deploy,
+        or with pgin validate when deployed with --defer-validation.
+        """
+        self.cursor.execute(
+            """ALTER TABLE %s ADD CONSTRAINT %s %s NOT VALID""",
+            [AsIs(table), AsIs(name), AsIs(definition)]
+        )
+        self.validations.append({'relation': table, 'constraint': name})
+    # _____________________________
+
+    def validate_constraint(self, table, name):
+        """
+        Validates a NOT VALID constraint right away, e.g. from the contract phase.
+        Holds SHARE UPDATE EXCLUSIVE while scanning, which lets writes through.
+        """
+        try:
+            self.cursor.execute("""ALTER TABLE %s VALIDATE CONSTRAINT %s""", [AsIs(table), AsIs(name)])
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+    # _____________________________
+
+    def rewrite_table(self, table, alterations=(), columns=None, using=None, key=None, chunk_size=10000):
+        """
+        Changes *table* online through a shadow copy instead of a rewriting ALTER TABLE:
+        *alterations* are ALTER TABLE subcommands applied to the empty shadow, e.g.
+        ['ALTER COLUMN id TYPE bigint'], or *columns* defines it in full, e.g. to reorder.
+        *using* maps shadow columns to expressions over the original row.
+        Rows are copied in chunks of *chunk_size*, throttled on replication lag.
+
+        The original is kept as <table>__pgin_old: pair with revert_rewrite()
+        in the revert script and drop it with finish_rewrite() once confirmed,
+        e.g. as the expand and contract phases of one change.
+        """
+        rewrite = self.shadow_rewrite(table, alterations, columns, using, key, chunk_size)
+        rewrite.run()
+        self.rewrites.append(
+            {'table': table, 'action': 'rewritten', 'rows': rewrite.copied, 'replayed': rewrite.replayed})
+    # _____________________________
+
+    def revert_rewrite(self, table, key=None):
+        """
+        Puts back the table kept by rewrite_table(), with the writes made since the swap
+        """
+        rewrite = self.shadow_rewrite(table, key=key)
+        rewrite.revert()
+        self.rewrites.append({'table': table, 'action': 'reverted', 'replayed': rewrite.replayed})
+    # _____________________________
+
+    def finish_rewrite(self, table):
+        self.shadow_rewrite(table).finish()
+        self.rewrites.append({'table': table, 'action': 'finished'})
+    # _____________________________
+
+    def shadow_rewrite(self, table, alterations=(), columns=None, using=None, key=None, chunk_size=10000):
+        return ShadowRewrite(
+            self.conn,
+            table,
+            alterations=alterations,
+            columns=columns,
+            using=using,
+            key=key,
+            chunk_size=chunk_size,
+            wait=self.throttle_wait,
+        )
+    # _____________________________
+
+    def throttle_wait(self):
+        """
+        Call between batches of a write-heavy migration:
+        pauses while replicas lag behind.
+        """
+        if self.throttle is None:
+            return 0
+
+        return self.throttle.wait()
+    # _____________________________
+
+    def run_batched(self, query, params=None):
+        """
+        Executes and commits *query* until it affects no more rows.
+        The query has to limit itself, e.g.
+
+            UPDATE t SET b = a
+            WHERE id IN (SELECT id FROM t WHERE b IS NULL LIMIT 10000)
+
+        Returns the total number of rows affected.
+        """
+        total = 0
+
+        while True:
+            try:
+                self.cursor.execute(query, params)
+                rows = self.cursor.rowcount
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+
+            if rows <= 0:
+                return total
+
+            total += rows
+            self.throttle_wait()
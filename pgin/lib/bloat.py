@@ -0,0 +1,47 @@
+# Dead tuples left by a change worth a VACUUM: at least this many...
+DEAD_MIN = 10000
+# ... and this fraction of the live ones
+DEAD_FRACTION = 0.2
+
+# Index growth worth a REINDEX: at least this many bytes...
+INDEX_GROWTH_MIN = 8 * 1024 * 1024
+# ... growing the indexes by this fraction, more than the table grew
+INDEX_GROWTH_FRACTION = 0.3
+# ==============================================================
+
+
+def growth(before, after):
+    """
+    Relative growth, None from nothing
+    """
+    if not before:
+        return None
+
+    return (after - before) / float(before)
+# _____________________________
+
+
+def follow_ups(row):
+    """
+    Follow-up maintenance statements for a relation *row* of size deltas:
+    {'relation', 'table_before', 'table_after', 'indexes_before', 'indexes_after',
+     'dead_after', 'live_after'}
+    """
+    suggested = []
+    relation = row['relation']
+
+    dead = row.get('dead_after') or 0
+    if dead >= DEAD_MIN and dead >= DEAD_FRACTION * (row.get('live_after') or 0):
+        suggested.append('VACUUM (ANALYZE) {}'.format(relation))
+
+    index_growth = growth(row['indexes_before'], row['indexes_after'])
+    table_growth = growth(row['table_before'], row['table_after']) or 0.0
+    if (
+            index_growth is not None
+            and row['indexes_after'] - row['indexes_before'] >= INDEX_GROWTH_MIN
+            and index_growth >= INDEX_GROWTH_FRACTION
+            and index_growth > table_growth):
+        suggested.append('REINDEX TABLE CONCURRENTLY {}'.format(relation))
+
+    return suggested
+# ==============================================================
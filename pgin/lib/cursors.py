@@ -0,0 +1,188 @@
+import re
+import time
+import hashlib
+import logging
+import functools
+import psycopg2
+import psycopg2.extras
+import psycopg2.extensions
+from pgin.lib import metrics
+from pgin.lib.helpers import get_callee_name
+from pgin.lib.tracing import tracer
+# ==============================================================
+
+WRITE_COMMANDS = {'INSERT', 'UPDATE', 'DELETE', 'MERGE', 'COPY'}
+EXPLAIN_COMMANDS = {'INSERT', 'UPDATE', 'DELETE', 'MERGE', 'WITH'}
+
+FINGERPRINT_SUBS = [
+    (re.compile(r'--[^\n]*'), ' '),
+    (re.compile(r'/\*.*?\*/', re.S), ' '),
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'%(\([^)]*\))?s'), '?'),
+    (re.compile(r'\b\d+(\.\d+)?\b'), '?'),
+    (re.compile(r'\s+'), ' '),
+    (re.compile(r'\(\s*\?(\s*,\s*\?)*\s*\)'), '(?)'),
+]
+# ==============================================================
+
+
+class MeteredConnection(psycopg2.extensions.connection):
+    """
+    Counts opened connections and commits.
+    In a dry run commits are skipped, so whatever runs on the connection
+    stays in one transaction for the caller to roll back.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(MeteredConnection, self).__init__(*args, **kwargs)
+        self.dry_run = False
+        metrics.connections.inc()
+    # _____________________________
+
+    def commit(self):
+        if self.dry_run:
+            return
+
+        super(MeteredConnection, self).commit()
+        metrics.commits.inc()
+# ==============================================================
+
+
+class MeteredCursor(psycopg2.extras.DictCursor):
+    """
+    DictCursor timing every statement, labelled by the function executing it.
+    Rows affected are summed in *rows*.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(MeteredCursor, self).__init__(*args, **kwargs)
+        self.rows = 0
+    # _____________________________
+
+    def execute(self, query, vars=None):
+        return self.timed_execute(get_callee_name(1), query, vars)
+    # _____________________________
+
+    def timed_execute(self, caller, query, vars=None):
+        started = time.perf_counter()
+        try:
+            if not tracer.enabled:
+                return super(MeteredCursor, self).execute(query, vars)
+
+            with tracer.span(caller, 'sql', query=str(query).strip()[:200]):
+                return super(MeteredCursor, self).execute(query, vars)
+        finally:
+            metrics.query_duration.observe(time.perf_counter() - started, query=caller)
+            if self.rowcount > 0 and self.statusmessage and self.statusmessage.split()[0] in WRITE_COMMANDS:
+                self.rows += self.rowcount
+# ==============================================================
+
+
+class StatementCursor(MeteredCursor):
+    """
+    The cursor migrations get. Aggregates every statement by fingerprint:
+    calls, total and max duration, rows.
+
+    With *explain* set, the first execution of every DML fingerprint is
+    preceded by EXPLAIN (ANALYZE, BUFFERS) under a savepoint that is rolled
+    back, so the statement effects happen once, by the real execution.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(StatementCursor, self).__init__(*args, **kwargs)
+        self.explain = False
+        self.statements = {}
+        self.explains = {}
+    # _____________________________
+
+    def execute(self, query, vars=None):
+        key, text = fingerprint(query_text(query, self))
+        if self.explain and key not in self.explains and text.split(' ', 1)[0].upper() in EXPLAIN_COMMANDS:
+            self.explains[key] = self.explain_analyze(query, vars, text)
+
+        started = time.perf_counter()
+        try:
+            return self.timed_execute(get_callee_name(1), query, vars)
+        finally:
+            self.record(key, text, time.perf_counter() - started)
+    # _____________________________
+
+    def record(self, key, text, duration):
+        stat = self.statements.get(key)
+        if stat is None:
+            stat = self.statements[key] = {
+                'fingerprint': key,
+                'query': text[:500],
+                'calls': 0,
+                'total': 0.0,
+                'max': 0.0,
+                'rows': 0,
+            }
+
+        stat['calls'] += 1
+        stat['total'] += duration
+        stat['max'] = max(stat['max'], duration)
+        if self.rowcount > 0:
+            stat['rows'] += self.rowcount
+    # _____________________________
+
+    def explain_analyze(self, query, vars, text):
+        result = {'query': text[:500], 'plan': None, 'error': None}
+        if self.connection.autocommit:
+            result['error'] = 'autocommit connection, no savepoint to roll back to'
+            return result
+
+        # vars are bound into the explained text exactly as into the statement
+        explain = 'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + query_text(query, self)
+        super(StatementCursor, self).execute("""SAVEPOINT pgin_explain""")
+        try:
+            super(StatementCursor, self).execute(explain, vars)
+            result['plan'] = self.fetchone()[0]
+        except psycopg2.Error as e:
+            result['error'] = str(e).strip()
+        finally:
+            super(StatementCursor, self).execute("""ROLLBACK TO SAVEPOINT pgin_explain""")
+            super(StatementCursor, self).execute("""RELEASE SAVEPOINT pgin_explain""")
+
+        if result['plan']:
+            top = result['plan'][0]
+            result['execution_time_ms'] = top.get('Execution Time')
+            result['shared_hit_blocks'] = top['Plan'].get('Shared Hit Blocks')
+            result['shared_read_blocks'] = top['Plan'].get('Shared Read Blocks')
+        logging.getLogger('pgin').debug("Explained %s: %r", text[:200], result.get('execution_time_ms'))
+
+        return result
+    # _____________________________
+
+    def summary(self):
+        """
+        Statements heaviest first, as plain dicts for the change report
+        """
+        return sorted(self.statements.values(), key=lambda s: s['total'], reverse=True)
+# ==============================================================
+
+
+def query_text(query, cursor):
+    if hasattr(query, 'as_string'):
+        return query.as_string(cursor)
+
+    if isinstance(query, bytes):
+        return query.decode('utf-8', 'replace')
+
+    return query
+# _____________________________
+
+
+@functools.lru_cache(maxsize=1024)
+def fingerprint(query):
+    """
+    Statement text with literals and placeholders replaced by ?,
+    and a short hash of it
+    """
+    text = query
+    for pat, repl in FINGERPRINT_SUBS:
+        text = pat.sub(repl, text)
+    text = text.strip()
+
+    return hashlib.md5(text.encode('utf-8')).hexdigest()[:16], text
+# ==============================================================
@@ -0,0 +1,238 @@
+import re
+import time
+import queue
+import logging
+import threading
+from psycopg2.extensions import AsIs
+from pgin.lib.cursors import MeteredCursor
+from pgin.lib.tracing import tracer
+# ==============================================================
+
+# Session settings copied from the migration connection to the build connections
+INHERITED_SETTINGS = ('search_path',)
+
+# CONCURRENTLY waits for every older transaction under lock_timeout as well:
+# a deploy's short one would leave INVALID indexes behind on busy tables
+BUILD_SETTINGS = {'lock_timeout': '0'}
+# ==============================================================
+
+
+class ConcurrentIndexBuilder:
+    """
+    Builds indexes with CREATE INDEX CONCURRENTLY, outside any transaction.
+
+    Indexes of different tables are built at the same time, on up to
+    *parallelism* connections: the migration connection, switched to
+    autocommit for the duration, and extra ones opened with *connect*.
+    Indexes of the same table go one after another, since concurrent
+    builds on one table wait for each other anyway.
+
+    A valid index with the same name is left alone; an INVALID one,
+    left over by a failed build, is dropped concurrently and rebuilt.
+    """
+
+    def __init__(self, conn, connect=None, parallelism=2, settings=None):
+        self.logger = logging.getLogger('pgin')
+        self.conn = conn
+        self.connect = connect
+        self.parallelism = parallelism if connect is not None else 1
+        self.settings = settings or {}
+        self.results = []
+        self.errors = []
+        self.lock = threading.Lock()
+    # _____________________________
+
+    def build(self, indexes):
+        if getattr(self.conn, 'dry_run', False):
+            raise RuntimeError("CREATE INDEX CONCURRENTLY cannot run in a dry run")
+
+        # CONCURRENTLY waits for every older transaction, ours included
+        self.conn.commit()
+        inherited = self.inherited_settings()
+
+        groups = {}
+        for index in indexes:
+            groups.setdefault(index['table'], []).append(index)
+
+        tables = queue.Queue()
+        for group in groups.values():
+            tables.put(group)
+
+        autocommit = self.conn.autocommit
+        self.conn.autocommit = True
+        try:
+            workers = [
+                threading.Thread(
+                    target=self.worker,
+                    args=(tables, inherited, i == 0),
+                    name='pgin-index-%d' % i,
+                    daemon=True
+                )
+                for i in range(min(self.parallelism, len(groups)))
+            ]
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+        finally:
+            self.conn.autocommit = autocommit
+
+        if self.errors:
+            raise self.errors[0]
+
+        return self.results
+    # _____________________________
+
+    def worker(self, tables, inherited, use_main):
+        conn = None
+        cursor = None
+        previous = {}
+        try:
+            if use_main:
+                conn = self.conn
+            else:
+                conn = self.connect()
+                conn.autocommit = True
+            cursor = conn.cursor(cursor_factory=MeteredCursor)
+            previous = self.apply_settings(cursor, inherited)
+
+            while not self.errors:
+                try:
+                    group = tables.get_nowait()
+                except queue.Empty:
+                    return
+
+                for index in group:
+                    self.build_index(cursor, index)
+        except Exception as e:
+            with self.lock:
+                self.errors.append(e)
+        finally:
+            if use_main:
+                self.restore_settings(cursor, previous)
+            elif conn is not None:
+                conn.close()
+    # _____________________________
+
+    def inherited_settings(self):
+        cursor = self.conn.cursor()
+        try:
+            settings = {}
+            for name in INHERITED_SETTINGS:
+                cursor.execute("""SELECT current_setting(%s)""", [name])
+                settings[name] = cursor.fetchone()[0]
+            self.conn.commit()
+            return settings
+        finally:
+            cursor.close()
+    # _____________________________
+
+    def apply_settings(self, cursor, inherited):
+        """
+        Returns the values replaced, for restore_settings()
+        """
+        settings = dict(inherited)
+        settings.update(BUILD_SETTINGS)
+        settings.update((k, v) for k, v in self.settings.items() if v is not None)
+        previous = {}
+        for name, value in settings.items():
+            cursor.execute("""SELECT current_setting(%s)""", [name])
+            previous[name] = cursor.fetchone()[0]
+            cursor.execute("""SELECT set_config(%s, %s, false)""", [name, str(value)])
+        return previous
+    # _____________________________
+
+    def restore_settings(self, cursor, previous):
+        """
+        The migration connection keeps serving the next changes, under its own lock_timeout
+        """
+        if cursor is None or cursor.closed:
+            return
+
+        for name, value in previous.items():
+            cursor.execute("""SELECT set_config(%s, %s, false)""", [name, value])
+    # _____________________________
+
+    def build_index(self, cursor, index):
+        name = index['name']
+        valid = index_validity(cursor, name)
+        result = {'index': name, 'table': index['table'], 'status': None, 'seconds': 0.0}
+
+        if valid:
+            self.logger.info("Index %s exists and is valid, skipping", name)
+            result['status'] = 'exists'
+        else:
+            if valid is False:
+                self.logger.warning("Index %s is INVALID, left by a failed build, rebuilding", name)
+                drop_index_concurrently(cursor, name)
+
+            started = time.perf_counter()
+            with tracer.span('create index {}'.format(name), 'index', table=index['table']):
+                cursor.execute(create_index_statement(index))
+            result['seconds'] = time.perf_counter() - started
+            result['status'] = 'rebuilt' if valid is False else 'created'
+            self.logger.info("Index %s %s in %.1fs", name, result['status'], result['seconds'])
+
+        with self.lock:
+            self.results.append(result)
+# ==============================================================
+
+
+def create_index_statement(index):
+    """
+    CREATE INDEX CONCURRENTLY from a spec:
+    {'name', 'table', 'columns', 'unique', 'method', 'include', 'where'}
+    or {'name', 'table', 'definition'} with a CREATE INDEX statement as
+    pg_get_indexdef() returns it, e.g. to rebuild a dropped index
+    """
+    if index.get('definition'):
+        return re.sub(r'\bINDEX\s+(?!CONCURRENTLY\b)', 'INDEX CONCURRENTLY ', index['definition'], count=1, flags=re.I)
+
+    parts = ['CREATE']
+    if index.get('unique'):
+        parts.append('UNIQUE')
+    parts.append('INDEX CONCURRENTLY %s ON %s' % (index['name'], index['table']))
+    if index.get('method'):
+        parts.append('USING %s' % index['method'])
+    parts.append('(%s)' % index['columns'])
+    if index.get('include'):
+        parts.append('INCLUDE (%s)' % index['include'])
+    if index.get('where'):
+        parts.append('WHERE %s' % index['where'])
+
+    return ' '.join(parts)
+# _____________________________
+
+
+def index_validity(cursor, name):
+    """
+    True or False for an existing index, None if there is none
+    """
+    query = """
+        SELECT i.indisvalid
+        FROM pg_index i
+        WHERE i.indexrelid = to_regclass(%s)
+    """
+    params = [name]
+
+    cursor.execute(query, params)
+    fetch = cursor.fetchone()
+    if fetch is None:
+        return
+
+    return fetch[0]
+# _____________________________
+
+
+def drop_index_concurrently(cursor, name):
+    query = """DROP INDEX CONCURRENTLY IF EXISTS %s"""
+    params = [AsIs(name)]
+
+    with tracer.span('drop index {}'.format(name), 'index'):
+        cursor.execute(query, params)
+# _____________________________
+
+
+def index_name(index):
+    return index if isinstance(index, str) else index['name']
+# ==============================================================
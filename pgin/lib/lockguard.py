@@ -0,0 +1,152 @@
+import time
+import random
+import logging
+import threading
+import psycopg2
+from psycopg2 import errorcodes
+# ==============================================================
+
+RETRYABLE_PGCODES = {
+    errorcodes.LOCK_NOT_AVAILABLE: 'lock timeout',
+    errorcodes.DEADLOCK_DETECTED: 'deadlock',
+    errorcodes.SERIALIZATION_FAILURE: 'serialization failure',
+}
+# ==============================================================
+
+
+class LockWatchdog(threading.Thread):
+    """
+    Cancels the migration backend once it keeps more than *max_blocked*
+    sessions waiting for longer than *max_blocked_ms* milliseconds.
+
+    Uses its own autocommit DBAdmin connection, the same way
+    the progress monitor does.
+    """
+
+    def __init__(self, dba, pid, change, max_blocked, max_blocked_ms, interval=0.5):
+        super(LockWatchdog, self).__init__(name='pgin-watchdog-%s' % change, daemon=True)
+        self.logger = logging.getLogger('pgin')
+        self.dba = dba
+        self.pid = pid
+        self.change = change
+        self.max_blocked = max_blocked
+        self.max_blocked_ms = max_blocked_ms
+        self.interval = interval
+        self.blocking_since = None
+        self.cancelled = None
+        self._stop_event = threading.Event()
+    # _____________________________
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                blocked = self.dba.fetch_blocked_by(self.pid)
+            except psycopg2.Error:
+                self.logger.exception("Lock watchdog failed to inspect backend %s", self.pid)
+                continue
+
+            if len(blocked) <= self.max_blocked:
+                self.blocking_since = None
+                continue
+
+            now = time.time()
+            if self.blocking_since is None:
+                self.blocking_since = now
+
+            blocked_ms = (now - self.blocking_since) * 1000
+            if blocked_ms < self.max_blocked_ms:
+                continue
+
+            self.cancelled = {
+                'event': 'watchdog_cancel',
+                'change': self.change,
+                'pid': self.pid,
+                'ts': now,
+                'blocked': len(blocked),
+                'blocked_ms': blocked_ms,
+                'blocked_pids': [b['pid'] for b in blocked],
+            }
+            self.logger.warning(
+                "Cancelling backend %s of change %s: %d sessions blocked for %.0f ms",
+                self.pid, self.change, len(blocked), blocked_ms, extra={'event': self.cancelled})
+            self.dba.cancel_backend(self.pid)
+            return
+    # _____________________________
+
+    def stop(self):
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+# ==============================================================
+
+
+class LockGuard:
+    """
+    Lock related deploy settings:
+    per-change lock_timeout, retries with jittered backoff and the watchdog limits.
+    """
+
+    def __init__(
+            self,
+            lock_timeout=None,
+            retries=0,
+            backoff_base=0.5,
+            backoff_cap=30.0,
+            max_blocked=None,
+            max_blocked_ms=2000):
+
+        self.lock_timeout = lock_timeout
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.max_blocked = max_blocked
+        self.max_blocked_ms = max_blocked_ms
+    # _____________________________
+
+    def change_lock_timeout(self, change):
+        """
+        A change may override the deploy lock_timeout with its own class attribute
+        """
+        timeout = getattr(change, 'lock_timeout', None)
+        if timeout is None:
+            timeout = self.lock_timeout
+
+        return timeout
+    # _____________________________
+
+    def backoff(self, attempt):
+        """
+        Full jitter exponential backoff, seconds
+        """
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+    # _____________________________
+
+    def retry_reason(self, error, watchdog=None):
+        """
+        Why *error* is worth another attempt, or None if it is not.
+        """
+        pgcode = getattr(error, 'pgcode', None)
+        if pgcode in RETRYABLE_PGCODES:
+            return RETRYABLE_PGCODES[pgcode]
+
+        if pgcode == errorcodes.QUERY_CANCELED and watchdog is not None and watchdog.cancelled:
+            return 'cancelled by lock watchdog'
+
+        return
+    # _____________________________
+
+    def start_watchdog(self, dba, pid, change):
+        if self.max_blocked is None or dba is None:
+            return
+
+        watchdog = LockWatchdog(
+            dba=dba,
+            pid=pid,
+            change=change,
+            max_blocked=self.max_blocked,
+            max_blocked_ms=self.max_blocked_ms
+        )
+        watchdog.start()
+
+        return watchdog
+# ==============================================================
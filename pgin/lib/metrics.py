@@ -0,0 +1,226 @@
+import os
+import math
+import tempfile
+import threading
+# ==============================================================
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600, math.inf)
+# ==============================================================
+
+
+class Metric:
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+    # _____________________________
+
+    def key(self, labels):
+        return tuple(str(labels.get(n, '')) for n in self.labelnames)
+    # _____________________________
+
+    def format_labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ''
+
+        return '{%s}' % ','.join('%s="%s"' % (n, escape_label(v)) for n, v in pairs)
+    # _____________________________
+
+    @property
+    def family(self):
+        """
+        OpenMetrics names a counter family without the _total suffix its samples carry
+        """
+        if self.kind == 'counter' and self.name.endswith('_total'):
+            return self.name[:-len('_total')]
+
+        return self.name
+    # _____________________________
+
+    def header(self):
+        return [
+            '# HELP %s %s' % (self.family, self.documentation),
+            '# TYPE %s %s' % (self.family, self.kind),
+        ]
+# ==============================================================
+
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+    # _____________________________
+
+    def total(self):
+        with self.lock:
+            return sum(self.values.values())
+    # _____________________________
+
+    def samples(self):
+        with self.lock:
+            return ['%s%s %s' % (self.name, self.format_labels(k), format_value(v)) for k, v in self.values.items()]
+# ==============================================================
+
+
+class Gauge(Counter):
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+# ==============================================================
+
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DURATION_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = buckets
+    # _____________________________
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            entry = self.values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry['counts'][i] += 1
+            entry['sum'] += value
+            entry['count'] += 1
+    # _____________________________
+
+    def total(self):
+        """
+        Number of observations over all label sets
+        """
+        with self.lock:
+            return sum(e['count'] for e in self.values.values())
+    # _____________________________
+
+    def samples(self):
+        lines = []
+        with self.lock:
+            for key, entry in self.values.items():
+                for bound, count in zip(self.buckets, entry['counts']):
+                    labels = self.format_labels(key, [('le', format_value(bound))])
+                    lines.append('%s_bucket%s %s' % (self.name, labels, count))
+                lines.append('%s_count%s %s' % (self.name, self.format_labels(key), entry['count']))
+                lines.append('%s_sum%s %s' % (self.name, self.format_labels(key), format_value(entry['sum'])))
+        return lines
+# ==============================================================
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+    # _____________________________
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+    # _____________________________
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+    # _____________________________
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+    # _____________________________
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DURATION_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+    # _____________________________
+
+    def reset(self):
+        for metric in self.metrics:
+            with metric.lock:
+                metric.values.clear()
+    # _____________________________
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            samples = metric.samples()
+            if not samples:
+                continue
+            lines.extend(metric.header())
+            lines.extend(samples)
+
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+    # _____________________________
+
+    def write_textfile(self, path):
+        """
+        Atomic write, so node_exporter's textfile collector never reads half a file
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.pgin-metrics-')
+        try:
+            with os.fdopen(fd, 'w') as fw:
+                fw.write(self.render())
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+# ==============================================================
+
+
+def escape_label(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+# _____________________________
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+
+    if isinstance(value, float) and value.is_integer():
+        return '%d' % value
+
+    return str(value)
+# ==============================================================
+
+
+registry = Registry()
+
+change_duration = registry.histogram(
+    'pgin_change_duration_seconds', 'Time to execute a deploy or revert change', ['direction', 'status'])
+change_last_duration = registry.gauge(
+    'pgin_change_last_duration_seconds', 'Duration of the last execution of a change', ['change', 'direction'])
+change_rows = registry.counter(
+    'pgin_change_rows_total', 'Rows affected by change statements', ['direction'])
+change_wal_bytes = registry.counter(
+    'pgin_change_wal_bytes_total', 'WAL generated while changes ran', ['direction'])
+change_retries = registry.counter(
+    'pgin_change_retries_total', 'Change attempts retried', ['reason'])
+lock_wait = registry.counter(
+    'pgin_lock_wait_seconds_total', 'Time changes were seen waiting on locks', ['direction'])
+changes = registry.counter(
+    'pgin_changes_total', 'Changes executed', ['direction', 'status'])
+commits = registry.counter(
+    'pgin_commits_total', 'Transactions committed by pgin connections')
+connections = registry.counter(
+    'pgin_connections_total', 'Database connections opened')
+query_duration = registry.histogram(
+    'pgin_query_duration_seconds', 'Statement execution time by calling function', ['query'])
+# ==============================================================
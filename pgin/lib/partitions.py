@@ -0,0 +1,319 @@
+import re
+import logging
+import datetime
+import psycopg2
+from psycopg2.extensions import AsIs
+from pgin.lib.cursors import MeteredConnection, MeteredCursor
+from pgin.lib.tracing import tracer
+# ==============================================================
+
+INTERVALS = ('day', 'week', 'month', 'year')
+
+# Suffix of the partitions pgin manages: <parent>_p20240101
+SUFFIX_FORMATS = {
+    'day': '%Y%m%d',
+    'week': '%Y%m%d',
+    'month': '%Y%m',
+    'year': '%Y',
+}
+
+# Spec keys and their defaults; 'parent', 'column' and 'interval' are required
+SPEC_DEFAULTS = {
+    # periods created ahead of the current one
+    'premake': 3,
+    # past periods kept attached; None keeps them all
+    'retain': None,
+    # schema detached partitions are moved to; None drops them
+    'archive_schema': None,
+    # partitions detached per run at most, the oldest first
+    'archive_batch': 2,
+}
+# ==============================================================
+
+
+class PartitionMaintainer:
+    """
+    Keeps a table range-partitioned by time in shape, declared by a spec:
+
+        {'parent': 'events', 'column': 'created', 'interval': 'month',
+         'premake': 3, 'retain': 12, 'archive_schema': 'archive'}
+
+    Future partitions are built as plain tables with a CHECK constraint
+    matching their bounds, so ATTACH PARTITION skips the validation scan
+    and holds SHARE UPDATE EXCLUSIVE on the parent only.
+    Partitions older than *retain* periods are detached with DETACH
+    ... CONCURRENTLY, at most *archive_batch* per run, then moved to
+    *archive_schema* or dropped.
+
+    Only partitions named <parent>_p<period start> are touched. Every run
+    picks up what is missing, so it is safe to repeat, e.g. from cron.
+    """
+
+    def __init__(self, conn, spec, now=None):
+        self.logger = logging.getLogger('pgin')
+        self.conn = conn
+        self.spec = partition_spec(spec)
+        self.parent = self.spec['parent']
+        self.now = now or datetime.datetime.utcnow()
+        self.actions = []
+
+        if '.' in self.parent:
+            self.schema, self.name = self.parent.split('.', 1)
+        else:
+            self.schema, self.name = None, self.parent
+    # _____________________________
+
+    def run(self):
+        if getattr(self.conn, 'dry_run', False):
+            raise RuntimeError("Partition maintenance cannot run in a dry run")
+
+        self.conn.commit()
+        cursor = self.conn.cursor(cursor_factory=MeteredCursor)
+        try:
+            with tracer.span('partitions {}'.format(self.parent), 'partitions'):
+                attached = self.attached(cursor)
+                self.create_future(cursor, attached)
+                self.detach_old(cursor, attached)
+        finally:
+            cursor.close()
+
+        return self.actions
+    # _____________________________
+
+    def qualified(self, name):
+        return name if self.schema is None else '{}.{}'.format(self.schema, name)
+    # _____________________________
+
+    def partition_name(self, start):
+        return '{}_p{}'.format(self.name, start.strftime(SUFFIX_FORMATS[self.spec['interval']]))
+    # _____________________________
+
+    def attached(self, cursor):
+        """
+        {partition name: detach pending} of the partitions attached to the parent
+        """
+        pending = 'i.inhdetachpending' if self.conn.server_version >= 140000 else 'false'
+        query = """
+            SELECT c.relname, %s
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = %s::regclass
+        """
+        params = [AsIs(pending), self.parent]
+
+        cursor.execute(query, params)
+        attached = dict(cursor.fetchall())
+        self.conn.commit()
+        return attached
+    # _____________________________
+
+    def create_future(self, cursor, attached):
+        interval = self.spec['interval']
+        start = period_start(self.now, interval)
+        for _ in range(self.spec['premake'] + 1):
+            end = period_add(start, interval, 1)
+            name = self.partition_name(start)
+            if name not in attached:
+                self.attach(cursor, name, start, end)
+            start = end
+    # _____________________________
+
+    def attach(self, cursor, name, start, end):
+        partition = self.qualified(name)
+        constraint = '{}_bounds'.format(name)[:63]
+        column = self.spec['column']
+        bounds = {
+            'partition': AsIs(partition),
+            'parent': AsIs(self.parent),
+            'constraint': AsIs(constraint),
+            'column': AsIs(column),
+            'start': start.isoformat(),
+            'end': end.isoformat(),
+        }
+
+        try:
+            # a table left by an interrupted run is reused
+            cursor.execute("""SELECT to_regclass(%s) IS NOT NULL""", [partition])
+            if not cursor.fetchone()[0]:
+                cursor.execute(
+                    """
+                    CREATE TABLE %(partition)s
+                    (LIKE %(parent)s INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING STORAGE)
+                    """,
+                    bounds
+                )
+                # lets ATTACH PARTITION prove the bounds instead of scanning
+                cursor.execute(
+                    """
+                    ALTER TABLE %(partition)s ADD CONSTRAINT %(constraint)s
+                    CHECK (%(column)s IS NOT NULL AND %(column)s >= %(start)s AND %(column)s < %(end)s)
+                    """,
+                    bounds
+                )
+            cursor.execute(
+                """ALTER TABLE %(parent)s ATTACH PARTITION %(partition)s FOR VALUES FROM (%(start)s) TO (%(end)s)""",
+                bounds
+            )
+            cursor.execute("""ALTER TABLE %(partition)s DROP CONSTRAINT IF EXISTS %(constraint)s""", bounds)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+        self.logger.info("Attached partition %s for [%s, %s)", partition, start, end)
+        self.actions.append({'parent': self.parent, 'partition': partition, 'action': 'attached'})
+    # _____________________________
+
+    def detach_old(self, cursor, attached):
+        if self.spec['retain'] is None:
+            return
+
+        interval = self.spec['interval']
+        oldest_kept = period_add(period_start(self.now, interval), interval, -self.spec['retain'])
+        pattern = re.compile(r'^{}_p(\d+)$'.format(re.escape(self.name)))
+
+        expired = []
+        for name, pending in attached.items():
+            match = pattern.match(name)
+            if match is None:
+                continue
+            start = datetime.datetime.strptime(match.group(1), SUFFIX_FORMATS[interval]).date()
+            if period_add(start, interval, 1) <= oldest_kept:
+                expired.append((start, name, pending))
+
+        for _, name, pending in sorted(expired)[:self.spec['archive_batch']]:
+            self.detach(cursor, name, pending)
+            self.archive(cursor, name)
+    # _____________________________
+
+    def detach(self, cursor, name, pending):
+        """
+        DETACH ... CONCURRENTLY runs outside a transaction block, in two
+        transactions waiting out the queries using the partition.
+        One interrupted half way is left pending and gets finalized.
+        """
+        partition = self.qualified(name)
+        params = [AsIs(self.parent), AsIs(partition)]
+
+        autocommit = self.conn.autocommit
+        self.conn.autocommit = True
+        try:
+            if pending:
+                cursor.execute("""ALTER TABLE %s DETACH PARTITION %s FINALIZE""", params)
+            elif self.conn.server_version >= 140000 and not self.has_default(cursor):
+                cursor.execute("""ALTER TABLE %s DETACH PARTITION %s CONCURRENTLY""", params)
+            else:
+                self.logger.warning("DETACH CONCURRENTLY unavailable for %s, detaching under lock", self.parent)
+                cursor.execute("""ALTER TABLE %s DETACH PARTITION %s""", params)
+        finally:
+            self.conn.autocommit = autocommit
+
+        self.logger.info("Detached partition %s", partition)
+    # _____________________________
+
+    def has_default(self, cursor):
+        query = """
+            SELECT EXISTS (
+                SELECT 1
+                FROM pg_partitioned_table
+                WHERE partrelid = %s::regclass
+                AND partdefid <> 0
+            )
+        """
+        cursor.execute(query, [self.parent])
+        return cursor.fetchone()[0]
+    # _____________________________
+
+    def archive(self, cursor, name):
+        partition = self.qualified(name)
+        archive_schema = self.spec['archive_schema']
+
+        try:
+            if archive_schema is None:
+                cursor.execute("""DROP TABLE %s""", [AsIs(partition)])
+                action = 'dropped'
+            else:
+                cursor.execute("""CREATE SCHEMA IF NOT EXISTS %s""", [AsIs(archive_schema)])
+                cursor.execute("""ALTER TABLE %s SET SCHEMA %s""", [AsIs(partition), AsIs(archive_schema)])
+                action = 'archived'
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+        self.logger.info("Partition %s %s", partition, action)
+        self.actions.append({'parent': self.parent, 'partition': partition, 'action': action})
+# ==============================================================
+
+
+def partition_spec(spec):
+    """
+    The spec with defaults filled in, checked
+    """
+    for key in ('parent', 'column', 'interval'):
+        if key not in spec:
+            raise ValueError("Partition spec needs '{}': {}".format(key, spec))
+
+    unknown = set(spec) - set(SPEC_DEFAULTS) - {'parent', 'column', 'interval'}
+    if unknown:
+        raise ValueError("Unknown partition spec keys: {}".format(', '.join(sorted(unknown))))
+
+    if spec['interval'] not in INTERVALS:
+        raise ValueError("Partition interval has to be one of {}".format(', '.join(INTERVALS)))
+
+    full = dict(SPEC_DEFAULTS)
+    full.update(spec)
+    return full
+# _____________________________
+
+
+def period_start(moment, interval):
+    day = moment.date() if isinstance(moment, datetime.datetime) else moment
+    if interval == 'day':
+        return day
+    if interval == 'week':
+        return day - datetime.timedelta(days=day.weekday())
+    if interval == 'month':
+        return day.replace(day=1)
+
+    return day.replace(month=1, day=1)
+# _____________________________
+
+
+def period_add(start, interval, count):
+    if interval == 'day':
+        return start + datetime.timedelta(days=count)
+    if interval == 'week':
+        return start + datetime.timedelta(weeks=count)
+    if interval == 'year':
+        return start.replace(year=start.year + count)
+
+    months = start.year * 12 + start.month - 1 + count
+    return start.replace(year=months // 12, month=months % 12 + 1)
+# _____________________________
+
+
+def maintain_partitions(dsn, partitions, now=None, lock_timeout='5s'):
+    """
+    Runs the maintenance of *partitions* specs on its own connection,
+    for cron and other callers outside pgin deploy, e.g.
+
+        from pgin.lib.partitions import maintain_partitions
+        from migrations.deploy.events_partitions import Events_partitions
+        maintain_partitions('dbname=app', Events_partitions.partitions)
+
+    Returns the actions taken.
+    """
+    conn = psycopg2.connect(dsn, connection_factory=MeteredConnection)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""SET lock_timeout = %s""", [lock_timeout])
+        conn.commit()
+
+        actions = []
+        for spec in partitions:
+            actions.extend(PartitionMaintainer(conn, spec, now).run())
+        return actions
+    finally:
+        conn.close()
+# ==============================================================
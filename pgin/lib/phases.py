@@ -0,0 +1,121 @@
+EXPAND = 'expand'
+CONTRACT = 'contract'
+PHASES = (EXPAND, CONTRACT)
+# ==============================================================
+
+
+def change_phases(change):
+    """
+    Phases a loaded deploy/revert object is split into, empty for a plain one
+    """
+    phases = getattr(change, 'phases', None) or ()
+    for phase in phases:
+        if phase not in PHASES:
+            raise ValueError("Unknown phase {!r} in {}".format(phase, type(change).__name__))
+
+    return tuple(phases)
+# _____________________________
+
+
+def phases_to_deploy(phases, phase, done):
+    """
+    What a deploy limited to *phase* (None: all of them) runs of a change
+    split into *phases*, given the phases already *done*.
+    [None] stands for a plain change run as a whole.
+
+    A plain change goes with the expand phase: whatever is not split
+    has to be safe for the old and the new application version alike.
+    """
+    if not phases:
+        return [None] if phase in (None, EXPAND) else []
+
+    todo = [p for p in phases if p not in done]
+    if phase is None:
+        return todo
+
+    # contract only after expand, in an earlier deploy or this one
+    if phase == CONTRACT and EXPAND in phases and EXPAND not in done:
+        return []
+
+    return [p for p in todo if p == phase]
+# _____________________________
+
+
+def sync_trigger_name(table, old, new):
+    return 'pgin_sync_{}_{}_{}'.format(table.replace('.', '_'), old, new)[:63]
+# _____________________________
+
+
+def dual_write_trigger_sql(table, old, new, forward=None, backward=None):
+    """
+    A BEFORE INSERT OR UPDATE trigger keeping column *old* and its replacement *new*
+    in step while old and new application versions write the table side by side.
+
+    *forward* computes new from NEW.<old>, *backward* old from NEW.<new>;
+    both default to a plain copy.
+    """
+    name = sync_trigger_name(table, old, new)
+    forward = forward or 'NEW.{}'.format(old)
+    backward = backward or 'NEW.{}'.format(new)
+
+    return """
+        CREATE OR REPLACE FUNCTION {name}() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                IF NEW.{new} IS NULL THEN
+                    NEW.{new} := {forward};
+                ELSIF NEW.{old} IS NULL THEN
+                    NEW.{old} := {backward};
+                END IF;
+            ELSIF NEW.{old} IS DISTINCT FROM OLD.{old} THEN
+                NEW.{new} := {forward};
+            ELSIF NEW.{new} IS DISTINCT FROM OLD.{new} THEN
+                NEW.{old} := {backward};
+            END IF;
+            RETURN NEW;
+        END
+        $$;
+
+        DROP TRIGGER IF EXISTS {name} ON {table};
+        CREATE TRIGGER {name}
+            BEFORE INSERT OR UPDATE ON {table}
+            FOR EACH ROW EXECUTE PROCEDURE {name}();
+    """.format(name=name, table=table, old=old, new=new, forward=forward, backward=backward)
+# _____________________________
+
+
+def drop_dual_write_trigger_sql(table, old, new):
+    name = sync_trigger_name(table, old, new)
+
+    return """
+        DROP TRIGGER IF EXISTS {name} ON {table};
+        DROP FUNCTION IF EXISTS {name}();
+    """.format(name=name, table=table)
+# _____________________________
+
+
+def backfill_sql(table, assignments, where, key='id', batch_size=10000, skip_locked=True):
+    """
+    One batch of a backfill, for Basemigration.run_batched.
+    SKIP LOCKED leaves rows the application is writing right now to a later batch.
+    """
+    return """
+        UPDATE {table}
+        SET {assignments}
+        WHERE {key} IN (
+            SELECT {key}
+            FROM {table}
+            WHERE {where}
+            LIMIT {batch_size}
+            FOR UPDATE{skip_locked}
+        )
+    """.format(
+        table=table,
+        assignments=assignments,
+        where=where,
+        key=key,
+        batch_size=int(batch_size),
+        skip_locked=' SKIP LOCKED' if skip_locked else ''
+    )
+# ==============================================================
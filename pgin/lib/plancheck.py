@@ -0,0 +1,169 @@
+import os
+import json
+import logging
+import psycopg2
+import toml
+from pgin.lib.cursors import MeteredCursor
+# ==============================================================
+
+# Total cost growing more than this many times over is a regression
+COST_THRESHOLD = 2.0
+
+INDEX_SCANS = {'Index Scan', 'Index Only Scan', 'Bitmap Index Scan', 'Bitmap Heap Scan'}
+# ==============================================================
+
+
+def load_registry(path):
+    """
+    Critical application queries, from a TOML file in the migration home:
+
+        [queries.orders_of_customer]
+        sql = "SELECT * FROM orders WHERE customer_id = %s ORDER BY created DESC LIMIT 20"
+        params = [42]
+        # optional, overrides the cost threshold for this query
+        cost_threshold = 1.5
+
+    Returns [] when there is no file.
+    """
+    if not os.path.exists(path):
+        return []
+
+    with open(path) as fp:
+        registry = toml.load(fp)
+
+    queries = []
+    for name, query in sorted(registry.get('queries', {}).items()):
+        if 'sql' not in query:
+            raise ValueError("Query '{}' in {} has no sql".format(name, path))
+        queries.append({
+            'name': name,
+            'sql': query['sql'],
+            'params': query.get('params'),
+            'cost_threshold': query.get('cost_threshold'),
+        })
+
+    return queries
+# _____________________________
+
+
+def capture_plans(conn, queries):
+    """
+    {query name: top plan node of EXPLAIN (FORMAT JSON), or {'error': message}}.
+    The queries are only planned, each in a savepoint rolled back afterwards,
+    so capturing inside an open transaction, e.g. a dry run deploy, leaves it intact.
+    """
+    logger = logging.getLogger('pgin')
+    cursor = conn.cursor(cursor_factory=MeteredCursor)
+    plans = {}
+    try:
+        for query in queries:
+            cursor.execute("""SAVEPOINT pgin_plancheck""")
+            try:
+                cursor.execute('EXPLAIN (FORMAT JSON) ' + query['sql'], query['params'])
+                plan = cursor.fetchone()[0]
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                plans[query['name']] = plan[0]['Plan']
+            except psycopg2.Error as e:
+                logger.warning("Cannot plan query %s: %s", query['name'], e)
+                plans[query['name']] = {'error': str(e).strip()}
+            cursor.execute("""ROLLBACK TO SAVEPOINT pgin_plancheck""")
+    finally:
+        cursor.close()
+
+    return plans
+# _____________________________
+
+
+def plan_nodes(plan):
+    """
+    Nodes of a plan tree, depth first
+    """
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from plan_nodes(child)
+# _____________________________
+
+
+def plan_shape(plan):
+    return [(n['Node Type'], n.get('Relation Name'), n.get('Index Name')) for n in plan_nodes(plan)]
+# _____________________________
+
+
+def index_scans(plan):
+    """
+    {relation: set of indexes} scanned through an index
+    """
+    scans = {}
+    for node in plan_nodes(plan):
+        relation = node.get('Relation Name')
+        if node['Node Type'] not in INDEX_SCANS or relation is None:
+            continue
+
+        if node['Node Type'] == 'Bitmap Heap Scan':
+            # the indexes are named by the Bitmap Index Scans below
+            indexes = {n.get('Index Name') for n in plan_nodes(node) if n['Node Type'] == 'Bitmap Index Scan'}
+        else:
+            indexes = {node.get('Index Name')}
+        scans.setdefault(relation, set()).update(indexes)
+
+    return scans
+# _____________________________
+
+
+def seq_scanned(plan):
+    return {n.get('Relation Name') for n in plan_nodes(plan) if n['Node Type'] == 'Seq Scan'}
+# _____________________________
+
+
+def compare_plans(queries, before, after, cost_threshold=COST_THRESHOLD):
+    """
+    One finding per query: status 'ok', 'changed' (a different plan shape,
+    no regression), 'regressed' or 'error', and what was found.
+    Regressions: a relation read through an index before is sequentially
+    scanned after; the total cost grew more than *cost_threshold* times;
+    a query plannable before fails after.
+    """
+    findings = []
+    for query in queries:
+        name = query['name']
+        old, new = before.get(name), after.get(name)
+        threshold = query.get('cost_threshold') or cost_threshold
+        finding = {'query': name, 'status': 'ok', 'notes': [], 'cost_before': None, 'cost_after': None}
+        findings.append(finding)
+
+        if new is None or 'error' in new:
+            if old is not None and 'error' not in old:
+                finding['status'] = 'regressed'
+                finding['notes'].append('fails after deploy: {}'.format((new or {}).get('error')))
+            elif new is not None:
+                finding['status'] = 'error'
+                finding['notes'].append(new['error'])
+            continue
+
+        finding['cost_after'] = new['Total Cost']
+        if old is None or 'error' in old:
+            finding['notes'].append('no plan before deploy')
+            continue
+
+        finding['cost_before'] = old['Total Cost']
+        regressions = []
+
+        new_seq = seq_scanned(new)
+        for relation, indexes in sorted(index_scans(old).items()):
+            if relation in new_seq:
+                regressions.append('lost index scan on {} ({})'.format(relation, ', '.join(sorted(indexes))))
+
+        if old['Total Cost'] > 0 and new['Total Cost'] > old['Total Cost'] * threshold:
+            regressions.append('cost x{:.1f} ({:.0f} -> {:.0f})'.format(
+                new['Total Cost'] / old['Total Cost'], old['Total Cost'], new['Total Cost']))
+
+        if regressions:
+            finding['status'] = 'regressed'
+            finding['notes'].extend(regressions)
+        elif plan_shape(old) != plan_shape(new):
+            finding['status'] = 'changed'
+            finding['notes'].append('plan shape changed')
+
+    return findings
+# ==============================================================
@@ -0,0 +1,168 @@
+import re
+import inspect
+# ==============================================================
+
+# Weakest to strongest
+LOCK_MODES = [
+    'ACCESS SHARE',
+    'ROW SHARE',
+    'ROW EXCLUSIVE',
+    'SHARE UPDATE EXCLUSIVE',
+    'SHARE',
+    'SHARE ROW EXCLUSIVE',
+    'EXCLUSIVE',
+    'ACCESS EXCLUSIVE',
+]
+
+# Lock modes, as named in pg_locks, conflicting with each LOCK TABLE mode
+CONFLICTS = {
+    'ACCESS SHARE': ['AccessExclusiveLock'],
+    'ROW SHARE': ['ExclusiveLock', 'AccessExclusiveLock'],
+    'ROW EXCLUSIVE': ['ShareLock', 'ShareRowExclusiveLock', 'ExclusiveLock', 'AccessExclusiveLock'],
+    'SHARE UPDATE EXCLUSIVE': [
+        'ShareUpdateExclusiveLock', 'ShareLock', 'ShareRowExclusiveLock', 'ExclusiveLock', 'AccessExclusiveLock'],
+    'SHARE': [
+        'RowExclusiveLock', 'ShareUpdateExclusiveLock', 'ShareRowExclusiveLock', 'ExclusiveLock',
+        'AccessExclusiveLock'],
+    'SHARE ROW EXCLUSIVE': [
+        'RowExclusiveLock', 'ShareUpdateExclusiveLock', 'ShareLock', 'ShareRowExclusiveLock', 'ExclusiveLock',
+        'AccessExclusiveLock'],
+    'EXCLUSIVE': [
+        'RowShareLock', 'RowExclusiveLock', 'ShareUpdateExclusiveLock', 'ShareLock', 'ShareRowExclusiveLock',
+        'ExclusiveLock', 'AccessExclusiveLock'],
+    'ACCESS EXCLUSIVE': [
+        'AccessShareLock', 'RowShareLock', 'RowExclusiveLock', 'ShareUpdateExclusiveLock', 'ShareLock',
+        'ShareRowExclusiveLock', 'ExclusiveLock', 'AccessExclusiveLock'],
+}
+
+RELATION = r'((?:"[^"]+"|[\w$]+)(?:\.(?:"[^"]+"|[\w$]+))?)'
+
+# Statement patterns and the lock mode they take on the captured relation.
+# Conservative: ALTER TABLE is assumed to take ACCESS EXCLUSIVE whatever the subcommand.
+STATEMENT_LOCKS = [
+    (re.compile(r'\bALTER\s+TABLE\s+(?:IF\s+EXISTS\s+)?(?:ONLY\s+)?' + RELATION, re.I), 'ACCESS EXCLUSIVE'),
+    (re.compile(r'\bDROP\s+TABLE\s+(?:IF\s+EXISTS\s+)?' + RELATION, re.I), 'ACCESS EXCLUSIVE'),
+    (re.compile(r'\bTRUNCATE\s+(?:TABLE\s+)?(?:ONLY\s+)?' + RELATION, re.I), 'ACCESS EXCLUSIVE'),
+    (re.compile(r'\bCLUSTER\s+' + RELATION, re.I), 'ACCESS EXCLUSIVE'),
+    (re.compile(r'\bCREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\b[^;]*?\bON\s+(?:ONLY\s+)?' + RELATION, re.I),
+        'SHARE UPDATE EXCLUSIVE'),
+    (re.compile(r'\bCREATE\s+(?:UNIQUE\s+)?INDEX\s+(?!CONCURRENTLY)[^;]*?\bON\s+(?:ONLY\s+)?' + RELATION, re.I),
+        'SHARE'),
+    (re.compile(r'\bCREATE\s+(?:OR\s+REPLACE\s+)?TRIGGER\b[^;]*?\bON\s+' + RELATION, re.I), 'SHARE ROW EXCLUSIVE'),
+    (re.compile(r'\bREFERENCES\s+' + RELATION, re.I), 'SHARE ROW EXCLUSIVE'),
+    (re.compile(r'\b(?:VACUUM|ANALYZE)\s+(?:\([^)]*\)\s+)?' + RELATION, re.I), 'SHARE UPDATE EXCLUSIVE'),
+    (re.compile(r'\bINSERT\s+INTO\s+' + RELATION, re.I), 'ROW EXCLUSIVE'),
+    (re.compile(r'\bUPDATE\s+(?:ONLY\s+)?' + RELATION + r'\s+SET\b', re.I), 'ROW EXCLUSIVE'),
+    (re.compile(r'\bDELETE\s+FROM\s+(?:ONLY\s+)?' + RELATION, re.I), 'ROW EXCLUSIVE'),
+]
+
+LOCK_TABLE_PAT = re.compile(
+    r'\bLOCK\s+(?:TABLE\s+)?(?:ONLY\s+)?' + RELATION + r'\s+IN\s+([A-Z ]+?)\s+MODE\b', re.I)
+
+KEYWORDS = {'if', 'only', 'table', 'concurrently', 'set', 'select', 'on'}
+# ==============================================================
+
+
+def stronger_mode(mode1, mode2):
+    if mode1 is None:
+        return mode2
+
+    return max(mode1, mode2, key=LOCK_MODES.index)
+# _____________________________
+
+
+def infer_relations(sql):
+    """
+    Relations referenced by *sql* and the strongest lock mode each one needs
+    """
+    relations = {}
+
+    for pat, mode in STATEMENT_LOCKS:
+        for match in pat.finditer(sql):
+            relation = match.group(1)
+            if relation.lower() in KEYWORDS:
+                continue
+            relations[relation] = stronger_mode(relations.get(relation), mode)
+
+    for match in LOCK_TABLE_PAT.finditer(sql):
+        relation = match.group(1)
+        mode = ' '.join(match.group(2).upper().split())
+        if mode in LOCK_MODES:
+            relations[relation] = stronger_mode(relations.get(relation), mode)
+
+    return relations
+# _____________________________
+
+
+def change_relations(change):
+    """
+    Relations a loaded deploy/revert object is going to lock.
+
+    A migration may declare them with a *relations* class attribute,
+    either a {relation: lock mode} dict or a list locked in ACCESS EXCLUSIVE mode.
+    Otherwise they are inferred from the SQL in the migration class source.
+    """
+    declared = getattr(change, 'relations', None)
+    if declared is not None:
+        if not isinstance(declared, dict):
+            return {r: 'ACCESS EXCLUSIVE' for r in declared}
+
+        relations = {r: ' '.join(m.upper().split()) for r, m in declared.items()}
+        for relation, mode in relations.items():
+            if mode not in LOCK_MODES:
+                raise ValueError("Unknown lock mode {!r} declared for {}".format(mode, relation))
+        return relations
+
+    # built or dropped concurrently
+    indexes = list(getattr(change, 'drop_indexes', None) or [])
+    if getattr(change, 'direction', None) != 'revert':
+        indexes += getattr(change, 'indexes', None) or []
+    if indexes:
+        return {i['table']: 'SHARE UPDATE EXCLUSIVE' for i in indexes}
+
+    try:
+        source = inspect.getsource(type(change))
+    except (OSError, TypeError):
+        return {}
+
+    return infer_relations(source)
+# _____________________________
+
+
+def probe_relations(dba, relations):
+    """
+    Tries to take every lock with NOWAIT inside a throwaway transaction.
+    Returns one result per relation with the sessions holding
+    or queued for conflicting locks.
+    """
+    results = []
+
+    try:
+        for relation, mode in sorted(relations.items()):
+            result = {
+                'relation': relation,
+                'mode': mode,
+                'status': 'ok',
+                'holders': [],
+            }
+            results.append(result)
+
+            if not dba.relation_exists(relation):
+                result['status'] = 'missing'
+                continue
+
+            if dba.try_lock_relation(relation, mode):
+                continue
+
+            result['status'] = 'conflict'
+            result['holders'] = dba.fetch_relation_lock_holders(relation, CONFLICTS[mode])
+    finally:
+        dba.conn.rollback()
+
+    return results
+# _____________________________
+
+
+def is_clear(results):
+    return all(r['status'] != 'conflict' for r in results)
+# ==============================================================
@@ -0,0 +1,151 @@
+import os
+import time
+import logging
+import functools
+import psycopg2
+from psycopg2.extensions import make_dsn
+# ==============================================================
+
+# libpq connection parameters a profile may set
+PARAMS = (
+    'host', 'hostaddr', 'port', 'service', 'passfile', 'sslmode', 'sslrootcert',
+    'connect_timeout', 'keepalives', 'keepalives_idle', 'keepalives_interval', 'keepalives_count',
+    'tcp_user_timeout', 'application_name', 'target_session_attrs', 'options',
+)
+
+DEFAULTS = {
+    'host': 'localhost',
+    'port': 5432,
+    'connect_timeout': 10,
+    'keepalives': 1,
+    'keepalives_idle': 30,
+    'keepalives_interval': 10,
+    'keepalives_count': 5,
+    'application_name': 'pgin',
+}
+
+RECONNECT_ATTEMPTS = 3
+RECONNECT_BACKOFF = 1.0
+
+# PGIN_DB_HOST, PGIN_DB_SOCKET_DIR, PGIN_DB_RECONNECT_ATTEMPTS, ...
+ENV_PREFIX = 'PGIN_DB_'
+ENV_KEYS = PARAMS + ('socket_dir', 'reconnect_attempts', 'reconnect_backoff')
+
+# Let libpq environment variables win over the host/port defaults
+LIBPQ_ENV = ('PGHOST', 'PGHOSTADDR', 'PGPORT', 'PGSERVICE')
+# ==============================================================
+
+
+class ConnectionProfile:
+    """
+    How pgin connects: libpq parameters plus the reconnect policy
+    used when a connection drops in the middle of a command.
+    """
+
+    def __init__(self, name='default', params=None, reconnect_attempts=RECONNECT_ATTEMPTS,
+                 reconnect_backoff=RECONNECT_BACKOFF):
+        self.name = name
+        self.params = dict(DEFAULTS if params is None else params)
+        self.reconnect_attempts = int(reconnect_attempts)
+        self.reconnect_backoff = float(reconnect_backoff)
+    # _____________________________
+
+    def dsn(self, dbname, user):
+        return make_dsn(dbname=dbname, user=user, **self.params)
+    # _____________________________
+
+    def __repr__(self):
+        return '<ConnectionProfile {} {}>'.format(self.name, self.params)
+# ==============================================================
+
+
+def load_profile(conf=None, name='default', use_env=True):
+    """
+    Profiles live in pgin.conf under [connections.<name>], e.g.
+
+        [connections.default]
+        socket_dir = "/var/run/postgresql"
+        keepalives_idle = 60
+        reconnect_attempts = 5
+
+        [connections.read]
+        host = "standby1,standby2"
+        target_session_attrs = "prefer-standby"
+
+    A named profile extends [connections.default]. With *use_env*,
+    PGIN_DB_<KEY> environment variables override the file.
+    *socket_dir* connects over the Unix-domain socket in that directory;
+    *service* reads host, port and the rest from pg_service.conf.
+    """
+    sections = (conf or {}).get('connections', {})
+    if name != 'default' and name not in sections:
+        raise ValueError("No connection profile '{}' in pgin.conf".format(name))
+
+    layers = [sections.get(section, {}) for section in ['default', name]]
+
+    if use_env:
+        env = {}
+        for key in ENV_KEYS:
+            value = os.environ.get(ENV_PREFIX + key.upper())
+            if value is not None:
+                env[key] = value
+        layers.append(env)
+
+    settings = {}
+    for layer in layers:
+        unknown = set(layer) - set(ENV_KEYS)
+        if unknown:
+            raise ValueError("Unknown keys in connection profile '{}': {}".format(name, ', '.join(sorted(unknown))))
+
+        # a host or socket_dir of a later layer replaces either one of an earlier layer
+        layer = dict(layer)
+        if 'socket_dir' in layer:
+            layer['host'] = layer.pop('socket_dir')
+        settings.update(layer)
+
+    params = dict(DEFAULTS)
+    if 'service' in settings or any(os.environ.get(v) for v in LIBPQ_ENV):
+        del params['host']
+        del params['port']
+
+    params.update((k, v) for k, v in settings.items() if k in PARAMS)
+
+    return ConnectionProfile(
+        name,
+        params,
+        settings.get('reconnect_attempts', RECONNECT_ATTEMPTS),
+        settings.get('reconnect_backoff', RECONNECT_BACKOFF),
+    )
+# ==============================================================
+
+
+def connection_lost(conn):
+    return conn is not None and conn.closed != 0
+# ==============================================================
+
+
+def reconnecting(method):
+    """
+    Decorator for idempotent DBAdmin methods: when the connection
+    turns out to be broken, reconnects and runs the method again.
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return method(self, *args, **kwargs)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                if not connection_lost(self.conn) or attempt >= self.profile.reconnect_attempts:
+                    raise
+
+                attempt += 1
+                logging.getLogger('pgin').warning(
+                    "Connection lost in %s, reconnecting (%d/%d)",
+                    method.__name__, attempt, self.profile.reconnect_attempts)
+                time.sleep(self.profile.reconnect_backoff * (attempt - 1))
+                self.reconnect()
+
+    return wrapper
+# ==============================================================
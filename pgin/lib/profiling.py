@@ -0,0 +1,117 @@
+import os
+import sys
+import time
+import pstats
+import cProfile
+import resource
+import tracemalloc
+import contextlib
+from pgin.lib.helpers import create_directory
+# ==============================================================
+
+# CPU time of the profiled thread only, so the monitor threads do not count
+CPU_TIMER = getattr(time, 'thread_time', time.process_time)
+MB = 1024 * 1024
+# ==============================================================
+
+
+def peak_rss():
+    """
+    Process high-water mark of resident memory, bytes
+    """
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return maxrss
+
+    return maxrss * 1024
+# ==============================================================
+
+
+class ChangeProfiler:
+    """
+    Runs a change under cProfile and, optionally, tracemalloc.
+    Writes <direction>.<change>.pstats into *outdir* and puts
+    CPU time, peak RSS and top allocation sites into the change report.
+    """
+
+    def __init__(self, outdir, memory=False, top=10):
+        self.outdir = outdir
+        self.memory = memory
+        self.top = top
+        self.profiles = []
+        create_directory(outdir)
+    # _____________________________
+
+    @contextlib.contextmanager
+    def profile(self, report):
+        profiler = cProfile.Profile(CPU_TIMER)
+        rss_before = peak_rss()
+        if self.memory:
+            tracemalloc.start()
+
+        wall_start = time.perf_counter()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            wall = time.perf_counter() - wall_start
+            result = self.collect(report, profiler, wall, rss_before)
+            report.data['profile'] = result
+            self.profiles.append(result)
+    # _____________________________
+
+    def collect(self, report, profiler, wall, rss_before):
+        path = os.path.join(self.outdir, '{}.{}.pstats'.format(report.direction, report.name))
+        profiler.dump_stats(path)
+        stats = pstats.Stats(profiler)
+        rss = peak_rss()
+
+        result = {
+            'change': report.name,
+            'direction': report.direction,
+            'pstats': path,
+            'cpu': stats.total_tt,
+            'wall': wall,
+            'peak_rss': rss,
+            'rss_growth': rss - rss_before,
+            'traced_peak': None,
+            'top_allocations': [],
+        }
+
+        if self.memory:
+            result['traced_peak'] = tracemalloc.get_traced_memory()[1]
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            result['top_allocations'] = [
+                {'site': str(stat.traceback), 'size': stat.size, 'count': stat.count}
+                for stat in snapshot.statistics('lineno')[:self.top]
+            ]
+
+        return result
+    # _____________________________
+
+    def summary(self):
+        """
+        Rows for the summary table, heaviest Python CPU first
+        """
+        rows = []
+        for p in sorted(self.profiles, key=lambda p: (p['cpu'], p['peak_rss']), reverse=True):
+            rows.append((
+                p['change'],
+                p['cpu'],
+                p['wall'],
+                p['peak_rss'] / MB,
+                p['rss_growth'] / MB,
+                p['traced_peak'] / MB if p['traced_peak'] is not None else None,
+                p['top_allocations'][0]['site'] if p['top_allocations'] else None,
+            ))
+
+        return rows
+# ==============================================================
+
+
+SUMMARY_HEADERS = [
+    'Change', 'Python CPU (s)', 'Wall (s)', 'Peak RSS (MB)', 'RSS Growth (MB)', 'Traced Peak (MB)', 'Top Allocation'
+]
+# ==============================================================
@@ -0,0 +1,132 @@
+import time
+import logging
+import datetime
+import threading
+import psycopg2
+# ==============================================================
+
+
+class ProgressMonitor(threading.Thread):
+    """
+    Polls the progress views for the backend running a change
+    and turns every sample into a structured progress event.
+
+    The monitor uses its own DBAdmin connection, which has to be
+    in autocommit mode: statistics views are snapshotted per transaction.
+    """
+
+    def __init__(self, dba, pid, change, interval=2.0, on_event=None):
+        super(ProgressMonitor, self).__init__(name='pgin-progress-%s' % change, daemon=True)
+        self.logger = logging.getLogger('pgin')
+        self.dba = dba
+        self.pid = pid
+        self.change = change
+        self.interval = interval
+        self.on_event = on_event
+        self.started = None
+        self.last_sample = None
+        self.events = []
+        self._stop_event = threading.Event()
+    # _____________________________
+
+    def run(self):
+        self.started = time.time()
+        while not self._stop_event.wait(self.interval):
+            try:
+                sample = self.dba.fetch_backend_progress(self.pid)
+            except psycopg2.Error:
+                self.logger.exception("Progress monitor failed to sample backend %s", self.pid)
+                continue
+
+            if sample is None:
+                continue
+
+            event = self.make_event(sample, time.time())
+            self.events.append(event)
+            self.logger.debug("Progress: %r", event, extra={'event': event})
+
+            if self.on_event is not None:
+                self.on_event(event)
+    # _____________________________
+
+    def stop(self):
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+    # _____________________________
+
+    def make_event(self, sample, now):
+        event = {
+            'event': 'progress',
+            'change': self.change,
+            'pid': self.pid,
+            'ts': now,
+            'elapsed': now - self.started,
+            'state': sample['state'],
+            'wait_event_type': sample['wait_event_type'],
+            'wait_event': sample['wait_event'],
+            'command': sample['command'],
+            'phase': sample['phase'],
+            'relation': sample['relation'],
+            'unit': sample['unit'],
+            'done': sample['units_done'],
+            'total': sample['units_total'],
+            'percent': None,
+            'rate': None,
+            'eta': None,
+        }
+
+        done = event['done']
+        total = event['total']
+        if done is not None and total:
+            event['percent'] = 100.0 * done / total
+
+        prev = self.last_sample
+        if prev is not None and done is not None and prev['done'] is not None \
+                and prev['command'] == event['command'] and prev['phase'] == event['phase']:
+            elapsed = now - prev['ts']
+            if elapsed > 0 and done >= prev['done']:
+                event['rate'] = (done - prev['done']) / elapsed
+
+        if event['rate'] and total:
+            event['eta'] = (total - done) / event['rate']
+
+        self.last_sample = event
+        return event
+# ==============================================================
+
+
+def format_seconds(seconds):
+    if seconds is None:
+        return '?'
+
+    return str(datetime.timedelta(seconds=int(seconds)))
+# _____________________________
+
+
+def render_progress(event):
+    """
+    One console line out of a progress event
+    """
+
+    elapsed = format_seconds(event['elapsed'])
+
+    if event['command'] is None:
+        line = "    {} running, state: {}".format(elapsed, event['state'])
+        if event['wait_event']:
+            line += ", waiting on {}:{}".format(event['wait_event_type'], event['wait_event'])
+        return line
+
+    line = "    {} {}".format(elapsed, event['command'])
+    if event['relation']:
+        line += " {}".format(event['relation'])
+    line += ": {}".format(event['phase'])
+
+    if event['percent'] is not None:
+        line += " {:.1f}%".format(event['percent'])
+
+    if event['rate'] is not None:
+        line += " ({:.0f} {}/s, ETA {})".format(event['rate'], event['unit'], format_seconds(event['eta']))
+
+    return line
+# ==============================================================
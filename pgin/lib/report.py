@@ -0,0 +1,65 @@
+import time
+import datetime
+# ==============================================================
+
+
+class ChangeReport:
+    """
+    Collects what happened while a single change was executed.
+    Every event is a plain dict, so the report can be dumped as JSON as is.
+    """
+
+    def __init__(self, name, direction, changeid=None):
+        self.name = name
+        self.direction = direction
+        self.changeid = changeid
+        self.status = None
+        self.started = None
+        self.finished = None
+        self.events = []
+        self.data = {}
+    # _____________________________
+
+    def start(self):
+        self.started = time.time()
+    # _____________________________
+
+    def finish(self, status):
+        self.finished = time.time()
+        self.status = status
+    # _____________________________
+
+    @property
+    def duration(self):
+        if self.started is None:
+            return
+
+        end = self.finished if self.finished is not None else time.time()
+        return end - self.started
+    # _____________________________
+
+    def add_event(self, event):
+        self.events.append(event)
+    # _____________________________
+
+    def to_dict(self):
+        return {
+            'change': self.name,
+            'changeid': self.changeid,
+            'direction': self.direction,
+            'status': self.status,
+            'started': timestamp_to_iso(self.started),
+            'finished': timestamp_to_iso(self.finished),
+            'duration': self.duration,
+            'events': self.events,
+            'data': self.data,
+        }
+# _____________________________
+
+
+def timestamp_to_iso(ts):
+    if ts is None:
+        return
+
+    return datetime.datetime.utcfromtimestamp(ts).isoformat()
+# ==============================================================
@@ -0,0 +1,816 @@
+import re
+import time
+import logging
+import psycopg2
+from psycopg2 import errorcodes
+from psycopg2.extensions import AsIs, quote_ident
+from pgin.lib.cursors import MeteredCursor
+from pgin.lib.tracing import tracer
+# ==============================================================
+
+SHADOW_SUFFIX = '__pgin_new'
+OLD_SUFFIX = '__pgin_old'
+DELTA_SUFFIX = '__pgin_delta'
+CAPTURE_SUFFIX = '__pgin_capture'
+STATE_SUFFIX = '__pgin_state'
+
+# Longest identifier, in bytes, PostgreSQL keeps
+MAX_IDENT_BYTES = 63
+
+# A plain or double quoted identifier as pg_get_indexdef() prints it
+IDENT = r'(?:"(?:[^"]|"")*"|[^\s."]+)'
+
+INDEXDEF_PAT = re.compile(
+    r'(CREATE (?:UNIQUE )?INDEX )({ident})( ON (?:ONLY )?)({ident}(?:\.{ident})?)(.*)$'.format(ident=IDENT), re.S)
+
+TRIGGERDEF_PAT = re.compile(
+    r'(CREATE (?:CONSTRAINT )?TRIGGER {ident} .*? ON )({ident}(?:\.{ident})?)( .*)$'.format(ident=IDENT), re.S)
+
+# ALTER TABLE ... TRIGGER action by pg_trigger.tgenabled
+TRIGGER_STATES = {'O': 'ENABLE', 'D': 'DISABLE', 'R': 'ENABLE REPLICA', 'A': 'ENABLE ALWAYS'}
+# ==============================================================
+
+
+class ShadowRewrite:
+    """
+    Rewrites a table online, copy-and-swap style:
+
+    1. a shadow table gets the new definition: the original's (LIKE ... INCLUDING ALL)
+       changed by *alterations*, or *columns* written out in full plus the original's indexes
+    2. a trigger on the original records the key of every written row in a delta table
+    3. rows are copied in key order, in committed chunks, calling *wait* between them;
+       the last key copied is committed with each chunk into a state table
+    4. captured deltas are replayed: the shadow row is replaced by the current original row
+    5. under a short ACCESS EXCLUSIVE lock the last deltas are replayed, the shadow gets
+       what LIKE does not copy: owner, privileges, comment, row level security policies
+       and user triggers, and the names are swapped
+
+    The original stays as <table>__pgin_old, and writes to the new table keep being
+    captured, so revert() can swap back without losing them. finish() drops the old
+    table once the change is confirmed and gives the indexes of the new table, named
+    after the shadow one until then, the names of their counterparts on the old table.
+
+    The user triggers of the old table are disabled, so the replays of a revert
+    do not fire them; revert() enables them again.
+
+    Every stage resumes where a failed run stopped. The table needs a single column
+    key that keeps its name; views and foreign keys referencing it are refused,
+    since they would follow the old table, and so is FORCE ROW LEVEL SECURITY,
+    which would hide rows from the copy.
+    """
+
+    def __init__(
+            self,
+            conn,
+            table,
+            alterations=(),
+            columns=None,
+            using=None,
+            key=None,
+            chunk_size=10000,
+            replay_every=10,
+            swap_lock_timeout='2s',
+            swap_retries=10,
+            wait=None):
+
+        self.logger = logging.getLogger('pgin')
+        self.conn = conn
+        self.cursor = conn.cursor(cursor_factory=MeteredCursor)
+        self.alterations = alterations
+        self.columns = columns
+        self.using = using or {}
+        self.key = key
+        self.chunk_size = chunk_size
+        self.replay_every = replay_every
+        self.swap_lock_timeout = swap_lock_timeout
+        self.swap_retries = swap_retries
+        self.wait = wait or (lambda: 0)
+
+        if '.' in table:
+            self.schema, self.name = table.split('.', 1)
+        else:
+            self.schema, self.name = None, table
+
+        self.table = table
+        self.shadow = self.qualified(self.name + SHADOW_SUFFIX)
+        self.old = self.qualified(self.name + OLD_SUFFIX)
+        self.delta = self.qualified(self.name + DELTA_SUFFIX)
+        self.capture = self.qualified(self.name + CAPTURE_SUFFIX)
+        self.state = self.qualified(self.name + STATE_SUFFIX)
+        self.trigger = self.name + CAPTURE_SUFFIX
+        self.copied = 0
+        self.replayed = 0
+    # _____________________________
+
+    def qualified(self, name):
+        return name if self.schema is None else '{}.{}'.format(self.schema, name)
+    # _____________________________
+
+    def ident(self, name):
+        return quote_ident(name, self.conn)
+    # _____________________________
+
+    def execute(self, query, params=None):
+        self.cursor.execute(query, params)
+        return self.cursor
+    # _____________________________
+
+    def exists(self, relation):
+        return self.execute("""SELECT to_regclass(%s) IS NOT NULL""", [relation]).fetchone()[0]
+    # _____________________________
+
+    def run(self):
+        if getattr(self.conn, 'dry_run', False):
+            raise RuntimeError("A shadow table rewrite cannot run in a dry run")
+
+        if self.exists(self.old) and not self.exists(self.shadow):
+            self.logger.info("%s was rewritten already, %s is waiting for finish()", self.table, self.old)
+            self.conn.commit()
+            return
+
+        with tracer.span('rewrite prepare {}'.format(self.table), 'rewrite'):
+            self.prepare()
+        with tracer.span('rewrite copy {}'.format(self.table), 'rewrite'):
+            self.copy()
+        with tracer.span('rewrite catch up {}'.format(self.table), 'rewrite'):
+            self.catch_up()
+        with tracer.span('rewrite swap {}'.format(self.table), 'rewrite'):
+            self.swap()
+
+        self.logger.info(
+            "Rewrote %s: %d rows copied, %d deltas replayed, old table kept as %s",
+            self.table, self.copied, self.replayed, self.old)
+    # _____________________________
+
+    def prepare(self):
+        self.conn.commit()
+        self.key = self.key or self.primary_key(self.table)
+        refs = self.references()
+        if refs:
+            raise ValueError("Cannot swap {}, referenced by: {}".format(self.table, ', '.join(refs)))
+
+        query = """SELECT relforcerowsecurity FROM pg_class WHERE oid = %s::regclass"""
+        if self.execute(query, [self.table]).fetchone()[0]:
+            raise ValueError("Cannot rewrite {}: FORCE ROW LEVEL SECURITY would hide rows from the copy".format(
+                self.table))
+
+        if not self.exists(self.shadow):
+            self.create_shadow()
+
+        self.execute(
+            """CREATE TABLE IF NOT EXISTS %s (seq BIGSERIAL PRIMARY KEY, pk %s NOT NULL)""",
+            [AsIs(self.delta), AsIs(self.key_type())]
+        )
+        # the copy position: replayed rows land in the shadow beyond it
+        self.execute(
+            """CREATE TABLE IF NOT EXISTS %s (id boolean PRIMARY KEY DEFAULT true CHECK (id), copied_to %s)""",
+            [AsIs(self.state), AsIs(self.key_type())]
+        )
+        self.execute("""INSERT INTO %s (copied_to) VALUES (NULL) ON CONFLICT DO NOTHING""", [AsIs(self.state)])
+        self.install_capture(self.table)
+        self.conn.commit()
+    # _____________________________
+
+    def primary_key(self, table):
+        query = """
+            SELECT a.attname
+            FROM pg_index i
+            JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+            WHERE i.indrelid = %s::regclass
+            AND i.indisprimary
+        """
+        keys = [r[0] for r in self.execute(query, [table]).fetchall()]
+        if len(keys) != 1:
+            raise ValueError("{} needs a single column primary key, or pass key=".format(table))
+
+        return keys[0]
+    # _____________________________
+
+    def key_type(self):
+        query = """
+            SELECT format_type(atttypid, atttypmod)
+            FROM pg_attribute
+            WHERE attrelid = %s::regclass
+            AND attname = %s
+        """
+        return self.execute(query, [self.table, self.key]).fetchone()[0]
+    # _____________________________
+
+    def references(self):
+        query = """
+            SELECT DISTINCT v.oid::regclass::text
+            FROM pg_depend d
+            JOIN pg_rewrite r ON r.oid = d.objid
+            JOIN pg_class v ON v.oid = r.ev_class
+            WHERE d.refobjid = %(table)s::regclass
+            AND v.oid <> %(table)s::regclass
+
+            UNION
+
+            SELECT conname || ' on ' || conrelid::regclass::text
+            FROM pg_constraint
+            WHERE confrelid = %(table)s::regclass
+            AND contype = 'f'
+        """
+        return [r[0] for r in self.execute(query, {'table': self.table}).fetchall()]
+    # _____________________________
+
+    def create_shadow(self):
+        self.logger.info("Creating shadow table %s", self.shadow)
+
+        if self.columns is None:
+            self.execute("""CREATE TABLE %s (LIKE %s INCLUDING ALL)""", [AsIs(self.shadow), AsIs(self.table)])
+            if self.alterations:
+                self.execute("""ALTER TABLE %s %s""", [AsIs(self.shadow), AsIs(', '.join(self.alterations))])
+            return
+
+        self.execute("""CREATE TABLE %s (%s)""", [AsIs(self.shadow), AsIs(self.columns)])
+
+        # indexes not backing a constraint; constraints come with *columns*
+        query = """
+            SELECT pg_get_indexdef(i.indexrelid)
+            FROM pg_index i
+            WHERE i.indrelid = %s::regclass
+            AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = i.indexrelid)
+        """
+        taken = set()
+        for (indexdef,) in self.execute(query, [self.table]).fetchall():
+            self.execute(shadow_indexdef(indexdef, self.shadow, taken))
+    # _____________________________
+
+    def install_capture(self, table):
+        key = self.ident(self.key)
+        self.execute("""
+            CREATE OR REPLACE FUNCTION {capture}() RETURNS trigger
+            LANGUAGE plpgsql AS $$
+            BEGIN
+                IF TG_OP <> 'INSERT' THEN
+                    INSERT INTO {delta} (pk) VALUES (OLD.{key});
+                END IF;
+                IF TG_OP = 'INSERT' OR NEW.{key} IS DISTINCT FROM OLD.{key} THEN
+                    INSERT INTO {delta} (pk) VALUES (NEW.{key});
+                END IF;
+                RETURN NULL;
+            END
+            $$;
+
+            DROP TRIGGER IF EXISTS {trigger} ON {table};
+            CREATE TRIGGER {trigger}
+                AFTER INSERT OR UPDATE OR DELETE ON {table}
+                FOR EACH ROW EXECUTE PROCEDURE {capture}();
+        """.format(capture=self.capture, delta=self.delta, key=key, trigger=self.trigger, table=table))
+    # _____________________________
+
+    def drop_capture(self, table):
+        self.execute("""DROP TRIGGER IF EXISTS %s ON %s""", [AsIs(self.trigger), AsIs(table)])
+    # _____________________________
+
+    def column_names(self, table):
+        query = """
+            SELECT attname
+            FROM pg_attribute
+            WHERE attrelid = %s::regclass
+            AND attnum > 0
+            AND NOT attisdropped
+            ORDER BY attnum
+        """
+        return [r[0] for r in self.execute(query, [table]).fetchall()]
+    # _____________________________
+
+    def mapping(self, source, target, using=None):
+        """
+        Target columns and the select list computing them from *source* rows.
+        Columns missing from the source and not in *using* take their defaults.
+        """
+        using = using or {}
+        source_columns = set(self.column_names(source))
+        columns = []
+        select = []
+        for column in self.column_names(target):
+            if column in using:
+                expr = using[column]
+            elif column in source_columns:
+                expr = self.ident(column)
+            else:
+                continue
+            columns.append(self.ident(column))
+            select.append('{} AS {}'.format(expr, self.ident(column)))
+
+        return ', '.join(columns), ', '.join(select)
+    # _____________________________
+
+    def copy(self):
+        columns, select = self.mapping(self.table, self.shadow, self.using)
+        key = self.ident(self.key)
+        last = self.execute("""SELECT copied_to FROM %s""", [AsIs(self.state)]).fetchone()[0]
+        self.conn.commit()
+        if last is not None:
+            self.logger.info("Resuming copy into %s after key %s", self.shadow, last)
+
+        chunks = 0
+        while True:
+            query = """
+                WITH batch AS (
+                    SELECT {select}, {key} AS pgin_key
+                    FROM {table}
+                    {where}
+                    ORDER BY {key}
+                    LIMIT %(limit)s
+                ), copied AS (
+                    INSERT INTO {shadow} ({columns}) OVERRIDING SYSTEM VALUE
+                    SELECT {columns} FROM batch
+                    ON CONFLICT DO NOTHING
+                )
+                SELECT max(pgin_key), count(*) FROM batch
+            """.format(
+                select=select,
+                key=key,
+                table=self.table,
+                where='' if last is None else 'WHERE {} > %(last)s'.format(key),
+                shadow=self.shadow,
+                columns=columns,
+            )
+            try:
+                chunk_last, rows = self.execute(query, {'limit': self.chunk_size, 'last': last}).fetchone()
+                if rows:
+                    self.execute("""UPDATE %s SET copied_to = %s""", [AsIs(self.state), chunk_last])
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+
+            if not rows:
+                return
+
+            last = chunk_last
+            self.copied += rows
+            chunks += 1
+            if chunks % self.replay_every == 0:
+                self.replay(self.table, self.shadow, self.using, self.chunk_size)
+                self.logger.info("Copied %d rows of %s, up to key %s", self.copied, self.table, last)
+            self.wait()
+    # _____________________________
+
+    def replay(self, source, target, using=None, limit=None, commit=True):
+        """
+        Replaces the *target* rows of the keys captured so far by the current *source* rows.
+        Only delta rows visible at the start are consumed, so a write committing
+        late with a lower seq is replayed next time.
+        Returns the number of delta rows consumed.
+        """
+        columns, select = self.mapping(source, target, using)
+        key = self.ident(self.key)
+        try:
+            self.execute(
+                """
+                CREATE TEMP TABLE pgin_replay ON COMMIT DROP AS
+                SELECT seq, pk FROM %s ORDER BY seq %s
+                """,
+                [AsIs(self.delta), AsIs('' if limit is None else 'LIMIT %d' % limit)]
+            )
+            rows = self.execute("""SELECT count(*) FROM pgin_replay""").fetchone()[0]
+            if rows:
+                self.execute("""
+                    DELETE FROM {target} WHERE {key} IN (SELECT pk FROM pgin_replay);
+
+                    INSERT INTO {target} ({columns}) OVERRIDING SYSTEM VALUE
+                    SELECT {select} FROM {source} WHERE {key} IN (SELECT pk FROM pgin_replay);
+
+                    DELETE FROM {delta} WHERE seq IN (SELECT seq FROM pgin_replay);
+                """.format(target=target, key=key, columns=columns, select=select, source=source, delta=self.delta))
+            self.execute("""DROP TABLE pgin_replay""")
+            if commit:
+                self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+        self.replayed += rows
+        return rows
+    # _____________________________
+
+    def catch_up(self):
+        """
+        Replays until what is left fits into the final locked replay
+        """
+        while self.replay(self.table, self.shadow, self.using, self.chunk_size) >= self.chunk_size:
+            self.wait()
+    # _____________________________
+
+    def locked(self, table, action):
+        """
+        Runs *action* holding ACCESS EXCLUSIVE on *table*, retrying a busy lock
+        """
+        for attempt in range(self.swap_retries + 1):
+            try:
+                self.execute("""SET LOCAL lock_timeout = %s""", [self.swap_lock_timeout])
+                self.execute("""LOCK TABLE %s IN ACCESS EXCLUSIVE MODE""", [AsIs(table)])
+                action()
+                self.conn.commit()
+                return
+            except psycopg2.OperationalError as e:
+                self.conn.rollback()
+                if e.pgcode != errorcodes.LOCK_NOT_AVAILABLE or attempt >= self.swap_retries:
+                    raise
+                self.logger.warning("Lock on %s busy, swap attempt %d/%d", table, attempt + 1, self.swap_retries + 1)
+                self.catch_up()
+                time.sleep(min(0.5 * 2 ** attempt, 10))
+    # _____________________________
+
+    def swap(self):
+        foreign_keys = self.foreign_keys(self.table)
+
+        def action():
+            self.replay(self.table, self.shadow, self.using, commit=False)
+            self.drop_capture(self.table)
+            triggers = self.user_triggers(self.table)
+            self.copy_attributes(self.table, self.shadow, triggers)
+            for name, _, _ in triggers:
+                self.set_trigger_state(self.table, name, 'D')
+            self.execute("""ALTER TABLE %s RENAME TO %s""", [AsIs(self.table), AsIs(self.name + OLD_SUFFIX)])
+            self.execute("""ALTER TABLE %s RENAME TO %s""", [AsIs(self.shadow), AsIs(self.name)])
+            self.move_sequences(self.old, self.table)
+            self.reset_identities(self.table)
+            for name, definition in foreign_keys:
+                self.execute(
+                    """ALTER TABLE %s ADD CONSTRAINT %s %s NOT VALID""",
+                    [AsIs(self.table), AsIs(self.ident(name)), AsIs(definition)]
+                )
+            # writes to the new table are captured, for revert()
+            self.install_capture(self.table)
+
+        self.locked(self.table, action)
+
+        # validating takes SHARE UPDATE EXCLUSIVE only, writes go on
+        for name, _ in foreign_keys:
+            self.execute("""ALTER TABLE %s VALIDATE CONSTRAINT %s""", [AsIs(self.table), AsIs(self.ident(name))])
+            self.conn.commit()
+    # _____________________________
+
+    def copy_attributes(self, source, target, triggers):
+        """
+        What CREATE TABLE ... LIKE leaves behind: owner, table and column privileges,
+        comment, row level security and its policies, *triggers* in their enabled state
+        """
+        query = """
+            SELECT pg_get_userbyid(relowner), obj_description(oid, 'pg_class'), relrowsecurity
+            FROM pg_class
+            WHERE oid = %s::regclass
+        """
+        owner, comment, row_security = self.execute(query, [source]).fetchone()
+
+        # first, so the default privileges of both tables are the owner's
+        self.execute("""ALTER TABLE %s OWNER TO %s""", [AsIs(target), AsIs(self.ident(owner))])
+        for statement in acl_statements(self.privileges(source, target), self.privileges(target, target), target):
+            self.execute(statement)
+
+        if comment is not None:
+            self.execute("""COMMENT ON TABLE %s IS %s""", [AsIs(target), comment])
+
+        if row_security:
+            self.execute("""ALTER TABLE %s ENABLE ROW LEVEL SECURITY""", [AsIs(target)])
+        for policy in self.policies(source):
+            self.execute(policy_statement(policy, target))
+
+        for name, triggerdef, enabled in triggers:
+            self.execute(retarget_triggerdef(triggerdef, target))
+            if enabled != 'O':
+                self.set_trigger_state(target, name, enabled)
+    # _____________________________
+
+    def privileges(self, table, columns_of):
+        """
+        (grantee, privilege, grantable, column) of *table* and of its columns found in *columns_of*
+        """
+        query = """
+            SELECT
+                CASE WHEN a.grantee = 0 THEN 'PUBLIC' ELSE quote_ident(pg_get_userbyid(a.grantee)) END,
+                a.privilege_type,
+                a.is_grantable,
+                NULL::text
+            FROM pg_class c, aclexplode(COALESCE(c.relacl, acldefault('r', c.relowner))) a
+            WHERE c.oid = %(table)s::regclass
+
+            UNION ALL
+
+            SELECT
+                CASE WHEN a.grantee = 0 THEN 'PUBLIC' ELSE quote_ident(pg_get_userbyid(a.grantee)) END,
+                a.privilege_type,
+                a.is_grantable,
+                quote_ident(t.attname)
+            FROM pg_attribute t, aclexplode(t.attacl) a
+            WHERE t.attrelid = %(table)s::regclass
+            AND t.attnum > 0
+            AND NOT t.attisdropped
+            AND EXISTS (
+                SELECT 1
+                FROM pg_attribute s
+                WHERE s.attrelid = %(columns_of)s::regclass
+                AND s.attname = t.attname
+                AND NOT s.attisdropped
+            )
+        """
+        return [tuple(r) for r in self.execute(query, {'table': table, 'columns_of': columns_of}).fetchall()]
+    # _____________________________
+
+    def policies(self, table):
+        query = """
+            SELECT
+                p.policyname,
+                p.permissive,
+                p.roles::text[] AS roles,
+                p.cmd,
+                p.qual,
+                p.with_check
+            FROM pg_policies p
+            JOIN pg_namespace n ON n.nspname = p.schemaname
+            JOIN pg_class c ON c.relnamespace = n.oid AND c.relname = p.tablename
+            WHERE c.oid = %s::regclass
+            ORDER BY p.policyname
+        """
+        return [dict(r) for r in self.execute(query, [table]).fetchall()]
+    # _____________________________
+
+    def user_triggers(self, table):
+        """
+        (name, definition, enabled) of the triggers of *table*
+        but the change capture and those implementing constraints
+        """
+        query = """
+            SELECT tgname, pg_get_triggerdef(oid), tgenabled
+            FROM pg_trigger
+            WHERE tgrelid = %s::regclass
+            AND NOT tgisinternal
+            AND tgname <> %s
+            ORDER BY tgname
+        """
+        return [tuple(r) for r in self.execute(query, [table, self.trigger]).fetchall()]
+    # _____________________________
+
+    def set_trigger_state(self, table, name, enabled):
+        self.execute(
+            """ALTER TABLE %s %s TRIGGER %s""",
+            [AsIs(table), AsIs(TRIGGER_STATES[enabled]), AsIs(self.ident(name))]
+        )
+    # _____________________________
+
+    def foreign_keys(self, table):
+        query = """
+            SELECT conname, pg_get_constraintdef(oid)
+            FROM pg_constraint
+            WHERE conrelid = %s::regclass
+            AND contype = 'f'
+        """
+        return [tuple(r) for r in self.execute(query, [table]).fetchall()]
+    # _____________________________
+
+    def move_sequences(self, source, target):
+        """
+        Serial sequences owned by *source* columns go to the same *target* columns,
+        so dropping *source* later leaves them alone
+        """
+        query = """
+            SELECT s.oid::regclass::text, a.attname
+            FROM pg_depend d
+            JOIN pg_class s ON s.oid = d.objid AND s.relkind = 'S'
+            JOIN pg_attribute a ON a.attrelid = d.refobjid AND a.attnum = d.refobjsubid
+            WHERE d.refobjid = %s::regclass
+            AND d.deptype = 'a'
+        """
+        for sequence, column in self.execute(query, [source]).fetchall():
+            self.execute(
+                """ALTER SEQUENCE %s OWNED BY %s.%s""",
+                [AsIs(sequence), AsIs(target), AsIs(self.ident(column))]
+            )
+    # _____________________________
+
+    def reset_identities(self, table):
+        """
+        Identity sequences of *table* continue after the copied values
+        """
+        query = """
+            SELECT attname
+            FROM pg_attribute
+            WHERE attrelid = %s::regclass
+            AND attidentity <> ''
+        """
+        for (column,) in self.execute(query, [table]).fetchall():
+            self.execute(
+                """
+                SELECT setval(pg_get_serial_sequence(%(table)s, %(column)s), COALESCE(max(%(ident)s), 0) + 1, false)
+                FROM %(table_ident)s
+                """,
+                {'table': table, 'column': column, 'ident': AsIs(self.ident(column)), 'table_ident': AsIs(table)}
+            )
+    # _____________________________
+
+    def revert(self):
+        """
+        Swaps the old table back, with the writes the new one got meanwhile
+        """
+        self.conn.commit()
+        if not self.exists(self.old):
+            self.logger.info(
+                "No %s, rewrite of %s was not swapped or is finished, dropping leftovers", self.old, self.table)
+            self.drop_capture(self.table)
+            self.execute("""DROP TABLE IF EXISTS %s""", [AsIs(self.shadow)])
+            self.execute("""DROP TABLE IF EXISTS %s""", [AsIs(self.delta)])
+            self.execute("""DROP TABLE IF EXISTS %s""", [AsIs(self.state)])
+            self.execute("""DROP FUNCTION IF EXISTS %s()""", [AsIs(self.capture)])
+            self.conn.commit()
+            return
+
+        self.key = self.key or self.primary_key(self.table)
+
+        def action():
+            self.replay(self.table, self.old, commit=False)
+            self.drop_capture(self.table)
+            # the old triggers come back in the state of their copies on the new table
+            states = {name: enabled for name, _, enabled in self.user_triggers(self.table)}
+            for name, _, _ in self.user_triggers(self.old):
+                self.set_trigger_state(self.old, name, states.get(name, 'O'))
+            self.execute("""ALTER TABLE %s RENAME TO %s""", [AsIs(self.table), AsIs(self.name + SHADOW_SUFFIX)])
+            self.execute("""ALTER TABLE %s RENAME TO %s""", [AsIs(self.old), AsIs(self.name)])
+            self.move_sequences(self.shadow, self.table)
+            self.reset_identities(self.table)
+
+        self.replay(self.table, self.old)
+        self.locked(self.table, action)
+
+        self.execute("""DROP TABLE %s""", [AsIs(self.shadow)])
+        self.execute("""DROP TABLE IF EXISTS %s""", [AsIs(self.delta)])
+        self.execute("""DROP TABLE IF EXISTS %s""", [AsIs(self.state)])
+        self.execute("""DROP FUNCTION IF EXISTS %s()""", [AsIs(self.capture)])
+        self.conn.commit()
+        self.logger.info("Swapped the original %s back", self.table)
+    # _____________________________
+
+    def indexes(self, table):
+        """
+        (name, regclass, definition) of every index of *table*, oldest first
+        """
+        query = """
+            SELECT c.relname, i.indexrelid::regclass::text, pg_get_indexdef(i.indexrelid)
+            FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE i.indrelid = %s::regclass
+            ORDER BY i.indexrelid
+        """
+        return [tuple(r) for r in self.execute(query, [table]).fetchall()]
+    # _____________________________
+
+    def restore_index_names(self, old_indexes):
+        """
+        Renames the indexes of the new table after the *old_indexes* with the same definition.
+        Renaming an index backing a constraint renames the constraint as well.
+        """
+        names = {}
+        for name, _, indexdef in old_indexes:
+            names.setdefault(index_signature(indexdef), []).append(name)
+
+        for name, index, indexdef in self.indexes(self.table):
+            original = names.get(index_signature(indexdef))
+            if not original:
+                self.logger.info("Index %s has no counterpart on %s, keeping its name", index, self.old)
+                continue
+
+            target = original.pop(0)
+            if target != name:
+                self.execute("""ALTER INDEX %s RENAME TO %s""", [AsIs(index), AsIs(self.ident(target))])
+    # _____________________________
+
+    def finish(self):
+        """
+        The rewrite is confirmed: drops the old table and the change capture,
+        then hands the old index names over to the new table
+        """
+        self.conn.commit()
+        old_indexes = self.indexes(self.old) if self.exists(self.old) else []
+        self.drop_capture(self.table)
+        self.execute("""DROP TABLE IF EXISTS %s""", [AsIs(self.old)])
+        self.restore_index_names(old_indexes)
+        self.execute("""DROP TABLE IF EXISTS %s""", [AsIs(self.delta)])
+        self.execute("""DROP TABLE IF EXISTS %s""", [AsIs(self.state)])
+        self.execute("""DROP FUNCTION IF EXISTS %s()""", [AsIs(self.capture)])
+        self.conn.commit()
+        self.logger.info("Dropped %s", self.old)
+# ==============================================================
+
+
+def shadow_indexdef(indexdef, shadow, taken=None):
+    """
+    CREATE INDEX statement of the original table rewritten for the shadow one.
+    The index name chosen is added to *taken*, a set of the names chosen so far.
+    """
+    match = INDEXDEF_PAT.match(indexdef)
+    if match is None:
+        raise ValueError("Unexpected index definition: {}".format(indexdef))
+
+    head, name, on, _, rest = match.groups()
+    name = shadow_index_name(unquote_ident(name), taken or ())
+    if taken is not None:
+        taken.add(name)
+
+    return '{}{}{}{}{}'.format(head, quote_ident_plain(name), on, shadow, rest)
+# _____________________________
+
+
+def retarget_triggerdef(triggerdef, table):
+    """
+    CREATE TRIGGER statement, as pg_get_triggerdef() prints it, moved to *table*
+    """
+    match = TRIGGERDEF_PAT.match(triggerdef)
+    if match is None:
+        raise ValueError("Unexpected trigger definition: {}".format(triggerdef))
+
+    head, _, rest = match.groups()
+    return '{}{}{}'.format(head, table, rest)
+# _____________________________
+
+
+def policy_statement(policy, table):
+    """
+    CREATE POLICY statement of a pg_policies row, on *table*
+    """
+    roles = ', '.join('PUBLIC' if r == 'public' else quote_ident_plain(r) for r in policy['roles'])
+    statement = 'CREATE POLICY {} ON {} AS {} FOR {} TO {}'.format(
+        quote_ident_plain(policy['policyname']), table, policy['permissive'], policy['cmd'], roles)
+    if policy['qual'] is not None:
+        statement += ' USING ({})'.format(policy['qual'])
+    if policy['with_check'] is not None:
+        statement += ' WITH CHECK ({})'.format(policy['with_check'])
+
+    return statement
+# _____________________________
+
+
+def acl_statements(source, target, table):
+    """
+    REVOKE and GRANT statements giving *table*, holding the *target* privileges,
+    the *source* ones instead. Privileges are (grantee, privilege, grantable, column).
+    """
+    statements = []
+    for grantee, privilege, _, column in sorted(set(target) - set(source), key=str):
+        statements.append('REVOKE {} ON {} FROM {}'.format(privilege_spec(privilege, column), table, grantee))
+
+    for grantee, privilege, grantable, column in sorted(set(source) - set(target), key=str):
+        statements.append('GRANT {} ON {} TO {}{}'.format(
+            privilege_spec(privilege, column), table, grantee, ' WITH GRANT OPTION' if grantable else ''))
+
+    return statements
+# _____________________________
+
+
+def privilege_spec(privilege, column=None):
+    return privilege if column is None else '{} ({})'.format(privilege, column)
+# _____________________________
+
+
+def shadow_index_name(name, taken=()):
+    """
+    *name* with SHADOW_SUFFIX, cut short so the suffix survives the identifier length limit.
+    Names cut to the same prefix are told apart by a number before the suffix,
+    the way PostgreSQL picks index names.
+    """
+    number = 0
+    while True:
+        suffix = SHADOW_SUFFIX if number == 0 else '{}{}'.format(number, SHADOW_SUFFIX)
+        candidate = truncate_ident(name, MAX_IDENT_BYTES - len(suffix)) + suffix
+        if candidate != name and candidate not in taken:
+            return candidate
+        number += 1
+# _____________________________
+
+
+def index_signature(indexdef):
+    """
+    Index definition without the index and table names, to match indexes across tables
+    """
+    match = INDEXDEF_PAT.match(indexdef)
+    if match is None:
+        return indexdef
+
+    head, _, on, _, rest = match.groups()
+    return '{}{}{}'.format(head, on, rest)
+# _____________________________
+
+
+def truncate_ident(name, limit):
+    """
+    At most *limit* bytes of *name*, without splitting a character
+    """
+    return name.encode('utf-8')[:limit].decode('utf-8', 'ignore')
+# _____________________________
+
+
+def unquote_ident(name):
+    if name.startswith('"'):
+        return name[1:-1].replace('""', '"')
+
+    return name
+# _____________________________
+
+
+def quote_ident_plain(name):
+    return '"{}"'.format(name.replace('"', '""'))
+# ==============================================================
@@ -0,0 +1,124 @@
+import time
+import logging
+import psycopg2
+from pgin.lib.tracing import tracer
+# ==============================================================
+
+
+class ReplicationThrottle:
+    """
+    Holds write-heavy migrations back while streaming replicas lag behind.
+
+    Lag is sampled on the primary from pg_stat_replication, or, if a standby
+    DBAdmin is given, as the distance between the primary WAL position
+    and the standby pg_last_wal_replay_lsn().
+
+    Lag in seconds is only known on the primary: a standby reports
+    its replay position alone.
+
+    Once the lag passes a threshold, wait() sleeps until it drops
+    under *resume_ratio* of that threshold. If the lag cannot be sampled
+    *max_sample_errors* times in a row, the migration resumes.
+    """
+
+    def __init__(
+            self,
+            dba,
+            standby_dba=None,
+            max_lag_bytes=None,
+            max_lag_seconds=None,
+            check_interval=1.0,
+            pause=1.0,
+            resume_ratio=0.5,
+            max_sample_errors=5):
+
+        self.logger = logging.getLogger('pgin')
+        self.dba = dba
+        self.standby_dba = standby_dba
+        self.max_lag_bytes = max_lag_bytes
+        self.max_lag_seconds = max_lag_seconds
+        self.check_interval = check_interval
+        self.pause = pause
+        self.resume_ratio = resume_ratio
+        self.max_sample_errors = max_sample_errors
+        self.last_check = 0
+        self.throttled = 0.0
+        self.pauses = 0
+    # _____________________________
+
+    @property
+    def enabled(self):
+        return self.max_lag_bytes is not None or self.max_lag_seconds is not None
+    # _____________________________
+
+    def sample(self):
+        """
+        Current replay lag: {'bytes': ..., 'seconds': ...}, either may be None
+        """
+        if self.standby_dba is None:
+            return self.dba.fetch_replication_lag()
+
+        lsn = self.dba.fetch_current_wal_lsn()
+        return self.standby_dba.fetch_standby_replay_lag(lsn)
+    # _____________________________
+
+    def over(self, lag, ratio=1.0):
+        if self.max_lag_bytes is not None and lag['bytes'] is not None \
+                and lag['bytes'] > self.max_lag_bytes * ratio:
+            return True
+
+        if self.max_lag_seconds is not None and lag['seconds'] is not None \
+                and lag['seconds'] > self.max_lag_seconds * ratio:
+            return True
+
+        return False
+    # _____________________________
+
+    def wait(self):
+        """
+        Returns the number of seconds spent waiting.
+        Cheap to call after every batch: the lag is sampled
+        at most once per *check_interval*.
+        """
+        if not self.enabled:
+            return 0
+
+        now = time.time()
+        if now - self.last_check < self.check_interval:
+            return 0
+        self.last_check = now
+
+        try:
+            lag = self.sample()
+        except psycopg2.Error:
+            self.logger.exception("Failed to sample replication lag")
+            return 0
+
+        if not self.over(lag):
+            return 0
+
+        self.pauses += 1
+        self.logger.info("Replication lag %r over the limit, pausing", lag)
+        started = time.time()
+
+        with tracer.span('replication lag', 'wait', lag=lag):
+            errors = 0
+            while self.over(lag, self.resume_ratio):
+                time.sleep(self.pause)
+                try:
+                    lag = self.sample()
+                    errors = 0
+                except psycopg2.Error:
+                    errors += 1
+                    self.logger.warning(
+                        "Failed to sample replication lag (%d/%d)", errors, self.max_sample_errors, exc_info=True)
+                    if errors >= self.max_sample_errors:
+                        self.logger.error("Replication lag unknown, resuming")
+                        break
+
+        waited = time.time() - started
+        self.throttled += waited
+        self.logger.info("Replication lag %r, resuming after %.1fs", lag, waited)
+
+        return waited
+# ==============================================================
@@ -0,0 +1,117 @@
+import os
+import json
+import time
+import functools
+import threading
+import contextlib
+# ==============================================================
+
+
+class Tracer:
+    """
+    Records spans in Chrome trace event format, viewable in Perfetto or chrome://tracing.
+    Every thread gets its own lane. Disabled tracing costs a single attribute check.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.threads = {}
+        self.pid = os.getpid()
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()
+    # _____________________________
+
+    def enable(self):
+        self.enabled = True
+        self.origin = time.perf_counter()
+    # _____________________________
+
+    def now(self):
+        return (time.perf_counter() - self.origin) * 1e6
+    # _____________________________
+
+    def record(self, event):
+        thread = threading.current_thread()
+        event['pid'] = self.pid
+        event['tid'] = thread.ident
+        with self.lock:
+            self.threads[thread.ident] = thread.name
+            self.events.append(event)
+    # _____________________________
+
+    @contextlib.contextmanager
+    def span(self, name, cat='pgin', **args):
+        if not self.enabled:
+            yield
+            return
+
+        start = self.now()
+        try:
+            yield
+        finally:
+            self.record({
+                'name': name,
+                'cat': cat,
+                'ph': 'X',
+                'ts': start,
+                'dur': self.now() - start,
+                'args': args,
+            })
+    # _____________________________
+
+    def instant(self, name, cat='pgin', **args):
+        if not self.enabled:
+            return
+
+        self.record({
+            'name': name,
+            'cat': cat,
+            'ph': 'i',
+            's': 't',
+            'ts': self.now(),
+            'args': args,
+        })
+    # _____________________________
+
+    def dump(self, path):
+        with self.lock:
+            metadata = [
+                {'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid, 'args': {'name': name}}
+                for tid, name in self.threads.items()
+            ]
+            metadata.append({'name': 'process_name', 'ph': 'M', 'pid': self.pid, 'args': {'name': 'pgin'}})
+            trace = {
+                'traceEvents': metadata + self.events,
+                'displayTimeUnit': 'ms',
+            }
+
+        with open(path, 'w') as fw:
+            json.dump(trace, fw, default=str)
+# ==============================================================
+
+
+def traced(cat, name=None):
+    """
+    Decorator recording every call of the function as a span
+    """
+
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return func(*args, **kwargs)
+
+            with tracer.span(span_name, cat):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+# ==============================================================
+
+
+tracer = Tracer()
+# ==============================================================
@@ -1,9 +1,11 @@
 import os
 import sys
+import time
 import uuid
 import importlib
 import click
 import re
+import logging
 import jsonlines
 import psycopg2
 import psycopg2.extras
@@ -13,7 +15,22 @@ from tabulate import tabulate
 import toml
 # =================================================
 
+from pgin.lib import metrics  # noqa
+from pgin.lib.advisor import IndexAdvisor, change_name  # noqa
+from pgin.lib.analyze import ParallelAnalyzer, modification_counts, touched_relations, STATS_FLUSH_DELAY  # noqa
+from pgin.lib.applogging import set_logger  # noqa
+from pgin.lib.bloat import follow_ups  # noqa
 from pgin.lib.helpers import create_directory  # noqa
+from pgin.lib.lockguard import LockGuard  # noqa
+from pgin.lib.preflight import change_relations, probe_relations, is_clear  # noqa
+from pgin.lib.profiles import load_profile, connection_lost  # noqa
+from pgin.lib.profiling import ChangeProfiler, SUMMARY_HEADERS  # noqa
+from pgin.lib.plancheck import load_registry, capture_plans, compare_plans, COST_THRESHOLD  # noqa
+from pgin.lib.phases import PHASES, EXPAND, CONTRACT, change_phases, phases_to_deploy  # noqa
+from pgin.lib.progress import ProgressMonitor, render_progress  # noqa
+from pgin.lib.report import ChangeReport  # noqa
+from pgin.lib.throttle import ReplicationThrottle  # noqa
+from pgin.lib.tracing import tracer, traced  # noqa
 from pgin.dba import DBAdmin  # noqa
 MSG_LENGTH = 60
 
@@ -23,8 +40,12 @@ PLAN_FILE = 'plan.json'
 DEPLOY_DIR = 'deploy'
 REVERT_DIR = 'revert'
 CONF_FILE = 'pgin.conf'
+QUERIES_FILE = 'queries.toml'
 CONF_PATH_FILE = '.pgin_confpath'
+LOG_FILE = os.path.join('~', '.pgin', 'log', 'pgin.log')
 # /TODO: might be a subject of configuration later on
+
+logger = logging.getLogger('pgin')
 # _____________________________________________
 
 
@@ -45,6 +66,27 @@ def create_containers(conf):
 # _____________________________________________
 
 
+def find_conf_file():
+    '''
+    PGIN_CONF env variable or the path saved by the last init
+    '''
+    conf_file = os.environ.get('PGIN_CONF')
+    if conf_file:
+        return conf_file
+
+    rootdir = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+    conf_path_file = os.path.join(rootdir, CONF_PATH_FILE)
+    if not os.path.exists(conf_path_file):
+        return
+
+    with open(conf_path_file) as cp:
+        conf_file = cp.read().strip()
+
+    if os.path.exists(conf_file):
+        return conf_file
+# _____________________________________________
+
+
 def get_version():
     rootdir = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
     with open(os.path.join(rootdir, 'VERSION')) as fp:
@@ -68,8 +110,9 @@ def init_config(pgin_project, dbuser, topdir):
         'dbuser': dbuser,
         'migration_container': MIGRATION_DIR,
         'plan_file': PLAN_FILE,
-        'plan': os.path.join(home, PLAN_FILE)
-
+        'plan': os.path.join(home, PLAN_FILE),
+        # Set to true on dev/CI databases to allow `pgin reset`
+        'disposable': False,
     }
     conf_file = os.path.join(home, CONF_FILE)
     save_conf_path(conf_file)
@@ -82,20 +125,19 @@ def init_config(pgin_project, dbuser, topdir):
 # _____________________________________________
 
 
-def init_db(conf, newdb):
+def init_db(migration, newdb):
 
-    dbname = conf['project']
-    dbuser = conf['dbuser']
-    plan = conf['plan']
+    dbname = migration.project
+    plan = migration.plan
 
     try:
-        dba = DBAdmin(dbname=dbname, dbuser=dbuser)
+        dba = new_dba(migration)
         dba.revoke_connect_from_db()
 
         if newdb:
             sure = input("Sure to drop existing DB {}? (Yes/No) ".format(dbname).lower())
             if sure in ['y', 'yes']:
-                upgrade_plan_file(plan)
+                upgrade_plan_file(migration)
                 click.echo("Dropping DB {}".format(dbname))
                 dba.dropdb()
             else:
@@ -104,7 +146,7 @@ def init_db(conf, newdb):
         click.echo("Creating DB {} if not already exists".format(dbname))
         dba.createdb()
         dba.grant_connect_to_db()
-        dba = connect_dba(dbname=dbname, dbuser=dbuser)
+        dba = connect_dba(migration)
         create_pgin_metaschema(dba)
         populate_plan_table(dba, plan)
     finally:
@@ -140,10 +182,56 @@ class MutuallyExclusiveOption(click.Option):
 
 class Migration(object):
 
-    def __init__(self):
+    def __init__(self, connection='default'):
         pgindir = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
         self.template_dir = os.path.join(pgindir, 'templates')
         self.template_env = Environment(loader=FileSystemLoader(self.template_dir))
+        self.logger = logger
+        self.conf = None
+        self.project = None
+        self.project_user = None
+        self.home = None
+        self.plan = None
+        self.workdir = None
+        self.monitor_dba = None
+        self.watchdog_dba = None
+        self.progress_interval = 2.0
+        self.lockguard = LockGuard()
+        self.profiler = None
+        self.throttle = None
+        self.throttle_dba = None
+        self.standby_dba = None
+        self.reports = []
+        self.read_dsn = None
+        self.explain = False
+        self.record_sizes = False
+        self.connection = connection
+        self.profile = None
+        self.read_profile = None
+
+        conf_file = find_conf_file()
+        if conf_file is not None:
+            with open(conf_file) as fp:
+                self.set_conf(toml.load(fp))
+        else:
+            # no pgin.conf yet: a profile other than the default cannot be resolved
+            self.profile = load_profile(name=connection)
+    # ___________________________________
+
+    def set_conf(self, conf):
+        self.conf = conf
+        self.project = conf['project']
+        self.project_user = conf['dbuser']
+        self.home = conf['home']
+        self.plan = conf['plan']
+        self.workdir = '{}.{}'.format(conf['migration_container'], conf['project'])
+        self.profile = load_profile(conf, self.connection)
+        if 'read' in conf.get('connections', {}):
+            self.read_profile = load_profile(conf, 'read', use_env=False)
+
+        # deploy/revert scripts are imported as <migration_container>.<project>.<direction>.<change>
+        if conf['topdir'] not in sys.path:
+            sys.path.insert(0, conf['topdir'])
     # ___________________________________
 
 # =============================================
@@ -187,20 +275,12 @@ pass_migration = click.make_pass_decorator(Migration)
 # _____________________________________________
 
 
-def change_deployed(migration, changeid):
-    dba = connect_dba(migration)
-    return dba.fetch_change_deployed(changeid)
-# _____________________________________________
-
-
-def create_script(migration, direction, name):
-    template_file = '%s.tmpl' % direction
+def create_script(migration, direction, name, kind=None, params=None):
+    template_file = '%s.tmpl' % direction if kind is None else '%s_%s.tmpl' % (direction, kind)
     script_file = '%s.py' % name
     script_path = os.path.join(migration.home, direction, script_file)
     tmpl = migration.template_env.get_template(template_file)
-    params = {
-        'name': name
-    }
+    params = dict(params or {}, name=name)
     code = tmpl.render(params)
     with open(script_path, 'w') as fw:
         fw.write("%s\n" % code)
@@ -219,22 +299,86 @@ def create_plan(plan):
 # _____________________________________________
 
 
-def connect_dba(dbname, dbuser, dbschema=None):
-    dba = DBAdmin(dbname=dbname, dbuser=dbuser)
-    dba.conn = dba.connectdb(dba.dburi)
-    dba.cursor = dba.conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+def new_dba(migration, profile=None):
+    return DBAdmin(
+        dbname=migration.project,
+        dbuser=migration.project_user,
+        profile=profile if profile is not None else migration.profile
+    )
+# _____________________________________________
+
+
+def connect_dba(migration, dbschema=None):
+    dba = new_dba(migration).connect()
     if dbschema is None:
-        dbschema = dbname
+        dbschema = migration.project
     dba.set_search_path(schema=dbschema)
     return dba
 # _____________________________________________
 
 
+def connect_read_dba(migration):
+    '''
+    Connection for read-only commands. Goes to the read DSN or the
+    'read' connection profile, typically a hot standby, if one is configured,
+    and to the primary otherwise or when the standby cannot be reached.
+    The session is read-only, so a write sent here fails instead of
+    landing on the wrong server.
+    A meta schema older than this pgin is upgraded on the primary first;
+    a standby not carrying the upgrade yet is passed over.
+    '''
+    if not migration.read_dsn and migration.read_profile is None:
+        return upgrade_metaschema(connect_dba(migration))
+
+    dba = new_dba(migration, migration.read_profile)
+    try:
+        dba.connect(migration.read_dsn, autocommit=True, readonly=True)
+    except psycopg2.OperationalError:
+        logger.warning("Standby unreachable, reading from the primary", exc_info=True)
+        return upgrade_metaschema(connect_dba(migration))
+
+    if dba.meta_schema_outdated():
+        logger.warning("Meta schema on the standby is outdated, reading from the primary")
+        disconnect_dba(dba)
+        return upgrade_metaschema(connect_dba(migration))
+
+    logger.debug("Reading from %s", dba.conn.dsn)
+    return dba
+# _____________________________________________
+
+
+def upgrade_metaschema(dba):
+    '''
+    Brings a meta schema created by an older pgin up to date
+    '''
+    if dba.meta_schema_outdated():
+        logger.info("Upgrading meta schema %s", dba.meta_schema)
+        create_pgin_metaschema(dba)
+    return dba
+# _____________________________________________
+
+
 def create_pgin_metaschema(dba):
     dba.create_meta_schema()
     dba.create_plan_table()
     dba.create_changes_table()
     dba.create_tags_table()
+    dba.create_steps_table()
+    dba.create_phases_table()
+    dba.create_validations_table()
+    dba.create_wal_table()
+    dba.create_sizes_table()
+# _____________________________________________
+
+
+def connect_monitor_dba(migration):
+    '''
+    A side connection for the background threads watching a change.
+    Autocommit, so every poll sees fresh statistics.
+    '''
+    dba = connect_dba(migration)
+    dba.conn.autocommit = True
+    return dba
 # _____________________________________________
 
 
@@ -287,59 +431,470 @@ def figure_deploy_to_change(dba, migration, to):
 # _____________________________________________
 
 
+def pending_changes(dba, migration, to):
+    '''
+    Plan entries not deployed yet, up to and including change *to*
+    '''
+    pending = []
+    for line in plan_file_entries(migration.plan):
+        if not dba.fetch_change_deployed(line['changeid']):
+            pending.append(line)
+
+        if line['name'] == to:
+            break
+
+    return pending
+# _____________________________________________
+
+
+def echo_change_label(sign, name):
+    click.echo(message="{} {} {} ".format(sign, name, '.' * (MSG_LENGTH - len(name))), nl=False)
+# _____________________________________________
+
+
+def start_progress_monitor(migration, dba, report):
+    if migration.monitor_dba is None:
+        return
+
+    def on_event(event):
+        report.add_event(event)
+        if len(monitor.events) == 1:
+            click.echo('')
+        click.echo(render_progress(event))
+
+    monitor = ProgressMonitor(
+        dba=migration.monitor_dba,
+        pid=dba.conn.get_backend_pid(),
+        change=report.name,
+        interval=migration.progress_interval,
+        on_event=on_event
+    )
+    monitor.start()
+
+    return monitor
+# _____________________________________________
+
+
+def run_monitored(migration, dba, change, report):
+    monitor = start_progress_monitor(migration, dba, report)
+    try:
+        if migration.profiler is None:
+            change()
+        else:
+            with migration.profiler.profile(report):
+                change()
+    finally:
+        if monitor is not None:
+            monitor.stop()
+            if monitor.events:
+                echo_change_label(direction_sign(report.direction), report.name)
+# _____________________________________________
+
+
+def direction_sign(direction):
+    return '+' if direction == 'deploy' else '-'
+# _____________________________________________
+
+
+def run_change(migration, dba, direction, name, changeid, phase=None):
+    '''
+    Loads and executes a deploy or revert, or a single phase of it
+    '''
+    load = get_change_deploy if direction == 'deploy' else get_change_revert
+    change = load(migration, dba, name, changeid)
+    change.phase = phase
+
+    label = name if phase is None else '{}.{}'.format(name, phase)
+    report = ChangeReport(label, direction, changeid)
+    report.data['phase'] = phase
+
+    echo_change_label(direction_sign(direction), label)
+    execute_change(migration, dba, change, report)
+    return report
+# _____________________________________________
+
+
+def execute_change(migration, dba, change, report):
+    '''
+    Runs a loaded deploy or revert object and records the outcome in *report*.
+    Lock timeouts, deadlocks, serialization failures and watchdog cancellations
+    are retried with jittered backoff. After a lost connection pgin reconnects;
+    only changes made of steps are retried then, resuming from the first
+    incomplete step, since a plain change may have committed unnoticed.
+    '''
+    migration.reports.append(report)
+    guard = migration.lockguard
+    attempt = 0
+    report.data['retries'] = attempt
+    throttled = migration.throttle.throttled if migration.throttle is not None else 0
+    wal_lsn = dba.fetch_current_wal_lsn()
+    wal_counters = dba.fetch_wal_counters()
+    relations = sorted(change_relations(change)) if migration.record_sizes else []
+    sizes = dba.fetch_relation_sizes(relations)
+
+    report.start()
+    try:
+        while True:
+            watchdog = None
+            try:
+                dba.set_lock_timeout(guard.change_lock_timeout(change))
+                watchdog = guard.start_watchdog(migration.watchdog_dba, dba.conn.get_backend_pid(), report.name)
+                with tracer.span('{} {}'.format(report.direction, report.name), 'change', attempt=attempt):
+                    run_monitored(migration, dba, change, report)
+                break
+            except psycopg2.Error as e:
+                if connection_lost(dba.conn):
+                    dba.reconnect()
+                    change.rebind(dba.conn)
+                    reason = 'connection lost' if getattr(change, 'steps', None) else None
+                else:
+                    reason = guard.retry_reason(e, watchdog)
+
+                if reason is None or attempt >= guard.retries:
+                    raise
+
+                attempt += 1
+                report.data['retries'] = attempt
+                metrics.change_retries.inc(reason=reason)
+                delay = guard.backoff(attempt)
+                event = {
+                    'event': 'retry',
+                    'change': report.name,
+                    'attempt': attempt,
+                    'reason': reason,
+                    'pgcode': e.pgcode,
+                    'error': str(e).strip(),
+                    'delay': delay,
+                }
+                report.add_event(event)
+                logger.warning("Retrying change %s: %s", report.name, reason, extra={'event': event})
+
+                click.echo(click.style('retry', fg='yellow'))
+                click.echo("    {}, attempt {}/{} in {:.1f}s".format(reason, attempt + 1, guard.retries + 1, delay))
+                dba.conn.rollback()
+                with tracer.span('backoff', 'wait', reason=reason, attempt=attempt):
+                    time.sleep(delay)
+                echo_change_label(direction_sign(report.direction), report.name)
+            finally:
+                if watchdog is not None:
+                    watchdog.stop()
+                    if watchdog.cancelled:
+                        report.add_event(watchdog.cancelled)
+                if migration.throttle is not None:
+                    report.data['throttled'] = migration.throttle.throttled - throttled
+    except Exception:
+        report.finish('fail')
+        raise
+    else:
+        report.data['wal_bytes'] = dba.fetch_wal_bytes_since(wal_lsn)
+        after = dba.fetch_wal_counters(flush=True)
+        report.data.update((k, after[k] - v) for k, v in wal_counters.items() if k in after)
+        dba.conn.commit()
+        report.finish('ok')
+        dba.record_wal(report.changeid, report.direction, report.data.get('phase'), report.duration, report.data)
+        if relations:
+            dba.record_sizes(
+                report.changeid,
+                report.direction,
+                report.data.get('phase'),
+                sizes,
+                dba.fetch_relation_sizes(relations)
+            )
+    finally:
+        observe_change(migration, change, report)
+# _____________________________________________
+
+
+def observe_change(migration, change, report):
+    '''
+    Feeds a finished change into the metrics registry
+    '''
+    direction = report.direction
+    cursor = getattr(change, 'cursor', None)
+    report.data['rows'] = getattr(cursor, 'rows', None)
+    if hasattr(cursor, 'summary'):
+        report.data['statements'] = cursor.summary()
+        if cursor.explains:
+            report.data['explains'] = list(cursor.explains.values())
+    if getattr(change, 'index_builds', None):
+        report.data['indexes'] = change.index_builds
+    if getattr(change, 'rewrites', None):
+        report.data['rewrites'] = change.rewrites
+    if getattr(change, 'validations', None):
+        report.data['validations'] = change.validations
+    if getattr(change, 'partition_actions', None):
+        report.data['partitions'] = change.partition_actions
+
+    metrics.changes.inc(direction=direction, status=report.status)
+    metrics.change_duration.observe(report.duration, direction=direction, status=report.status)
+    metrics.change_last_duration.set(report.duration, change=report.name, direction=direction)
+
+    if report.data['rows']:
+        metrics.change_rows.inc(report.data['rows'], direction=direction)
+
+    if report.data.get('wal_bytes'):
+        metrics.change_wal_bytes.inc(report.data['wal_bytes'], direction=direction)
+
+    lock_samples = [e for e in report.events if e['event'] == 'progress' and e['wait_event_type'] == 'Lock']
+    if lock_samples:
+        metrics.lock_wait.inc(len(lock_samples) * migration.progress_interval, direction=direction)
+# _____________________________________________
+
+
+def write_metrics(path):
+    if path is None:
+        return
+
+    try:
+        metrics.registry.write_textfile(path)
+    except OSError:
+        logger.exception("Failed to write metrics file %s", path)
+# _____________________________________________
+
+
+def run_preflight(migration, dba, pending):
+    '''
+    Probes the locks every pending change needs.
+    Returns False if any of them is held by another session.
+    '''
+    click.echo("Pre-flight lock probe of {} pending changes".format(len(pending)))
+    probe_dba = connect_dba(migration)
+    clear = True
+
+    try:
+        for line in pending:
+            name = line['name']
+            relations = change_relations(get_change_deploy(migration, dba, name))
+            results = probe_relations(probe_dba, relations)
+
+            echo_change_label('?', name)
+            if is_clear(results):
+                click.echo(click.style('ok', fg='green'))
+                continue
+
+            clear = False
+            click.echo(click.style('locked', fg='red'))
+            holders = [
+                (
+                    r['relation'],
+                    r['mode'],
+                    h['pid'],
+                    h['mode'],
+                    'held' if h['granted'] else 'queued',
+                    h['usename'],
+                    h['state'],
+                    '{:.1f}'.format(h['xact_age'] or 0),
+                    h['query']
+                )
+                for r in results for h in r['holders']
+            ]
+            click.echo(tabulate(
+                holders,
+                headers=['Relation', 'Needs', 'PID', 'Holds', 'Lock', 'User', 'State', 'Xact Age (s)', 'Query']
+            ))
+    finally:
+        disconnect_dba(probe_dba)
+
+    return clear
+# _____________________________________________
+
+
+def echo_change_ok(report):
+    msg = click.style('ok', fg='green')
+    if report.data.get('throttled'):
+        msg += " (throttled {:.1f}s)".format(report.data['throttled'])
+    click.echo(msg)
+# _____________________________________________
+
+
+def validate_pending(dba, relation=None):
+    '''
+    Validates the queued NOT VALID constraints one by one.
+    A failing one stays queued and the rest go on.
+    Returns True if all of them validated.
+    '''
+    ok = True
+    for pending in dba.fetch_pending_validations(relation):
+        label = '{}.{}'.format(pending['relation'], pending['constraint_name'])
+        echo_change_label('~', label)
+        started = time.perf_counter()
+        try:
+            dba.validate_constraint(pending['relation'], pending['constraint_name'])
+        except psycopg2.Error as e:
+            ok = False
+            click.echo(click.style('fail', fg='red'))
+            click.echo("!!! {}".format(str(e).strip()))
+            logger.warning("Validating %s failed: %s", label, e)
+            continue
+
+        click.echo("{} ({:.1f}s)".format(click.style('ok', fg='green'), time.perf_counter() - started))
+
+    return ok
+# _____________________________________________
+
+
+def analyze_touched(dba, mods_before, jobs, budget):
+    '''
+    ANALYZEs in parallel the relations modified since *mods_before*
+    '''
+    time.sleep(STATS_FLUSH_DELAY)
+    relations = touched_relations(mods_before, modification_counts(dba.conn))
+    if not relations:
+        return
+
+    click.echo("Analyzing {} modified relations".format(len(relations)))
+    analyzer = ParallelAnalyzer(lambda: dba.connectdb(dba.connected_dsn), parallelism=jobs, budget=budget)
+    started = time.perf_counter()
+    results = analyzer.analyze(relations)
+
+    counts = {}
+    for result in results:
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+        logger.info("ANALYZE %s: %s in %.1fs", result['relation'], result['status'], result['seconds'])
+
+    click.echo("Analyzed {} relations in {:.1f}s{}".format(
+        counts.get('analyzed', 0),
+        time.perf_counter() - started,
+        ''.join(', {} {}'.format(n, status) for status, n in sorted(counts.items()) if status != 'analyzed')
+    ))
+# _____________________________________________
+
+
+def check_plans(queries, before, after, cost_threshold):
+    '''
+    Reports the registered queries whose plan changed or regressed.
+    Returns True if none regressed.
+    '''
+    findings = compare_plans(queries, before, after, cost_threshold)
+    notable = [f for f in findings if f['status'] != 'ok']
+    regressed = [f for f in findings if f['status'] == 'regressed']
+
+    if notable:
+        tablist = [
+            (f['query'], f['status'], f['cost_before'], f['cost_after'], '; '.join(f['notes'])) for f in notable
+        ]
+        click.echo(tabulate(tablist, headers=['Query', 'Plan', 'Cost Before', 'Cost After', 'Notes'], floatfmt=".0f"))
+    for f in regressed:
+        logger.warning("Plan of %s regressed: %s", f['query'], '; '.join(f['notes']))
+
+    click.echo("Plan check: {} queries, {} changed, {} regressed".format(
+        len(findings), len([f for f in findings if f['status'] == 'changed']), len(regressed)))
+    return not regressed
+# _____________________________________________
+
+
+def connect_standby_dba(migration, dsn):
+    return new_dba(migration).connect(dsn, autocommit=True)
+# _____________________________________________
+
+
+def echo_profile_summary(migration):
+    if migration.profiler is None or not migration.profiler.profiles:
+        return
+
+    click.echo('')
+    click.echo("Python profile by change (pstats in {}):".format(migration.profiler.outdir))
+    click.echo(tabulate(migration.profiler.summary(), headers=SUMMARY_HEADERS, floatfmt=".2f"))
+# _____________________________________________
+
+
+def echo_pending_validations(dba):
+    pending = dba.fetch_pending_validations()
+    if not pending:
+        return
+
+    tablist = [
+        (p['relation'], p['constraint_name'], p['name'], utc_to_local(p['queued']).strftime('%Y-%m-%d %H:%M:%S'))
+        for p in pending
+    ]
+    click.echo("Constraints pending validation (pgin validate):")
+    click.echo("")
+    click.echo(tabulate(tablist, headers=['Relation', 'Constraint', 'Change', 'Queued']))
+    click.echo("")
+# _____________________________________________
+
+
+def write_reports(migration, path):
+    if path is None:
+        return
+
+    with jsonlines.open(path, mode='w') as writer:
+        for report in migration.reports:
+            writer.write(report.to_dict())
+# _____________________________________________
+
+
+def revert_expanded(migration, dba):
+    '''
+    Rolls back an expand that is not going to be contracted
+    '''
+    changes = dba.fetch_expanded_changes()
+    if not changes:
+        click.echo("No expanded changes to revert")
+        return
+
+    click.echo("Reverting the expand phase of {} changes from '{}'".format(len(changes), migration.project))
+    for change_d in changes:
+        name = change_d['name']
+        changeid = str(change_d['changeid'])
+        if EXPAND not in change_phases(get_change_revert(migration, dba, name, changeid)):
+            raise ValueError("revert/{} has no expand phase".format(name))
+
+        run_change(migration, dba, 'revert', name, changeid, EXPAND)
+        dba.remove_phase(changeid, EXPAND)
+        click.echo(click.style('ok', fg='green'))
+# _____________________________________________
+
+
 def figure_revert_upto_change(dba, migration, upto):
+    """
+    The changes to revert, the last deployed first, and a message describing them.
+    Each target form resolves with a single query on the changes deploy sequence.
+    """
     logger.debug("Revert upto: %r", upto)
     pat1 = re.compile(r'^HEAD$')
     pat2 = re.compile(r'^HEAD~(\d+)$')
 
     if upto is None:
         msg = "Reverting all deployed changes from '{}'".format(migration.project)
-        return upto, msg
+        return dba.fetch_deployed_changes(), msg
 
     # check upto is tag
     name = dba.fetch_change_by_tag(upto)
     if name:
         msg = "Reverting deployed changes from '{}'. Last tag to revert: '{}'".format(
             migration.project, upto)
-        return name, msg
+        return dba.fetch_deployed_changes_since(name), msg
 
     # Figure out HEAD[~\d+] pattern passed
+    changes = None
     if pat1.match(upto):
         # last change
-        change = dba.fetch_deployed_changes(limit=1)[0]
-        name = change['name']
-        msg = "Reverting deployed changes from '{}'. Last change to revert: '{}'".format(
-            migration.project, name)
-        return name, msg
+        changes = dba.fetch_deployed_changes(limit=1)
 
     match2 = pat2.match(upto)
     if match2:
-        changes_back = match2.group(1)
+        # changes down to the one <changes_back> before the last
+        changes = dba.fetch_deployed_changes(limit=int(match2.group(1)) + 1)
 
-        # change with offset <changes_back>
-        try:
-            change = dba.fetch_deployed_changes(offset=int(changes_back), limit=1)[0]
-            name = change['name']
-            msg = "Reverting deployed changes from '{}'. Last change to revert: '{}'".format(
-                migration.project, name)
-        except IndexError:
-            msg = "Reverting all deployed changes from '{}'".format(migration.project)
-            name = None
-
-        return name, msg
+    if changes is not None:
+        msg = "Reverting deployed changes from '{}'. Last change to revert: '{}'".format(
+            migration.project, changes[-1]['name'] if changes else None)
+        return changes, msg
 
     if plan_record_exists(dba, migration, upto):
         msg = "Reverting deployed changes from '{}'. Last change to revert: '{}'".format(
             migration.project, upto)
-        return upto, msg
+        return dba.fetch_deployed_changes_since(upto), msg
 
     click.echo(message="Change '{}' not found".format(upto))
     sys.exit(0)
 # _____________________________________________
 
 
-def get_change_deploy(migration, dba, name):
-    mod = importlib.import_module('%s.deploy.%s' % (migration.workdir, name))
+def get_change_deploy(migration, dba, name, changeid=None):
+    with tracer.span('import {}'.format(name), 'import'):
+        mod = importlib.import_module('%s.deploy.%s' % (migration.workdir, name))
     deploy_cls = getattr(mod, name.capitalize())
 
     deploy = deploy_cls(
@@ -347,7 +902,12 @@ def get_change_deploy(migration, dba, name):
         project_user=migration.project_user,
         conf=migration.conf,
         conn=dba.conn,
-        logger=migration.logger
+        logger=migration.logger,
+        throttle=migration.throttle,
+        changeid=changeid,
+        direction='deploy',
+        explain=migration.explain,
+        connect=lambda: dba.connectdb(dba.connected_dsn)
     )
 
     return deploy
@@ -359,8 +919,9 @@ def generate_changeid():
 # _____________________________________________
 
 
-def get_change_revert(migration, dba, change):
-    mod = importlib.import_module('%s.revert.%s' % (migration.workdir, change))
+def get_change_revert(migration, dba, change, changeid=None):
+    with tracer.span('import {}'.format(change), 'import'):
+        mod = importlib.import_module('%s.revert.%s' % (migration.workdir, change))
     revert_cls = getattr(mod, change.capitalize())
 
     revert = revert_cls(
@@ -368,7 +929,11 @@ def get_change_revert(migration, dba, change):
         project_user=migration.project_user,
         conf=migration.conf,
         conn=dba.conn,
-        logger=migration.logger
+        logger=migration.logger,
+        throttle=migration.throttle,
+        changeid=changeid,
+        direction='revert',
+        connect=lambda: dba.connectdb(dba.connected_dsn)
     )
 
     return revert
@@ -398,6 +963,7 @@ def do_not_if_false(ctx, param, value):
 # _____________________________________________
 
 
+@traced('plan', 'plan parse')
 def plan_file_entries(plan):
     '''
     If passed change is None, the last line index is returned
@@ -420,7 +986,7 @@ def remove_from_plan(migration, name):
 
 def rename_in_plan(migration, changeid, old_name, new_name):
     click.echo("Renaming in plan file: {} to {}".format(old_name, new_name))
-    lines = plan_file_entries(plan)
+    lines = plan_file_entries(migration.plan)
     for ln in lines:
         if uuid.UUID(ln['changeid']) == uuid.UUID(changeid):
             ln['name'] = new_name
@@ -579,44 +1145,92 @@ def utc_to_local(utc_dt):
 # _____________________________________________
 
 
-def upgrade_plan_file(plan):
-    changes = plan_file_entries(plan)
+def upgrade_plan_file(migration):
+    changes = plan_file_entries(migration.plan)
     for change in changes:
         change['changeid'] = generate_changeid()
 
-    write_plan(plan, changes)
+    write_plan(migration, changes)
 
 # ============= Commands ==================
 
 
 @click.group()
 @click.version_option(get_version())
+@click.option(
+    '--log-file',
+    envvar='PGIN_LOG',
+    default=LOG_FILE,
+    help='JSON lines log file, rotated by size. If not provided, PGIN_LOG env variable value will be used.'
+)
+@click.option('-v', '--verbose', is_flag=True, help="Log to console as well")
+@click.option(
+    '--metrics-file',
+    envvar='PGIN_METRICS_FILE',
+    type=click.Path(dir_okay=False),
+    help="Write metrics there on exit, e.g. into node_exporter's textfile collector directory"
+)
+@click.option(
+    '--read-dsn',
+    envvar='PGIN_READ_DSN',
+    help="DSN for read-only commands (status, tag list), e.g. a hot standby or a multi-host "
+         "DSN with target_session_attrs=prefer-standby. Default: read_dsn in pgin.conf"
+)
+@click.option(
+    '--connection',
+    envvar='PGIN_CONNECTION',
+    default='default',
+    help="Connection profile from the [connections.<name>] sections of pgin.conf"
+)
 @click.pass_context
-def cli(ctx):
+def cli(ctx, log_file, verbose=False, metrics_file=None, read_dsn=None, connection='default'):
     """
     pgin is a command line tool for PostgreSQL DB migrations management.
     Run with Python 3.6+.
     Uses psycopg2 DB driver.
     """
-    ctx.obj = Migration()
+    set_logger('pgin', os.path.expanduser(log_file), log_to_console=verbose)
+    ctx.call_on_close(lambda: write_metrics(metrics_file))
+    try:
+        ctx.obj = Migration(connection)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='connection profile')
+    ctx.obj.read_dsn = read_dsn or (ctx.obj.conf or {}).get('read_dsn')
 # _____________________________________________
 
 
 @cli.command()
 @click.argument('name')
 @click.option('-m', '--msg', required=True, help="Short migration description")
+@click.option(
+    '--kind',
+    type=click.Choice(['phased', 'rewrite', 'partitions', 'maintenance']),
+    help="Script templates to start from: phased for an expand/contract change, "
+         "rewrite for a table altered through a shadow copy, partitions for time partition maintenance, "
+         "maintenance for VACUUM or REINDEX CONCURRENTLY run outside a transaction"
+)
 @pass_migration
-def add(migration, name, msg):
+def add(migration, name, msg, kind=None):
     """
     Adds migration script to the plan
     """
 
     os.chdir(migration.home)
     dba = connect_dba(migration)
+    if not add_change(migration, dba, name, msg, kind):
+        sys.exit(0)
+# _____________________________________________
+
+
+def add_change(migration, dba, name, msg, kind=None, params=None):
+    '''
+    Plans change *name* and creates its scripts from the templates,
+    rendered with *params*. False if the plan has it already.
+    '''
     changeid = dba.fetch_planned_changeid_by_name(name)
     if changeid:
         click.echo(message='Change {} already exists in migration plan'.format(name))
-        sys.exit(0)
+        return False
 
     changeid = generate_changeid()
     update_plan(migration, changeid, name, msg)
@@ -624,45 +1238,258 @@ def add(migration, name, msg):
 
     for direction in ['deploy', 'revert']:
         if not script_exists(migration, direction, name):
-            create_script(migration, direction, name)
+            create_script(migration, direction, name, kind, params)
 
     click.echo("Change '{}' has been added".format(name))
+    return True
+# _____________________________________________
+
+
+@cli.command()
+@click.option('--min-rows', type=int, default=10000, help="Tables smaller than this are not worth advising on")
+@click.option('--min-index-mb', type=float, default=1.0, help="Unused indexes smaller than this are left alone")
+@click.option('--add', 'scaffold', is_flag=True, help="Add the proposed changes to the plan")
+@pass_migration
+def advise(migration, min_rows=10000, min_index_mb=1.0, scaffold=False):
+    """
+    Proposes index changes from the workload statistics.
+
+    Foreign keys without a supporting index, indexes never scanned and
+    duplicate or overlapping indexes become proposed changes building or
+    dropping indexes concurrently; --add scaffolds them into the plan.
+    Tables read mostly by sequential scans are listed with their heaviest
+    statements from pg_stat_statements, when installed, for a human to index.
+    """
+    try:
+        dba = connect_dba(migration)
+        advisor = IndexAdvisor(dba.conn, min_rows=min_rows, min_index_bytes=int(min_index_mb * 1024 * 1024))
+
+        since = advisor.stats_since()
+        click.echo("# Statistics since: {}".format(since.strftime('%Y-%m-%d %H:%M:%S') if since else 'ever'))
+        click.echo("# Index usage is counted per server: check standbys before dropping")
+        click.echo("")
+
+        tables = advisor.seq_scanned_tables()
+        if tables:
+            click.echo("Tables read mostly by sequential scans:")
+            click.echo("")
+            click.echo(tabulate(
+                [(t['relation'], t['rows'], t['seq_scan'], t['idx_scan'], t['seq_tup_read']) for t in tables],
+                headers=['Relation', 'Rows', 'Seq Scans', 'Index Scans', 'Rows Read Sequentially']))
+            for t in tables:
+                for statement in t['statements']:
+                    click.echo("  {}: {:.1f}ms x {} calls: {}".format(
+                        t['relation'], statement['mean_ms'], statement['calls'], ' '.join(statement['query'].split())))
+            click.echo("")
+
+        proposals = advisor.proposals()
+        if not proposals:
+            click.echo("No index changes to propose")
+            return
+
+        click.echo("Proposed changes:")
+        click.echo("")
+        click.echo(tabulate([(p['name'], p['msg']) for p in proposals], headers=['Change', 'Message']))
+
+        if scaffold:
+            click.echo("")
+            os.chdir(migration.home)
+            for p in proposals:
+                params = {'indexes': p.get('indexes'), 'drop_indexes': p.get('drop_indexes')}
+                add_change(migration, dba, p['name'], p['msg'], params=params)
+    finally:
+        disconnect_dba(dba)
 # _____________________________________________
 
 
 @cli.command()
 @click.option('--to')
+@click.option('--progress/--no-progress', default=True, help="Report progress of long running changes")
+@click.option('--progress-interval', type=float, default=2.0, help="Seconds between progress samples")
+@click.option('--report', type=click.Path(dir_okay=False), help="Write per-change reports as JSON lines")
+@click.option('--lock-timeout', default='5s', help="lock_timeout set for every change, e.g. 5s or 500ms")
+@click.option('--retries', type=int, default=5, help="Retries on lock timeout, deadlock or serialization failure")
+@click.option('--max-blocked', type=int, help="Cancel a change blocking more than this number of sessions")
+@click.option('--max-blocked-ms', type=int, default=2000, help="... for longer than this number of milliseconds")
+@click.option('--preflight', is_flag=True, help="Probe the locks of all pending changes first, deploy only if free")
+@click.option('--max-replica-lag-bytes', type=int, help="Pause throttled migrations while replicas lag more WAL")
+@click.option('--max-replica-lag-seconds', type=float, help="Pause throttled migrations while replicas lag longer")
+@click.option('--standby-dsn', envvar='PGIN_STANDBY_DSN', help="Measure the lag on this standby")
+@click.option('--trace', type=click.Path(dir_okay=False), help="Write a Chrome trace of the deploy, for Perfetto")
+@click.option('--profile', is_flag=True, help="Run every change under cProfile")
+@click.option('--profile-dir', default='pgin-profile', type=click.Path(file_okay=False), help="Where .pstats go")
+@click.option('--profile-memory', is_flag=True, help="With --profile, trace allocations with tracemalloc as well")
+@click.option('--explain', is_flag=True, help="EXPLAIN (ANALYZE, BUFFERS) the first run of every DML statement")
+@click.option('--record-sizes', is_flag=True, help="Record size and dead tuple deltas of the relations changed")
+@click.option('--dry-run', is_flag=True, help="Run the changes in one transaction and roll it back at the end")
+@click.option('--phase', type=click.Choice(PHASES), help="Run only the expand or the contract phase of split changes")
+@click.option('--defer-validation', is_flag=True, help="Leave constraints added NOT VALID to pgin validate")
+@click.option('--analyze/--no-analyze', default=True, help="ANALYZE the relations the deploy modified, at the end")
+@click.option('--analyze-jobs', type=int, default=2, help="Connections running ANALYZE at the same time")
+@click.option('--analyze-budget', type=float, default=60.0, help="Seconds all ANALYZE runs may take together")
+@click.option('--plan-check/--no-plan-check', default=True, help="Compare the plans of the queries in queries.toml")
+@click.option(
+    '--plan-cost-threshold', type=float, default=COST_THRESHOLD, help="Cost growth factor that is a regression")
+@click.option('--fail-on-plan-regression', is_flag=True, help="Exit with 1 when a query plan regressed, for CI")
 @pass_migration
-def deploy(migration, to=None):
+def deploy(
+        migration,
+        to=None,
+        progress=True,
+        progress_interval=2.0,
+        report=None,
+        lock_timeout='5s',
+        retries=5,
+        max_blocked=None,
+        max_blocked_ms=2000,
+        preflight=False,
+        max_replica_lag_bytes=None,
+        max_replica_lag_seconds=None,
+        standby_dsn=None,
+        trace=None,
+        profile=False,
+        profile_dir='pgin-profile',
+        profile_memory=False,
+        explain=False,
+        record_sizes=False,
+        dry_run=False,
+        phase=None,
+        defer_validation=False,
+        analyze=True,
+        analyze_jobs=2,
+        analyze_budget=60.0,
+        plan_check=True,
+        plan_cost_threshold=COST_THRESHOLD,
+        fail_on_plan_regression=False):
     """
-    Deploys pending changes
+    Deploys pending changes.
+
+    Changes split into phases run them all, unless --phase is given:
+    expand runs the expand phase of split changes and all plain changes,
+    contract runs the contract phase of changes expanded before.
+    A split change counts as deployed once all its phases ran.
+
+    Per-statement timings of every change, and with --explain their plans,
+    go into the --report file.
+    With --dry-run commits are skipped and nothing is retried: migrations
+    that cannot run inside a transaction block (CONCURRENTLY, VACUUM) fail.
+
+    Constraints the changes added NOT VALID are validated once all changes
+    are in, each in its own transaction, unless --defer-validation is given.
+
+    Relations the deploy created or modified substantially, going by
+    n_mod_since_analyze in pg_stat_user_tables, are ANALYZEd at the end,
+    so the first queries after the release do not plan on stale statistics.
+
+    The critical queries registered in queries.toml of the migration home
+    are EXPLAINed before and after the deploy: a lost index scan or a cost
+    growing past --plan-cost-threshold is reported as a regression.
+    With --dry-run the plans after are taken before the rollback.
+
+    --record-sizes snapshots the size and dead tuples of the relations each
+    change touches before and after it, for pgin stats --bloat.
     """
 
+    if max_replica_lag_seconds is not None and standby_dsn:
+        # the standby knows its replay position, not how long ago the primary wrote it
+        raise click.BadParameter(
+            "the lag measured on a --standby-dsn has no seconds, use --max-replica-lag-bytes",
+            param_hint='--max-replica-lag-seconds'
+        )
+
+    if trace:
+        tracer.enable()
+
+    if profile:
+        migration.profiler = ChangeProfiler(profile_dir, memory=profile_memory)
+
+    migration.explain = explain
+    migration.record_sizes = record_sizes
+
     try:
         dba = connect_dba(migration)
+        create_pgin_metaschema(dba)
+        dba.conn.dry_run = dry_run
         to, msg = figure_deploy_to_change(dba, migration, to)
 
         click.echo(msg)
 
-        changes = plan_file_entries(conf)
+        if progress:
+            migration.monitor_dba = connect_monitor_dba(migration)
+            migration.progress_interval = progress_interval
 
-        for line in changes:
-            changeid = line['changeid']
-            if change_deployed(migration, changeid):
-                continue
+        migration.lockguard = LockGuard(
+            lock_timeout=lock_timeout,
+            # a retry rolls back, which in a dry run drops the earlier changes as well
+            retries=0 if dry_run else retries,
+            max_blocked=max_blocked,
+            max_blocked_ms=max_blocked_ms
+        )
+        if max_blocked is not None:
+            migration.watchdog_dba = connect_monitor_dba(migration)
+
+        if max_replica_lag_bytes is not None or max_replica_lag_seconds is not None:
+            migration.throttle_dba = connect_monitor_dba(migration)
+            if standby_dsn:
+                migration.standby_dba = connect_standby_dba(migration, standby_dsn)
+            migration.throttle = ReplicationThrottle(
+                dba=migration.throttle_dba,
+                standby_dba=migration.standby_dba,
+                max_lag_bytes=max_replica_lag_bytes,
+                max_lag_seconds=max_replica_lag_seconds
+            )
+
+        pending = pending_changes(dba, migration, to)
+        if preflight and not run_preflight(migration, dba, pending):
+            click.echo(click.style("Conflicting locks found, nothing deployed", fg='red'))
+            sys.exit(1)
+
+        mods_before = modification_counts(dba.conn) if analyze and pending else None
+
+        queries = load_registry(os.path.join(migration.home, QUERIES_FILE)) if plan_check and pending else []
+        plans_before = capture_plans(dba.conn, queries) if queries else None
+        dba.conn.commit()
 
+        phases_done = dba.fetch_phases()
+        for line in pending:
+            changeid = line['changeid']
             name = line['name']
-            deploy = get_change_deploy(migration, dba, name)
+            phases = change_phases(get_change_deploy(migration, dba, name, changeid))
+            done = phases_done.setdefault(uuid.UUID(changeid).hex, set())
+
+            for change_phase in phases_to_deploy(phases, phase, done):
+                change_report = run_change(migration, dba, 'deploy', name, changeid, change_phase)
+                for validation in change_report.data.get('validations', []):
+                    dba.queue_validation(changeid, validation['relation'], validation['constraint'])
+                if change_phase is not None:
+                    dba.apply_phase(changeid, change_phase)
+                    done.add(change_phase)
+                echo_change_ok(change_report)
+
+            if phases and not set(phases) <= done:
+                continue
+            if not phases and phase == CONTRACT:
+                continue
 
-            click.echo(message="+ {} {} ".format(name, '.' * (MSG_LENGTH - len(name))), nl=False)
-            deploy()
             dba.apply_change(changeid, name)
             if 'tag' in line:
                 dba.apply_tag(changeid, line['tag'], line['tagmsg'])
 
-            click.echo(click.style('ok', fg='green'))
-            if name == to:
-                break
+        validated = True
+        if dry_run:
+            plans_after = capture_plans(dba.conn, queries) if queries else None
+            dba.conn.rollback()
+            click.echo("Dry run, all changes rolled back")
+        else:
+            validated = defer_validation or validate_pending(dba)
+            if mods_before is not None:
+                analyze_touched(dba, mods_before, analyze_jobs, analyze_budget)
+            plans_after = capture_plans(dba.conn, queries) if queries else None
+            dba.conn.commit()
+
+        plans_ok = plans_before is None or check_plans(queries, plans_before, plans_after, plan_cost_threshold)
+        if not validated or (fail_on_plan_regression and not plans_ok):
+            sys.exit(1)
 
     except psycopg2.ProgrammingError as pe:
         click.echo(click.style('fail', fg='red'))
@@ -675,6 +1502,15 @@ def deploy(migration, to=None):
     else:
         sys.exit(0)
     finally:
+        write_reports(migration, report)
+        if trace:
+            tracer.dump(trace)
+        echo_profile_summary(migration)
+        if migration.throttle is not None and migration.throttle.throttled:
+            click.echo("Throttled on replication lag for {:.1f}s in total".format(migration.throttle.throttled))
+        for side_dba in [migration.monitor_dba, migration.watchdog_dba, migration.throttle_dba, migration.standby_dba]:
+            if side_dba is not None:
+                disconnect_dba(side_dba)
         disconnect_dba(dba)
 # _____________________________________________
 
@@ -702,13 +1538,15 @@ def deploy(migration, to=None):
     help='Pgin project top directory. If not provided, PGIN_TOPDIR env variable value will be used'
 )
 @click.option('--newdb', is_flag=True, required=False, help="If set to TRUE drops and re-creates existent DB")
-def init(project, dbuser, topdir, newdb=False):
+@pass_migration
+def init(migration, project, dbuser, topdir, newdb=False):
     """
         Initiates the project DB migrations.
     """
 
     conf = init_config(project, dbuser, topdir)
-    init_db(conf, newdb)
+    migration.set_conf(conf)
+    init_db(migration, newdb)
 # _____________________________________________
 
 
@@ -729,13 +1567,13 @@ def remove(migration, name):
             click.echo("Change {} not found in migration plan".format(name))
             sys.exit(0)
 
-        if change_deployed(migration, changeid):
+        if dba.fetch_change_deployed(changeid):
             click.echo("Cannot remove a deployed change {}. Revert first".format(name))
             sys.exit(1)
 
         click.echo("Removing change %s from migration plan" % name)
-        remove_from_plan(migration, changeid)
-        dba.remove_change_from_plan(changeid)
+        remove_from_plan(migration, name)
+        dba.remove_change_from_plan(name)
     finally:
         disconnect_dba(dba)
 
@@ -777,29 +1615,36 @@ def rename(migration, old_name, new_name):
 @click.option('-y', '--yes', is_flag=True, callback=do_not_if_false, expose_value=False, prompt='Revert?')
 @pass_migration
 @click.option('--to')
-def revert(migration, to=None):
+@click.option('--phase', type=click.Choice([EXPAND]), help="Undo the expand phase of changes not contracted yet")
+def revert(migration, to=None, phase=None):
     """
-    Revert deployed
+    Revert deployed.
+    Changes split into phases undo them in reverse order, contract first.
     """
     try:
 
         dba = connect_dba(migration)
-        to, msg = figure_revert_upto_change(dba, migration, to)
+        create_pgin_metaschema(dba)
+
+        if phase == EXPAND:
+            revert_expanded(migration, dba)
+            return
+
+        changes, msg = figure_revert_upto_change(dba, migration, to)
 
         click.echo(msg)
 
-        changes = dba.fetch_deployed_changes()
+        if not changes:
+            click.echo("Nothing to revert")
 
         for change_d in changes:
             name = change_d['name']
             changeid = change_d['changeid']
-            click.echo(message="- %s %s " % (name, '.' * (MSG_LENGTH - len(name))), nl=False)
-            revert = get_change_revert(migration, dba, name)
-            revert()
+            phases = change_phases(get_change_revert(migration, dba, name, changeid))
+            for change_phase in reversed(phases or (None,)):
+                run_change(migration, dba, 'revert', name, changeid, change_phase)
+                click.echo(click.style('ok', fg='green'))
             dba.remove_change(changeid)
-            click.echo(click.style('ok', fg='green'))
-            if name == to:
-                break
 
     except Exception:
         click.echo(click.style('fail', fg='red'))
@@ -810,39 +1655,104 @@ def revert(migration, to=None):
 
 
 @cli.command()
+@click.option('-y', '--yes', is_flag=True, callback=do_not_if_false, expose_value=False, prompt='Reset DB?')
+@click.option('--template', help="Re-clone the DB from this migrated template DB. Default: 'template' in pgin.conf")
 @pass_migration
-def status(migration):
+def reset(migration, template=None):
     """
-    Report deployment status
+    Fast revert-all of a disposable DB.
+
+    Instead of running every revert script, either drops and re-creates
+    the project schema, or, with a template, drops the whole DB and clones
+    it from the template. The meta schema is rewritten to match and the
+    plan file is synced into it.
+
+    Allowed only with 'disposable = true' in pgin.conf.
     """
 
+    if not migration.conf or not migration.conf.get('disposable'):
+        click.echo("DB {} is not marked disposable in pgin.conf, use revert instead".format(migration.project))
+        sys.exit(1)
+
+    if template is None:
+        template = migration.conf.get('template')
+
+    dba = new_dba(migration)
     try:
+        dba.revoke_connect_from_db()
+
+        if template:
+            click.echo("Re-cloning DB {} from template {}".format(migration.project, template))
+            dba.dropdb()
+            dba.createdb(template=template)
+            dba.grant_connect_to_db()
+
         dba = connect_dba(migration)
-        click.echo("# On database: {}".format(migration.project))
+
+        if template:
+            dba.rename_meta_schema_from(template)
+        else:
+            click.echo("Re-creating schema {}".format(migration.project))
+            dba.recreate_schema(migration.project)
+            dba.drop_meta_schema()
+
+        create_pgin_metaschema(dba)
+        populate_plan_table(dba, migration.plan)
 
         last_deployed_change = dba.fetch_last_deployed_change()
         if last_deployed_change:
+            click.echo("Reset to change '{}'".format(last_deployed_change['name']))
+        else:
+            click.echo("Reset to an empty DB")
+    finally:
+        if dba.conn is not None:
+            disconnect_dba(dba)
+# _____________________________________________
+
+
+@cli.command()
+@pass_migration
+def status(migration):
+    """
+    Report deployment status
+    """
+
+    try:
+        dba = connect_read_dba(migration)
+        click.echo("# On database: {}".format(migration.project))
+
+        snapshot = dba.fetch_deployment_snapshot()
+        deployed = [c for c in snapshot if c['deployed']]
+        if deployed:
+            last_deployed_change = deployed[-1]
             click.echo("# Last Change ID: {}".format(last_deployed_change['changeid']))
             click.echo("# Last Change Name: {}".format(last_deployed_change['name']))
             dt = utc_to_local(last_deployed_change['applied']).strftime('%Y-%m-%d %H:%M:%S')
             click.echo("# Applied: {}".format(dt))
             click.echo('')
 
-        lines = plan_file_entries(migration)
-        undeployed = []
-        for line in lines:
-            if not change_deployed(migration, line['changeid']):
-                undeployed.append(line)
+        # plan file ids are uuid hex, the DB returns them hyphenated
+        deployed_ids = set(uuid.UUID(str(c['changeid'])).hex for c in deployed)
+        lines = plan_file_entries(migration.plan)
+        undeployed = [line for line in lines if uuid.UUID(line['changeid']).hex not in deployed_ids]
+
+        # phases completed by changes split into expand/contract
+        phases = {c['name']: ', '.join(c['phases']) or None for c in snapshot}
+
+        echo_pending_validations(dba)
 
-        if len(undeployed) == len(lines):
+        if len(undeployed) == len(lines) and not any(phases.values()):
             click.echo("No changes deployed")
             sys.exit(0)
 
         if len(undeployed):
-            tablist = [(c['name'], c['msg'], c.get('tag'), c.get('tagmsg')) for c in undeployed]
+            tablist = [
+                (c['name'], c['msg'], phases.get(c['name']), c.get('tag'), c.get('tagmsg')) for c in undeployed
+            ]
             click.echo("Undeployed changes:")
             click.echo("")
-            click.echo(tabulate(tablist, headers=['Change', 'Message', 'Tag', 'Tag Message'], floatfmt=".1f"))
+            click.echo(tabulate(
+                tablist, headers=['Change', 'Message', 'Phases Done', 'Tag', 'Tag Message'], floatfmt=".1f"))
         else:
             click.echo("Nothing to deploy (up-to-date)")
     finally:
@@ -850,6 +1760,243 @@ def status(migration):
 # _____________________________________________
 
 
+@cli.command()
+@click.option('--relation', help="Validate the constraints of this table only")
+@click.option('--lock-timeout', default='5s', help="lock_timeout for each VALIDATE CONSTRAINT")
+@pass_migration
+def validate(migration, relation=None, lock_timeout='5s'):
+    """
+    Validates constraints deployed NOT VALID.
+
+    VALIDATE CONSTRAINT scans the table holding SHARE UPDATE EXCLUSIVE,
+    which lets reads and writes through, each constraint in its own transaction.
+    """
+    try:
+        dba = connect_dba(migration)
+        create_pgin_metaschema(dba)
+        dba.set_lock_timeout(lock_timeout)
+        if not dba.fetch_pending_validations(relation):
+            click.echo("No constraints pending validation")
+            sys.exit(0)
+
+        sys.exit(0 if validate_pending(dba, relation) else 1)
+    finally:
+        disconnect_dba(dba)
+# _____________________________________________
+
+
+@cli.command()
+@click.option('--lock-timeout', default='5s', help="lock_timeout for attaching and detaching partitions")
+@pass_migration
+def partitions(migration, lock_timeout='5s'):
+    """
+    Re-runs the partition maintenance of deployed changes.
+
+    Pre-creates the future partitions and detaches the expired ones
+    declared by every deployed change with partitions; safe to run
+    from cron as often as wanted.
+    """
+    try:
+        dba = connect_dba(migration)
+        create_pgin_metaschema(dba)
+        dba.set_lock_timeout(lock_timeout)
+
+        actions = []
+        for change_d in reversed(dba.fetch_deployed_changes()):
+            change = get_change_deploy(migration, dba, change_d['name'], str(change_d['changeid']))
+            if change.partitions:
+                actions.extend(change.maintain_partitions())
+
+        for action in actions:
+            click.echo("{action} {partition}".format(**action))
+        if not actions:
+            click.echo("Partitions up to date")
+    except Exception:
+        click.echo(click.style('fail', fg='red'))
+        logger.exception("Exception in partitions")
+        sys.exit(1)
+    finally:
+        disconnect_dba(dba)
+# _____________________________________________
+
+
+@cli.command()
+@click.option('--wal', is_flag=True, help="WAL generated by the deployed changes, per tag")
+@click.option('--predict', is_flag=True, help="With --wal: deploy the pending changes on a template clone and measure")
+@click.option('--template', help="DB to clone for --predict. Default: 'template' in pgin.conf")
+@click.option('--scale', type=float, default=1.0, help="Multiply the measured WAL, for a template holding a sample")
+@click.option('--bloat', is_flag=True, help="Table and index growth and dead tuples left by the deployed changes")
+@click.option('--add', 'scaffold', is_flag=True, help="With --bloat: add the suggested maintenance changes to the plan")
+@pass_migration
+def stats(migration, wal=False, predict=False, template=None, scale=1.0, bloat=False, scaffold=False):
+    """
+    Reports resource usage recorded by deploys.
+
+    --wal totals the WAL each deployed change generated per tag: bytes
+    from the LSN before and after the change, records and full-page
+    images from pg_stat_wal (PostgreSQL 14+, cluster wide, so concurrent
+    activity counts in). --predict deploys the pending changes on a clone
+    of --template and reports what they generated there.
+
+    --bloat lists the relations the latest deploy of each change grew
+    the most, from sizes and dead tuples taken before and after it by
+    deploy --record-sizes, and suggests VACUUM or REINDEX CONCURRENTLY
+    follow-ups; --add scaffolds them as maintenance changes.
+    """
+    if bloat:
+        report_bloat(migration, scaffold)
+        if not wal:
+            return
+
+    if not wal:
+        click.echo("Nothing to report, pick one of: --wal, --bloat")
+        sys.exit(1)
+
+    if predict:
+        template = template or migration.conf.get('template')
+        if not template:
+            raise click.BadParameter("--predict needs --template or 'template' in pgin.conf", param_hint='--template')
+        predict_wal(migration, template, scale)
+        return
+
+    try:
+        dba = connect_read_dba(migration)
+        totals = dba.fetch_wal_by_tag()
+        if not totals:
+            click.echo("No WAL recorded yet")
+            return
+
+        tablist = [
+            (t['tag'] or '(untagged)', t['changes'], format_bytes(t['wal_bytes']), t['wal_records'], t['wal_fpi'],
+             t['seconds'])
+            for t in totals
+        ]
+        click.echo(tabulate(
+            tablist, headers=['Tag', 'Changes', 'WAL', 'WAL Records', 'Full Page Images', 'Seconds'], floatfmt=".1f"))
+    finally:
+        disconnect_dba(dba)
+# _____________________________________________
+
+
+def report_bloat(migration, scaffold=False):
+    '''
+    Size deltas recorded per change, with the follow-up maintenance they call for.
+    Dead tuples come from the statistics collector and may lag behind.
+    '''
+    try:
+        dba = connect_dba(migration)
+        deltas = dba.fetch_size_deltas()
+        if not deltas:
+            click.echo("No relation sizes recorded yet, deploy with --record-sizes")
+            return
+
+        tablist = []
+        followups = {}
+        for d in deltas:
+            statements = follow_ups(d)
+            for statement in statements:
+                followups.setdefault(statement, d['relation'])
+            tablist.append((
+                d['name'] if d['phase'] is None else '{} ({})'.format(d['name'], d['phase']),
+                d['relation'],
+                format_bytes(d['table_after'] - d['table_before']),
+                format_bytes(d['indexes_after'] - d['indexes_before']),
+                d['dead_after'],
+                '; '.join(statements),
+            ))
+        click.echo(tabulate(
+            tablist, headers=['Change', 'Relation', 'Table Growth', 'Index Growth', 'Dead Tuples', 'Follow-up']))
+
+        if not followups:
+            return
+
+        click.echo("")
+        click.echo("Suggested follow-up changes:")
+        for statement in followups:
+            click.echo("  {}".format(statement))
+
+        if scaffold:
+            click.echo("")
+            os.chdir(migration.home)
+            by_relation = {}
+            for statement, relation in followups.items():
+                by_relation.setdefault(relation, []).append(statement)
+            for relation, statements in by_relation.items():
+                name = change_name('maintain', relation)
+                msg = "Maintenance of {}: {}".format(relation, ', '.join(s.split(' ')[0] for s in statements))
+                add_change(migration, dba, name, msg, kind='maintenance', params={'statements': statements})
+    finally:
+        disconnect_dba(dba)
+# _____________________________________________
+
+
+def predict_wal(migration, template, scale):
+    '''
+    Deploys the pending changes on a throwaway clone of *template*,
+    a DB with the data of production or a sample of it, and reports
+    the WAL each one generated there, multiplied by *scale*
+    '''
+    clone = DBAdmin('{}_pgin_predict'.format(migration.project), migration.project_user, migration.profile)
+    # the migrations address the project meta schema
+    clone.meta_schema = 'pgin_{}'.format(migration.project)
+    click.echo("Cloning {} from template {}".format(clone.dbname, template))
+    clone.dropdb()
+    clone.createdb(template=template)
+
+    rows = []
+    try:
+        clone.connect()
+        clone.set_search_path(migration.project)
+        clone.rename_meta_schema_from(template)
+        create_pgin_metaschema(clone)
+        for line in plan_file_entries(migration.plan):
+            clone.apply_planned(line['changeid'], line['name'], line['msg'])
+
+        for line in pending_changes(clone, migration, None):
+            changeid = line['changeid']
+            name = line['name']
+            phases = change_phases(get_change_deploy(migration, clone, name, changeid))
+            for change_phase in phases or (None,):
+                report = run_change(migration, clone, 'deploy', name, changeid, change_phase)
+                echo_change_ok(report)
+                rows.append((
+                    report.name,
+                    format_bytes(report.data['wal_bytes'] * scale),
+                    report.data.get('wal_records'),
+                    report.data.get('wal_fpi'),
+                    report.duration,
+                ))
+            clone.apply_change(changeid, name)
+    finally:
+        if clone.conn is not None:
+            disconnect_dba(clone)
+        clone.dropdb()
+
+    if not rows:
+        click.echo("Nothing to deploy (up-to-date)")
+        return
+
+    click.echo("")
+    click.echo(tabulate(
+        rows, headers=['Change', 'Predicted WAL', 'WAL Records', 'Full Page Images', 'Seconds'], floatfmt=".1f"))
+    if scale != 1.0:
+        click.echo("WAL scaled x{}; records and full-page images as measured on the clone".format(scale))
+# _____________________________________________
+
+
+def format_bytes(n):
+    if n is None:
+        return None
+
+    for unit in ['B', 'kB', 'MB', 'GB']:
+        if abs(n) < 1024:
+            return '{:.1f} {}'.format(n, unit)
+        n /= 1024.0
+
+    return '{:.1f} TB'.format(n)
+# _____________________________________________
+
+
 @cli.command()
 @pass_migration
 def sync(migration):
@@ -860,7 +2007,7 @@ def sync(migration):
     try:
         dba = connect_dba(migration)
         create_pgin_metaschema(dba)
-        populate_plan_table(migration, dba)
+        populate_plan_table(dba, migration.plan)
     finally:
         disconnect_dba(dba)
 # _____________________________________________
@@ -909,7 +2056,10 @@ def tag_add(migration, tag, msg, change=None):
     write_plan(migration, lines)
 
     dba = connect_dba(migration)
-    dba.apply_tag(change_line['changeid'], tag, msg)
+    try:
+        dba.apply_tag(change_line['changeid'], tag, msg)
+    finally:
+        disconnect_dba(dba)
 
     click.echo(click.style("Tag '{}' was applied to change '{}'".format(tag, change_line['name']), fg='green'))
 # _____________________________________________
@@ -923,9 +2073,13 @@ def tag_list(migration):
     If no change passed, the tag is applied to the last change
     """
 
-    dba = connect_dba(migration)
-    tags = dba.fetch_tags()
-    tag_list = [(t['name'], t['tag'], t['tagmsg']) for t in tags]
+    dba = connect_read_dba(migration)
+    try:
+        tags = dba.fetch_tags()
+    finally:
+        disconnect_dba(dba)
+
+    tag_list = [(t['change'], t['tag'], t['tagmsg']) for t in tags]
     click.echo(tabulate(tag_list, headers=['Change', 'Tag', 'Message'], floatfmt=".1f"))
 # _____________________________________________
 
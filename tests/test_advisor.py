@@ -0,0 +1,82 @@
+from pgin.lib.advisor import IndexAdvisor, change_name, index_name_for, NAME_LENGTH
+# ==============================================================
+
+
+class FakeConnection:
+
+    def cursor(self, cursor_factory=None):
+        return None
+# _____________________________
+
+
+class StaticAdvisor(IndexAdvisor):
+    """
+    Answers from canned statistics instead of the catalog
+    """
+
+    def __init__(self, foreign_keys=(), unused=(), redundant=()):
+        super(StaticAdvisor, self).__init__(FakeConnection())
+        self.foreign_keys = list(foreign_keys)
+        self.unused = list(unused)
+        self.redundant = list(redundant)
+
+    def unindexed_foreign_keys(self):
+        return self.foreign_keys
+
+    def unused_indexes(self):
+        return self.unused
+
+    def redundant_indexes(self):
+        return self.redundant
+# ==============================================================
+
+
+def test_change_name():
+    assert change_name('index', 'public.Orders', 'customer_id') == 'index_public_orders_customer_id'
+    assert len(change_name('drop', 'x' * 80)) == NAME_LENGTH
+    assert not change_name('drop', 'a' * 49, '__b').endswith('_')
+# _____________________________
+
+
+def test_index_name_for():
+    assert index_name_for('public.order_lines', ['order_id', 'line']) == 'order_lines_order_id_line_idx'
+    assert len(index_name_for('t', ['c' * 80])) == 63
+# _____________________________
+
+
+def test_proposes_foreign_key_index():
+    advisor = StaticAdvisor(foreign_keys=[
+        {'relation': 'public.order_lines', 'constraint_name': 'order_lines_order_id_fkey', 'columns': ['order_id']},
+    ])
+    assert advisor.proposals() == [{
+        'name': 'index_public_order_lines_order_id',
+        'msg': 'Index foreign key order_lines_order_id_fkey of public.order_lines',
+        'indexes': [{'name': 'order_lines_order_id_idx', 'table': 'public.order_lines', 'columns': 'order_id'}],
+    }]
+# _____________________________
+
+
+def test_proposes_each_dropped_index_once():
+    definition = 'CREATE INDEX orders_created_idx ON public.orders USING btree (created)'
+    row = {'relation': 'public.orders', 'index': 'public.orders_created_idx', 'definition': definition}
+    advisor = StaticAdvisor(unused=[row], redundant=[dict(row, covered_by='public.orders_created_id_idx')])
+
+    proposals = advisor.proposals()
+    assert len(proposals) == 1
+    assert proposals[0]['name'] == 'drop_public_orders_created_idx'
+    assert proposals[0]['msg'] == 'Drop never scanned index public.orders_created_idx'
+    assert proposals[0]['drop_indexes'] == [
+        {'name': 'public.orders_created_idx', 'table': 'public.orders', 'definition': definition}]
+# _____________________________
+
+
+def test_redundant_names_the_covering_index():
+    row = {
+        'relation': 'orders',
+        'index': 'orders_customer_idx',
+        'covered_by': 'orders_customer_created_idx',
+        'definition': 'CREATE INDEX orders_customer_idx ON public.orders USING btree (customer_id)',
+    }
+    proposals = StaticAdvisor(redundant=[row]).proposals()
+    assert proposals[0]['msg'] == 'Drop redundant index orders_customer_idx, covered by orders_customer_created_idx'
+# ==============================================================
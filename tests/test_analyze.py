@@ -0,0 +1,41 @@
+from pgin.lib.analyze import ANALYZE_MIN_ROWS, touched_relations
+# ==============================================================
+
+
+def test_modified_enough():
+    before = {'public.orders': (10, 1000000), 'public.small': (0, 100)}
+    after = {'public.orders': (10 + ANALYZE_MIN_ROWS, 1000000), 'public.small': (20, 100)}
+    assert touched_relations(before, after) == ['public.orders', 'public.small']
+# _____________________________
+
+
+def test_below_thresholds_left_alone():
+    before = {'public.orders': (0, 1000000)}
+    after = {'public.orders': (ANALYZE_MIN_ROWS - 1, 1000000)}
+    assert touched_relations(before, after) == []
+# _____________________________
+
+
+def test_most_modified_first():
+    before = {}
+    after = {'public.a': (2000, 0), 'public.b': (5000, 0), 'public.c': (3000, 0)}
+    assert touched_relations(before, after) == ['public.b', 'public.c', 'public.a']
+# _____________________________
+
+
+def test_created_relation_counts_from_zero():
+    assert touched_relations({}, {'app.new_table': (5, 5)}) == ['app.new_table']
+# _____________________________
+
+
+def test_analyze_in_between_resets_the_counter():
+    before = {'public.orders': (50000, 1000000)}
+    after = {'public.orders': (ANALYZE_MIN_ROWS, 1000000)}
+    assert touched_relations(before, after) == ['public.orders']
+# _____________________________
+
+
+def test_unmodified_left_alone():
+    counts = {'public.orders': (100, 1000)}
+    assert touched_relations(counts, dict(counts)) == []
+# ==============================================================
@@ -0,0 +1,66 @@
+import sys
+import json
+import logging
+from pgin.lib import applogging
+from pgin.lib.applogging import JsonLinesFormatter, DeferredQueueHandler
+# ==============================================================
+
+
+def record(msg, args=(), **extra):
+    rec = logging.LogRecord('pgin', logging.WARNING, __file__, 10, msg, args, None, func='deploy')
+    rec.__dict__.update(extra)
+    return rec
+# ==============================================================
+
+
+def test_json_line():
+    entry = json.loads(JsonLinesFormatter().format(record("Change %s failed", ('add_column',))))
+    assert entry['level'] == 'WARNING'
+    assert entry['logger'] == 'pgin'
+    assert entry['func'] == 'deploy'
+    assert entry['msg'] == 'Change add_column failed'
+    assert 'event' not in entry
+    assert 'exc' not in entry
+# _____________________________
+
+
+def test_json_line_event():
+    event = {'event': 'watchdog_cancel', 'pid': 42}
+    entry = json.loads(JsonLinesFormatter().format(record("Cancelling", event=event)))
+    assert entry['event'] == event
+# _____________________________
+
+
+def test_json_line_exception():
+    try:
+        raise ValueError('boom')
+    except ValueError:
+        rec = logging.LogRecord('pgin', logging.ERROR, __file__, 10, 'failed', (), sys.exc_info())
+    entry = json.loads(JsonLinesFormatter().format(rec))
+    assert 'ValueError: boom' in entry['exc']
+# _____________________________
+
+
+def test_deferred_handler_keeps_record_unformatted():
+    rec = record("Change %s failed", ('add_column',))
+    queued = DeferredQueueHandler(None).prepare(rec)
+    assert queued is not rec
+    assert queued.msg == "Change %s failed"
+    assert queued.args == ('add_column',)
+# _____________________________
+
+
+def test_set_logger_writes_json_lines(tmp_path):
+    path = tmp_path / 'log' / 'pgin.log'
+    logger = applogging.set_logger('pgin-test', str(path))
+    try:
+        logger.info("Deployed %d changes", 3)
+        logger.debug("detail", extra={'event': {'event': 'change'}})
+    finally:
+        applogging.stop_listener()
+        applogging.clean_logger(logger)
+
+    lines = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [e['msg'] for e in lines] == ['Deployed 3 changes', 'detail']
+    assert lines[1]['event'] == {'event': 'change'}
+# ==============================================================
@@ -0,0 +1,45 @@
+from pgin.lib.bloat import follow_ups
+# ==============================================================
+
+MB = 1024 * 1024
+
+
+def row(**kwargs):
+    values = {
+        'relation': 'public.orders',
+        'table_before': 100 * MB,
+        'table_after': 100 * MB,
+        'indexes_before': 50 * MB,
+        'indexes_after': 50 * MB,
+        'dead_after': 0,
+        'live_after': 1000000,
+    }
+    values.update(kwargs)
+    return values
+# _____________________________
+
+
+def test_nothing_to_follow_up():
+    assert follow_ups(row()) == []
+# _____________________________
+
+
+def test_dead_tuples_vacuum():
+    assert follow_ups(row(dead_after=300000)) == ['VACUUM (ANALYZE) public.orders']
+    assert follow_ups(row(dead_after=100000)) == []
+# _____________________________
+
+
+def test_index_growth_reindex():
+    assert follow_ups(row(indexes_after=90 * MB)) == ['REINDEX TABLE CONCURRENTLY public.orders']
+# _____________________________
+
+
+def test_index_growing_with_the_table_left_alone():
+    assert follow_ups(row(table_after=200 * MB, indexes_after=90 * MB)) == []
+# _____________________________
+
+
+def test_new_relation():
+    assert follow_ups(row(table_before=0, indexes_before=0, indexes_after=90 * MB)) == []
+# ==============================================================
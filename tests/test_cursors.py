@@ -0,0 +1,25 @@
+from pgin.lib.cursors import fingerprint
+# ==============================================================
+
+
+def test_literals_and_placeholders_fold():
+    one = fingerprint("SELECT * FROM orders WHERE id = 42 AND status = 'new'")
+    other = fingerprint("SELECT * FROM orders WHERE id = %s AND status = %(status)s")
+    assert one == other
+    assert one[1] == 'SELECT * FROM orders WHERE id = ? AND status = ?'
+# _____________________________
+
+
+def test_in_lists_fold():
+    assert fingerprint("DELETE FROM t WHERE id IN (1, 2, 3)")[1] == fingerprint("DELETE FROM t WHERE id IN (%s)")[1]
+# _____________________________
+
+
+def test_comments_and_whitespace_ignored():
+    assert fingerprint("SELECT a -- why\n  FROM t /* hint */")[1] == 'SELECT a FROM t'
+# _____________________________
+
+
+def test_different_statements_differ():
+    assert fingerprint("SELECT a FROM t")[0] != fingerprint("SELECT b FROM t")[0]
+# ==============================================================
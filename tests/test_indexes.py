@@ -0,0 +1,48 @@
+from pgin.lib.indexes import create_index_statement, index_name
+# ==============================================================
+
+
+def test_statement_from_spec():
+    index = {'name': 'orders_created_idx', 'table': 'public.orders', 'columns': 'created'}
+    assert create_index_statement(index) == (
+        'CREATE INDEX CONCURRENTLY orders_created_idx ON public.orders (created)')
+# _____________________________
+
+
+def test_statement_from_full_spec():
+    index = {
+        'name': 'orders_key',
+        'table': 'orders',
+        'columns': 'customer_id, key',
+        'unique': True,
+        'method': 'btree',
+        'include': 'total',
+        'where': 'deleted IS NULL',
+    }
+    assert create_index_statement(index) == (
+        'CREATE UNIQUE INDEX CONCURRENTLY orders_key ON orders USING btree (customer_id, key) '
+        'INCLUDE (total) WHERE deleted IS NULL')
+# _____________________________
+
+
+def test_statement_from_definition():
+    index = {
+        'name': 'orders_key',
+        'table': 'public.orders',
+        'definition': 'CREATE UNIQUE INDEX orders_key ON public.orders USING btree (key)',
+    }
+    assert create_index_statement(index) == (
+        'CREATE UNIQUE INDEX CONCURRENTLY orders_key ON public.orders USING btree (key)')
+# _____________________________
+
+
+def test_statement_from_concurrent_definition():
+    definition = 'CREATE INDEX CONCURRENTLY orders_created_idx ON orders USING btree (created)'
+    assert create_index_statement({'name': 'orders_created_idx', 'definition': definition}) == definition
+# _____________________________
+
+
+def test_index_name():
+    assert index_name('orders_created_idx') == 'orders_created_idx'
+    assert index_name({'name': 'orders_created_idx', 'table': 'orders'}) == 'orders_created_idx'
+# ==============================================================
@@ -0,0 +1,104 @@
+import psycopg2
+from psycopg2 import errorcodes
+from pgin.lib.lockguard import LockGuard, LockWatchdog
+# ==============================================================
+
+
+class PgError(psycopg2.Error):
+
+    def __init__(self, pgcode):
+        super(PgError, self).__init__()
+        self._pgcode = pgcode
+
+    @property
+    def pgcode(self):
+        return self._pgcode
+# _____________________________
+
+
+class FakeDBA:
+
+    def __init__(self, blocked):
+        self.blocked = blocked
+        self.cancelled = []
+
+    def fetch_blocked_by(self, pid):
+        return [{'pid': p} for p in self.blocked]
+
+    def cancel_backend(self, pid):
+        self.cancelled.append(pid)
+# _____________________________
+
+
+class Change:
+    lock_timeout = '5s'
+# ==============================================================
+
+
+def test_backoff_grows_and_is_capped(monkeypatch):
+    monkeypatch.setattr('random.uniform', lambda low, high: high)
+    guard = LockGuard(backoff_base=0.5, backoff_cap=3.0)
+    assert [guard.backoff(a) for a in range(5)] == [0.5, 1.0, 2.0, 3.0, 3.0]
+# _____________________________
+
+
+def test_backoff_jitter_within_bounds():
+    guard = LockGuard(backoff_base=1.0, backoff_cap=30.0)
+    for _ in range(100):
+        assert 0 <= guard.backoff(2) <= 4.0
+# _____________________________
+
+
+def test_retry_reason():
+    guard = LockGuard()
+    assert guard.retry_reason(PgError(errorcodes.LOCK_NOT_AVAILABLE)) == 'lock timeout'
+    assert guard.retry_reason(PgError(errorcodes.DEADLOCK_DETECTED)) == 'deadlock'
+    assert guard.retry_reason(PgError(errorcodes.UNIQUE_VIOLATION)) is None
+    assert guard.retry_reason(ValueError()) is None
+# _____________________________
+
+
+def test_retry_reason_cancel_only_by_watchdog():
+    guard = LockGuard()
+    watchdog = LockWatchdog(FakeDBA([]), 42, 'add_column', max_blocked=0, max_blocked_ms=0)
+    error = PgError(errorcodes.QUERY_CANCELED)
+    assert guard.retry_reason(error, watchdog) is None
+
+    watchdog.cancelled = {'event': 'watchdog_cancel'}
+    assert guard.retry_reason(error, watchdog) == 'cancelled by lock watchdog'
+# _____________________________
+
+
+def test_change_lock_timeout_override():
+    guard = LockGuard(lock_timeout='2s')
+    assert guard.change_lock_timeout(Change()) == '5s'
+    assert guard.change_lock_timeout(object()) == '2s'
+# _____________________________
+
+
+def test_watchdog_cancels_blocking_backend():
+    dba = FakeDBA([101, 102, 103])
+    watchdog = LockWatchdog(dba, 42, 'add_column', max_blocked=2, max_blocked_ms=0, interval=0.01)
+    watchdog.start()
+    watchdog.join(timeout=5)
+
+    assert dba.cancelled == [42]
+    assert watchdog.cancelled['blocked'] == 3
+    assert watchdog.cancelled['blocked_pids'] == [101, 102, 103]
+# _____________________________
+
+
+def test_watchdog_tolerates_few_blocked():
+    dba = FakeDBA([101])
+    watchdog = LockWatchdog(dba, 42, 'add_column', max_blocked=2, max_blocked_ms=0, interval=0.01)
+    watchdog.start()
+    watchdog.stop()
+
+    assert dba.cancelled == []
+    assert watchdog.cancelled is None
+# _____________________________
+
+
+def test_no_watchdog_without_limit():
+    assert LockGuard().start_watchdog(FakeDBA([101]), 42, 'add_column') is None
+# ==============================================================
@@ -0,0 +1,85 @@
+import math
+from pgin.lib.metrics import Registry, escape_label, format_value
+# ==============================================================
+
+
+def test_render_counter_samples():
+    registry = Registry()
+    changes = registry.counter('pgin_changes_total', 'Changes executed', ['direction', 'status'])
+    changes.inc(direction='deploy', status='ok')
+    changes.inc(2, direction='deploy', status='ok')
+    changes.inc(direction='revert', status='failed')
+
+    lines = registry.render().splitlines()
+    assert 'pgin_changes_total{direction="deploy",status="ok"} 3' in lines
+    assert 'pgin_changes_total{direction="revert",status="failed"} 1' in lines
+# _____________________________
+
+
+def test_render_counter_family():
+    registry = Registry()
+    registry.counter('pgin_commits_total', 'Transactions committed').inc()
+
+    assert registry.render() == (
+        '# HELP pgin_commits Transactions committed\n'
+        '# TYPE pgin_commits counter\n'
+        'pgin_commits_total 1\n'
+        '# EOF\n'
+    )
+# _____________________________
+
+
+def test_render_gauge():
+    registry = Registry()
+    registry.gauge('pgin_change_last_duration_seconds', 'Duration', ['change']).set(1.5, change='add_column')
+
+    assert registry.render() == (
+        '# HELP pgin_change_last_duration_seconds Duration\n'
+        '# TYPE pgin_change_last_duration_seconds gauge\n'
+        'pgin_change_last_duration_seconds{change="add_column"} 1.5\n'
+        '# EOF\n'
+    )
+# _____________________________
+
+
+def test_render_histogram():
+    registry = Registry()
+    duration = registry.histogram('pgin_query_duration_seconds', 'Query time', ['query'], buckets=(0.1, 1, math.inf))
+    duration.observe(0.05, query='fetch')
+    duration.observe(0.5, query='fetch')
+
+    lines = registry.render().splitlines()
+    assert lines[1] == '# TYPE pgin_query_duration_seconds histogram'
+    assert lines[2:7] == [
+        'pgin_query_duration_seconds_bucket{query="fetch",le="0.1"} 1',
+        'pgin_query_duration_seconds_bucket{query="fetch",le="1"} 2',
+        'pgin_query_duration_seconds_bucket{query="fetch",le="+Inf"} 2',
+        'pgin_query_duration_seconds_count{query="fetch"} 2',
+        'pgin_query_duration_seconds_sum{query="fetch"} 0.55',
+    ]
+# _____________________________
+
+
+def test_render_skips_empty_metrics():
+    registry = Registry()
+    registry.counter('pgin_commits_total', 'Transactions committed')
+    assert registry.render() == '# EOF\n'
+# _____________________________
+
+
+def test_escape_and_format():
+    assert escape_label('a"b\\c\nd') == 'a\\"b\\\\c\\nd'
+    assert format_value(3.0) == '3'
+    assert format_value(0.25) == '0.25'
+    assert format_value(math.inf) == '+Inf'
+# _____________________________
+
+
+def test_write_textfile(tmp_path):
+    registry = Registry()
+    registry.gauge('pgin_lag_bytes', 'Lag').set(10)
+    path = tmp_path / 'pgin.prom'
+    registry.write_textfile(str(path))
+    assert path.read_text() == registry.render()
+    assert [p.name for p in tmp_path.iterdir()] == ['pgin.prom']
+# ==============================================================
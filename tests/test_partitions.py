@@ -0,0 +1,55 @@
+import datetime
+import pytest
+from pgin.lib.partitions import partition_spec, period_start, period_add
+# ==============================================================
+
+
+def test_period_start():
+    moment = datetime.datetime(2024, 2, 29, 13, 45)
+    assert period_start(moment, 'day') == datetime.date(2024, 2, 29)
+    assert period_start(moment, 'week') == datetime.date(2024, 2, 26)
+    assert period_start(moment, 'month') == datetime.date(2024, 2, 1)
+    assert period_start(moment, 'year') == datetime.date(2024, 1, 1)
+    assert period_start(datetime.date(2024, 3, 3), 'week') == datetime.date(2024, 2, 26)
+# _____________________________
+
+
+def test_period_add_days_and_weeks():
+    assert period_add(datetime.date(2024, 2, 28), 'day', 2) == datetime.date(2024, 3, 1)
+    assert period_add(datetime.date(2024, 12, 30), 'week', 1) == datetime.date(2025, 1, 6)
+    assert period_add(datetime.date(2024, 1, 1), 'day', -1) == datetime.date(2023, 12, 31)
+# _____________________________
+
+
+def test_period_add_months_across_years():
+    start = datetime.date(2024, 11, 1)
+    assert period_add(start, 'month', 1) == datetime.date(2024, 12, 1)
+    assert period_add(start, 'month', 2) == datetime.date(2025, 1, 1)
+    assert period_add(start, 'month', 14) == datetime.date(2026, 1, 1)
+    assert period_add(datetime.date(2024, 1, 1), 'month', -1) == datetime.date(2023, 12, 1)
+    assert period_add(datetime.date(2024, 1, 1), 'month', -13) == datetime.date(2022, 12, 1)
+# _____________________________
+
+
+def test_period_add_years():
+    assert period_add(datetime.date(2024, 1, 1), 'year', 3) == datetime.date(2027, 1, 1)
+# _____________________________
+
+
+def test_partition_spec_defaults():
+    spec = partition_spec({'parent': 'events', 'column': 'created', 'interval': 'month', 'retain': 12})
+    assert spec['premake'] == 3
+    assert spec['retain'] == 12
+    assert spec['archive_schema'] is None
+# _____________________________
+
+
+@pytest.mark.parametrize('spec', [
+    {'column': 'created', 'interval': 'month'},
+    {'parent': 'events', 'column': 'created', 'interval': 'quarter'},
+    {'parent': 'events', 'column': 'created', 'interval': 'month', 'keep': 3},
+])
+def test_partition_spec_refused(spec):
+    with pytest.raises(ValueError):
+        partition_spec(spec)
+# ==============================================================
@@ -0,0 +1,37 @@
+from pgin.lib.phases import EXPAND, CONTRACT, phases_to_deploy
+# ==============================================================
+
+SPLIT = (EXPAND, CONTRACT)
+
+
+def test_plain_change_goes_with_expand():
+    assert phases_to_deploy((), None, set()) == [None]
+    assert phases_to_deploy((), EXPAND, set()) == [None]
+    assert phases_to_deploy((), CONTRACT, set()) == []
+# _____________________________
+
+
+def test_all_phases_in_order():
+    assert phases_to_deploy(SPLIT, None, set()) == [EXPAND, CONTRACT]
+    assert phases_to_deploy(SPLIT, None, {EXPAND}) == [CONTRACT]
+    assert phases_to_deploy(SPLIT, None, {EXPAND, CONTRACT}) == []
+# _____________________________
+
+
+def test_expand_only():
+    assert phases_to_deploy(SPLIT, EXPAND, set()) == [EXPAND]
+    assert phases_to_deploy(SPLIT, EXPAND, {EXPAND}) == []
+# _____________________________
+
+
+def test_contract_waits_for_expand():
+    assert phases_to_deploy(SPLIT, CONTRACT, set()) == []
+    assert phases_to_deploy(SPLIT, CONTRACT, {EXPAND}) == [CONTRACT]
+    assert phases_to_deploy(SPLIT, CONTRACT, {EXPAND, CONTRACT}) == []
+# _____________________________
+
+
+def test_contract_only_change():
+    assert phases_to_deploy((CONTRACT,), CONTRACT, set()) == [CONTRACT]
+    assert phases_to_deploy((CONTRACT,), EXPAND, set()) == []
+# ==============================================================
@@ -0,0 +1,134 @@
+from pgin.lib.plancheck import load_registry, compare_plans, index_scans, seq_scanned
+# ==============================================================
+
+QUERIES = [{'name': 'orders_of_customer', 'sql': 'SELECT 1', 'params': None, 'cost_threshold': None}]
+
+
+def node(node_type, relation=None, index=None, cost=10.0, plans=None):
+    plan = {'Node Type': node_type, 'Total Cost': cost}
+    if relation is not None:
+        plan['Relation Name'] = relation
+    if index is not None:
+        plan['Index Name'] = index
+    if plans:
+        plan['Plans'] = plans
+    return plan
+# _____________________________
+
+
+def compare(before, after, queries=QUERIES, cost_threshold=2.0):
+    return compare_plans(
+        queries, {'orders_of_customer': before}, {'orders_of_customer': after}, cost_threshold)[0]
+# ==============================================================
+
+
+def test_same_plan_ok():
+    plan = node('Index Scan', 'orders', 'orders_customer_idx')
+    finding = compare(plan, dict(plan))
+    assert finding['status'] == 'ok'
+    assert finding['notes'] == []
+# _____________________________
+
+
+def test_lost_index_scan_regressed():
+    before = node('Limit', cost=12.0, plans=[node('Index Scan', 'orders', 'orders_customer_idx')])
+    after = node('Limit', cost=12.0, plans=[node('Seq Scan', 'orders')])
+    finding = compare(before, after)
+    assert finding['status'] == 'regressed'
+    assert finding['notes'] == ['lost index scan on orders (orders_customer_idx)']
+# _____________________________
+
+
+def test_lost_bitmap_scan_names_the_index():
+    before = node('Bitmap Heap Scan', 'orders', plans=[node('Bitmap Index Scan', index='orders_customer_idx')])
+    assert index_scans(before) == {'orders': {'orders_customer_idx'}}
+
+    finding = compare(before, node('Seq Scan', 'orders'))
+    assert finding['status'] == 'regressed'
+    assert 'orders_customer_idx' in finding['notes'][0]
+# _____________________________
+
+
+def test_cost_growth_regressed():
+    before = node('Index Scan', 'orders', 'orders_customer_idx', cost=100.0)
+    after = node('Index Scan', 'orders', 'orders_customer_idx', cost=250.0)
+    finding = compare(before, after)
+    assert finding['status'] == 'regressed'
+    assert finding['cost_before'] == 100.0
+    assert finding['cost_after'] == 250.0
+# _____________________________
+
+
+def test_cost_growth_within_threshold_ok():
+    before = node('Index Scan', 'orders', 'orders_customer_idx', cost=100.0)
+    after = node('Index Scan', 'orders', 'orders_customer_idx', cost=150.0)
+    assert compare(before, after)['status'] == 'ok'
+# _____________________________
+
+
+def test_query_threshold_overrides_default():
+    queries = [dict(QUERIES[0], cost_threshold=1.2)]
+    before = node('Index Scan', 'orders', 'orders_customer_idx', cost=100.0)
+    after = node('Index Scan', 'orders', 'orders_customer_idx', cost=150.0)
+    assert compare(before, after, queries)['status'] == 'regressed'
+# _____________________________
+
+
+def test_shape_change_without_regression():
+    before = node('Index Scan', 'orders', 'orders_customer_idx')
+    after = node('Index Only Scan', 'orders', 'orders_customer_created_idx')
+    finding = compare(before, after)
+    assert finding['status'] == 'changed'
+# _____________________________
+
+
+def test_seq_scan_of_another_relation_is_not_a_lost_index_scan():
+    before = node('Nested Loop', plans=[node('Index Scan', 'orders', 'orders_customer_idx'), node('Seq Scan', 'tiny')])
+    after = node('Nested Loop', plans=[node('Index Scan', 'orders', 'orders_customer_idx'), node('Seq Scan', 'tiny')])
+    assert seq_scanned(after) == {'tiny'}
+    assert compare(before, after)['status'] == 'ok'
+# _____________________________
+
+
+def test_failing_after_deploy_regressed():
+    finding = compare(node('Seq Scan', 'orders'), {'error': 'relation "orders" does not exist'})
+    assert finding['status'] == 'regressed'
+    assert 'does not exist' in finding['notes'][0]
+# _____________________________
+
+
+def test_failing_before_and_after_error():
+    finding = compare({'error': 'syntax error'}, {'error': 'syntax error'})
+    assert finding['status'] == 'error'
+# _____________________________
+
+
+def test_no_plan_before():
+    finding = compare(None, node('Seq Scan', 'orders'))
+    assert finding['status'] == 'ok'
+    assert finding['notes'] == ['no plan before deploy']
+# _____________________________
+
+
+def test_load_registry(tmp_path):
+    path = tmp_path / 'queries.toml'
+    path.write_text(
+        '[queries.orders_of_customer]\n'
+        'sql = "SELECT * FROM orders WHERE customer_id = %s"\n'
+        'params = [42]\n'
+        'cost_threshold = 1.5\n'
+        '\n'
+        '[queries.all_customers]\n'
+        'sql = "SELECT * FROM customers"\n'
+    )
+    queries = load_registry(str(path))
+    assert [q['name'] for q in queries] == ['all_customers', 'orders_of_customer']
+    assert queries[1]['params'] == [42]
+    assert queries[1]['cost_threshold'] == 1.5
+    assert queries[0]['params'] is None
+# _____________________________
+
+
+def test_load_registry_missing_file(tmp_path):
+    assert load_registry(str(tmp_path / 'queries.toml')) == []
+# ==============================================================
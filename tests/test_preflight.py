@@ -0,0 +1,113 @@
+from pgin.lib.preflight import LOCK_MODES, CONFLICTS, infer_relations, change_relations, stronger_mode
+# ==============================================================
+
+
+class Declared:
+    relations = {'public.orders': 'share  row exclusive'}
+# _____________________________
+
+
+class DeclaredList:
+    relations = ['public.orders', 'public.customers']
+# _____________________________
+
+
+class Inferred:
+
+    def __call__(self):
+        self.dba.cursor.execute("""ALTER TABLE public.orders ADD COLUMN note text""")
+# _____________________________
+
+
+class AddIndex:
+    direction = 'deploy'
+    indexes = [{'name': 'orders_created_idx', 'table': 'public.orders', 'columns': 'created'}]
+# _____________________________
+
+
+class DropIndex:
+    direction = 'deploy'
+    drop_indexes = [{'name': 'lines_note_idx', 'table': 'public.lines'}]
+# ==============================================================
+
+
+def test_infer_alter_table():
+    sql = 'ALTER TABLE IF EXISTS public.orders ADD COLUMN note text'
+    assert infer_relations(sql) == {'public.orders': 'ACCESS EXCLUSIVE'}
+# _____________________________
+
+
+def test_infer_keeps_strongest_mode():
+    sql = """
+        INSERT INTO orders (id) VALUES (1);
+        CREATE INDEX orders_created_idx ON orders (created);
+        UPDATE customers SET name = 'x';
+        ALTER TABLE ONLY orders ADD COLUMN note text;
+    """
+    assert infer_relations(sql) == {'orders': 'ACCESS EXCLUSIVE', 'customers': 'ROW EXCLUSIVE'}
+# _____________________________
+
+
+def test_infer_concurrent_index_and_references():
+    sql = """
+        CREATE UNIQUE INDEX CONCURRENTLY orders_key ON ONLY "Sales".orders (key);
+        ALTER TABLE lines ADD FOREIGN KEY (order_id) REFERENCES "Sales".orders (id);
+    """
+    relations = infer_relations(sql)
+    assert relations['"Sales".orders'] == 'SHARE ROW EXCLUSIVE'
+    assert relations['lines'] == 'ACCESS EXCLUSIVE'
+# _____________________________
+
+
+def test_infer_lock_table():
+    assert infer_relations('LOCK TABLE orders IN share  row exclusive MODE') == {'orders': 'SHARE ROW EXCLUSIVE'}
+    assert infer_relations('LOCK TABLE orders IN NO SUCH MODE') == {}
+# _____________________________
+
+
+def test_stronger_mode():
+    assert stronger_mode(None, 'SHARE') == 'SHARE'
+    assert stronger_mode('ACCESS SHARE', 'ROW EXCLUSIVE') == 'ROW EXCLUSIVE'
+    assert stronger_mode('ACCESS EXCLUSIVE', 'SHARE') == 'ACCESS EXCLUSIVE'
+# _____________________________
+
+
+def test_conflicts_are_symmetric():
+    names = {m: ''.join(w.capitalize() for w in m.split()) + 'Lock' for m in LOCK_MODES}
+    for mode in LOCK_MODES:
+        for other in LOCK_MODES:
+            assert (names[other] in CONFLICTS[mode]) == (names[mode] in CONFLICTS[other]), (mode, other)
+# _____________________________
+
+
+def test_conflicts_access_exclusive_with_everything():
+    assert len(CONFLICTS['ACCESS EXCLUSIVE']) == len(LOCK_MODES)
+    assert CONFLICTS['ACCESS SHARE'] == ['AccessExclusiveLock']
+# _____________________________
+
+
+def test_change_relations():
+    assert change_relations(Declared()) == {'public.orders': 'SHARE ROW EXCLUSIVE'}
+    assert change_relations(DeclaredList()) == {
+        'public.orders': 'ACCESS EXCLUSIVE', 'public.customers': 'ACCESS EXCLUSIVE'}
+    assert change_relations(Inferred()) == {'public.orders': 'ACCESS EXCLUSIVE'}
+# _____________________________
+
+
+def test_change_relations_concurrent_indexes():
+    change = AddIndex()
+    assert change_relations(change) == {'public.orders': 'SHARE UPDATE EXCLUSIVE'}
+
+    # the revert of an index change drops nothing by itself
+    change.direction = 'revert'
+    assert change_relations(change) == {}
+# _____________________________
+
+
+def test_change_relations_dropped_indexes():
+    change = DropIndex()
+    assert change_relations(change) == {'public.lines': 'SHARE UPDATE EXCLUSIVE'}
+
+    change.direction = 'revert'
+    assert change_relations(change) == {'public.lines': 'SHARE UPDATE EXCLUSIVE'}
+# ==============================================================
@@ -0,0 +1,118 @@
+import pytest
+from click.testing import CliRunner
+from pgin.scripts import pgin
+from pgin.lib.profiles import load_profile, DEFAULTS, RECONNECT_ATTEMPTS
+# ==============================================================
+
+CONF = {
+    'connections': {
+        'default': {'host': 'db0', 'keepalives_idle': 60, 'reconnect_attempts': 5},
+        'read': {'host': 'standby1,standby2', 'target_session_attrs': 'prefer-standby'},
+    }
+}
+
+
+@pytest.fixture(autouse=True)
+def clean_env(monkeypatch):
+    for var in ['PGHOST', 'PGHOSTADDR', 'PGPORT', 'PGSERVICE', 'PGIN_DB_HOST', 'PGIN_DB_PORT']:
+        monkeypatch.delenv(var, raising=False)
+# ==============================================================
+
+
+def test_defaults_without_conf():
+    profile = load_profile()
+    assert profile.params == DEFAULTS
+    assert profile.reconnect_attempts == RECONNECT_ATTEMPTS
+# _____________________________
+
+
+def test_default_profile():
+    profile = load_profile(CONF)
+    assert profile.params['host'] == 'db0'
+    assert profile.params['port'] == 5432
+    assert profile.params['keepalives_idle'] == 60
+    assert profile.reconnect_attempts == 5
+    assert 'reconnect_attempts' not in profile.params
+# _____________________________
+
+
+def test_named_profile_extends_default():
+    profile = load_profile(CONF, 'read')
+    assert profile.params['host'] == 'standby1,standby2'
+    assert profile.params['target_session_attrs'] == 'prefer-standby'
+    assert profile.params['keepalives_idle'] == 60
+# _____________________________
+
+
+def test_unknown_profile():
+    with pytest.raises(ValueError):
+        load_profile(CONF, 'reporting')
+# _____________________________
+
+
+def test_unknown_key():
+    with pytest.raises(ValueError):
+        load_profile({'connections': {'default': {'hots': 'db1'}}})
+# _____________________________
+
+
+def test_env_overrides_file(monkeypatch):
+    monkeypatch.setenv('PGIN_DB_HOST', 'db1')
+    assert load_profile(CONF).params['host'] == 'db1'
+    assert load_profile(CONF, use_env=False).params['host'] == 'db0'
+# _____________________________
+
+
+def test_socket_dir_is_the_host():
+    params = load_profile({'connections': {'default': {'socket_dir': '/var/run/postgresql'}}}).params
+    assert params['host'] == '/var/run/postgresql'
+    assert 'socket_dir' not in params
+# _____________________________
+
+
+def test_later_host_replaces_socket_dir(monkeypatch):
+    conf = {
+        'connections': {
+            'default': {'socket_dir': '/var/run/postgresql'},
+            'read': {'host': 'standby1,standby2'},
+        }
+    }
+    assert load_profile(conf, 'read').params['host'] == 'standby1,standby2'
+
+    monkeypatch.setenv('PGIN_DB_HOST', 'db1')
+    assert load_profile(conf).params['host'] == 'db1'
+# _____________________________
+
+
+def test_libpq_env_drops_host_default(monkeypatch):
+    monkeypatch.setenv('PGHOST', 'db1')
+    params = load_profile().params
+    assert 'host' not in params
+    assert 'port' not in params
+# _____________________________
+
+
+def test_service_drops_host_default():
+    params = load_profile({'connections': {'default': {'service': 'shop'}}}).params
+    assert params['service'] == 'shop'
+    assert 'host' not in params
+# _____________________________
+
+
+def test_dsn():
+    dsn = load_profile(CONF, 'read').dsn('shop', 'pgin')
+    assert 'dbname=shop' in dsn
+    assert 'user=pgin' in dsn
+    assert "host=standby1,standby2" in dsn
+# _____________________________
+
+
+def test_connection_without_conf(monkeypatch, tmp_path):
+    monkeypatch.setattr(pgin, 'find_conf_file', lambda: None)
+    assert pgin.Migration().profile.name == 'default'
+
+    log_file = str(tmp_path / 'pgin.log')
+    result = CliRunner().invoke(pgin.cli, ['--log-file', log_file, '--connection', 'read', 'status'])
+    assert result.exit_code == 2
+    assert "No connection profile 'read'" in result.output
+# ==============================================================
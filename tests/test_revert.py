@@ -0,0 +1,71 @@
+import pytest
+from pgin.scripts.pgin import figure_revert_upto_change
+# ==============================================================
+
+# deployed changes, the last deployed first
+DEPLOYED = [{'name': 'add_index'}, {'name': 'add_column'}, {'name': 'create_orders'}, {'name': 'create_schema'}]
+TAGS = {'v1.0': 'create_orders'}
+
+
+class FakeDBA:
+
+    def __init__(self):
+        self.calls = []
+
+    def fetch_deployed_changes(self, limit=None):
+        self.calls.append(('deployed', limit))
+        return DEPLOYED[:limit]
+
+    def fetch_deployed_changes_since(self, name):
+        self.calls.append(('since', name))
+        return DEPLOYED[:[c['name'] for c in DEPLOYED].index(name) + 1]
+
+    def fetch_change_by_tag(self, tag):
+        return TAGS.get(tag)
+
+    def fetch_planned_changeid_by_name(self, name):
+        return 'id-' + name if name in [c['name'] for c in DEPLOYED] else None
+# _____________________________
+
+
+class FakeMigration:
+    project = 'shop'
+# _____________________________
+
+
+def revert(upto):
+    dba = FakeDBA()
+    changes, msg = figure_revert_upto_change(dba, FakeMigration(), upto)
+    return [c['name'] for c in changes], dba.calls
+# ==============================================================
+
+
+def test_revert_all():
+    assert revert(None) == (['add_index', 'add_column', 'create_orders', 'create_schema'], [('deployed', None)])
+# _____________________________
+
+
+def test_revert_head():
+    assert revert('HEAD') == (['add_index'], [('deployed', 1)])
+# _____________________________
+
+
+def test_revert_head_back():
+    assert revert('HEAD~2') == (['add_index', 'add_column', 'create_orders'], [('deployed', 3)])
+# _____________________________
+
+
+def test_revert_upto_tag():
+    assert revert('v1.0') == (['add_index', 'add_column', 'create_orders'], [('since', 'create_orders')])
+# _____________________________
+
+
+def test_revert_upto_change():
+    assert revert('add_column') == (['add_index', 'add_column'], [('since', 'add_column')])
+# _____________________________
+
+
+def test_revert_unknown_change():
+    with pytest.raises(SystemExit):
+        revert('no_such_change')
+# ==============================================================
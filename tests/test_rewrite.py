@@ -0,0 +1,299 @@
+import pytest
+from psycopg2.extensions import adapt
+from pgin.lib.rewrite import (
+    ShadowRewrite, shadow_indexdef, shadow_index_name, index_signature, retarget_triggerdef, policy_statement,
+    acl_statements
+)
+# ==============================================================
+
+
+class FakeCursor:
+    """
+    Records the statements; answers fetchone() and fetchall() from *answers*,
+    a list of (query fragment, row or rows) consumed in order
+    """
+
+    def __init__(self, log, answers):
+        self.log = log
+        self.answers = answers
+
+    def execute(self, query, params=None):
+        self.log.append(('execute', ' '.join(str(query).split()), params))
+
+    def fetchone(self):
+        statement = self.log[-1][1]
+        fragment, row = self.answers.pop(0)
+        assert fragment in statement, statement
+        return row
+
+    def fetchall(self):
+        return self.fetchone()
+# _____________________________
+
+
+class FakeConnection:
+
+    def __init__(self, answers):
+        self.log = []
+        self.answers = answers
+
+    def cursor(self, cursor_factory=None):
+        return FakeCursor(self.log, self.answers)
+
+    def commit(self):
+        self.log.append(('commit', None, None))
+
+    def rollback(self):
+        self.log.append(('rollback', None, None))
+# _____________________________
+
+
+def statements(conn):
+    """
+    The executed statements, list parameters filled in
+    """
+    rendered = []
+    for kind, statement, params in conn.log:
+        if kind != 'execute':
+            continue
+        if isinstance(params, list):
+            statement = statement % tuple(adapt(p).getquoted().decode() for p in params)
+        rendered.append(statement)
+    return rendered
+# _____________________________
+
+
+def copy_rewrite(answers, replay_every=10):
+    conn = FakeConnection(answers)
+    rewrite = ShadowRewrite(conn, 'public.orders', key='id', chunk_size=2, replay_every=replay_every)
+    rewrite.ident = lambda name: '"{}"'.format(name)
+    rewrite.mapping = lambda source, target, using=None: ('"id"', '"id" AS "id"')
+    rewrite.replays = 0
+
+    def replay(*args, **kwargs):
+        rewrite.replays += 1
+        return 0
+
+    rewrite.replay = replay
+    return conn, rewrite
+# _____________________________
+
+
+def test_copy_resumes_from_state_not_shadow():
+    conn, rewrite = copy_rewrite([
+        ('SELECT copied_to FROM', (4,)),
+        ('WITH batch AS', (6, 2)),
+        ('WITH batch AS', (None, 0)),
+    ])
+    rewrite.copy()
+
+    position = next(p for kind, s, p in conn.log if kind == 'execute' and s.startswith('SELECT copied_to'))
+    assert position[0].adapted == 'public.orders__pgin_state'
+
+    chunks = [p for kind, s, p in conn.log if kind == 'execute' and s.startswith('WITH batch AS')]
+    assert chunks[0]['last'] == 4
+    assert chunks[1]['last'] == 6
+    assert rewrite.copied == 2
+# _____________________________
+
+
+def test_copy_commits_position_with_each_chunk():
+    conn, rewrite = copy_rewrite([
+        ('SELECT copied_to', (None,)),
+        ('WITH batch AS', (2, 2)),
+        ('WITH batch AS', (4, 2)),
+        ('WITH batch AS', (None, 0)),
+    ], replay_every=1)
+    rewrite.copy()
+
+    first_chunk = next(i for i, (kind, s, _) in enumerate(conn.log) if kind == 'execute' and 'WITH batch AS' in s)
+    assert 'WHERE' not in conn.log[first_chunk][1].split('FROM public.orders')[1].split('ORDER BY')[0]
+
+    updates = [(i, p) for i, (kind, s, p) in enumerate(conn.log) if kind == 'execute' and s.startswith('UPDATE')]
+    assert [p[1] for _, p in updates] == [2, 4]
+    for i, _ in updates:
+        assert conn.log[i + 1][0] == 'commit'
+
+    # replays run between chunks, after the position is committed
+    assert rewrite.replays == 2
+# _____________________________
+
+
+def test_shadow_indexdef():
+    indexdef = 'CREATE INDEX orders_created_idx ON public.orders USING btree (created)'
+    assert shadow_indexdef(indexdef, 'public.orders__pgin_new') == (
+        'CREATE INDEX "orders_created_idx__pgin_new" ON public.orders__pgin_new USING btree (created)')
+# _____________________________
+
+
+def test_shadow_indexdef_unique_quoted_only():
+    indexdef = 'CREATE UNIQUE INDEX "Orders Key" ON ONLY public."Orders" USING btree (key) WHERE (key IS NOT NULL)'
+    assert shadow_indexdef(indexdef, 'public."Orders__pgin_new"') == (
+        'CREATE UNIQUE INDEX "Orders Key__pgin_new" ON ONLY public."Orders__pgin_new" USING btree (key) '
+        'WHERE (key IS NOT NULL)')
+# _____________________________
+
+
+def test_shadow_indexdef_truncates_name():
+    indexdef = 'CREATE INDEX {} ON t USING btree (a)'.format('x' * 63)
+    name = shadow_indexdef(indexdef, 't__pgin_new').split(' ')[2]
+    assert name == '"{}__pgin_new"'.format('x' * 53)
+    assert name.strip('"') != 'x' * 63
+# _____________________________
+
+
+def test_shadow_index_name_collisions():
+    taken = set()
+    first = 'CREATE INDEX {}_a ON t USING btree (a)'.format('x' * 60)
+    second = 'CREATE INDEX {}_b ON t USING btree (b)'.format('x' * 60)
+    shadow_indexdef(first, 't__pgin_new', taken)
+    shadow_indexdef(second, 't__pgin_new', taken)
+    assert taken == {'x' * 53 + '__pgin_new', 'x' * 52 + '1__pgin_new'}
+
+    # a name already carrying the suffix gets another one
+    name = 'y' * 53 + '__pgin_new'
+    assert shadow_index_name(name) == 'y' * 52 + '1__pgin_new'
+# _____________________________
+
+
+def test_shadow_index_name_multibyte():
+    name = shadow_index_name('\u00e9' * 40)
+    assert name == '\u00e9' * 26 + '__pgin_new'
+    assert len(name.encode('utf-8')) <= 63
+# _____________________________
+
+
+def test_index_signature():
+    old = 'CREATE UNIQUE INDEX orders_key ON public.orders__pgin_old USING btree (key)'
+    new = 'CREATE UNIQUE INDEX "orders_key__pgin_new" ON public.orders USING btree (key)'
+    assert index_signature(old) == index_signature(new)
+    assert index_signature(old) != index_signature(new.replace('(key)', '(key, id)'))
+# _____________________________
+
+
+def test_finish_restores_index_names():
+    conn = FakeConnection([
+        ('to_regclass', (True,)),
+        ('FROM pg_index', [
+            ('orders_pkey', 'public.orders_pkey', 'CREATE UNIQUE INDEX orders_pkey ON public.orders__pgin_old (id)'),
+            ('orders_created_idx', 'public.orders_created_idx',
+             'CREATE INDEX orders_created_idx ON public.orders__pgin_old (created)'),
+        ]),
+        ('FROM pg_index', [
+            ('orders__pgin_new_pkey', 'public.orders__pgin_new_pkey',
+             'CREATE UNIQUE INDEX orders__pgin_new_pkey ON public.orders (id)'),
+            ('orders_created_idx__pgin_new', 'public.orders_created_idx__pgin_new',
+             'CREATE INDEX orders_created_idx__pgin_new ON public.orders (created)'),
+            ('orders_note_idx', 'public.orders_note_idx', 'CREATE INDEX orders_note_idx ON public.orders (note)'),
+        ]),
+    ])
+    rewrite = ShadowRewrite(conn, 'public.orders', key='id')
+    rewrite.ident = lambda name: '"{}"'.format(name)
+    rewrite.finish()
+
+    renames = [
+        (p[0].adapted, p[1].adapted) for kind, s, p in conn.log if kind == 'execute' and s.startswith('ALTER INDEX')]
+    assert renames == [
+        ('public.orders__pgin_new_pkey', '"orders_pkey"'),
+        ('public.orders_created_idx__pgin_new', '"orders_created_idx"'),
+    ]
+    drop = next(i for i, (kind, s, p) in enumerate(conn.log) if kind == 'execute' and s.startswith('DROP TABLE'))
+    rename = next(i for i, (kind, s, p) in enumerate(conn.log) if kind == 'execute' and s.startswith('ALTER INDEX'))
+    assert drop < rename
+# _____________________________
+
+
+def test_shadow_indexdef_unexpected():
+    with pytest.raises(ValueError):
+        shadow_indexdef('ALTER TABLE t ADD PRIMARY KEY (id)', 't__pgin_new')
+# _____________________________
+
+
+def test_prepare_refuses_forced_row_security():
+    conn = FakeConnection([('pg_depend', []), ('relforcerowsecurity', (True,))])
+    rewrite = ShadowRewrite(conn, 'public.orders', key='id')
+    with pytest.raises(ValueError, match='FORCE ROW LEVEL SECURITY'):
+        rewrite.prepare()
+# _____________________________
+
+
+def test_copy_attributes():
+    conn = FakeConnection([
+        ('pg_get_userbyid(relowner)', ('shop_owner', "Customer's orders", True)),
+        ('aclexplode', [
+            ('shop_owner', 'SELECT', False, None),
+            ('reporting', 'SELECT', False, None),
+            ('clerk', 'UPDATE', True, '"note"'),
+        ]),
+        ('aclexplode', [
+            ('shop_owner', 'SELECT', False, None),
+            ('PUBLIC', 'SELECT', False, None),
+        ]),
+        ('pg_policies', [{
+            'policyname': 'own_rows',
+            'permissive': 'PERMISSIVE',
+            'roles': ['clerk'],
+            'cmd': 'ALL',
+            'qual': '(clerk = CURRENT_USER)',
+            'with_check': None,
+        }]),
+    ])
+    rewrite = ShadowRewrite(conn, 'public.orders', key='id')
+    rewrite.ident = lambda name: '"{}"'.format(name)
+    triggers = [
+        ('orders_audit', 'CREATE TRIGGER orders_audit AFTER UPDATE ON public.orders FOR EACH ROW '
+                         'EXECUTE FUNCTION audit()', 'O'),
+        ('orders_sync', 'CREATE TRIGGER orders_sync AFTER INSERT ON public.orders FOR EACH ROW '
+                        'EXECUTE FUNCTION sync()', 'R'),
+    ]
+    rewrite.copy_attributes('public.orders', 'public.orders__pgin_new', triggers)
+
+    assert [st for st in statements(conn) if not st.startswith('SELECT')] == [
+        'ALTER TABLE public.orders__pgin_new OWNER TO "shop_owner"',
+        'REVOKE SELECT ON public.orders__pgin_new FROM PUBLIC',
+        'GRANT UPDATE ("note") ON public.orders__pgin_new TO clerk WITH GRANT OPTION',
+        'GRANT SELECT ON public.orders__pgin_new TO reporting',
+        "COMMENT ON TABLE public.orders__pgin_new IS 'Customer''s orders'",
+        'ALTER TABLE public.orders__pgin_new ENABLE ROW LEVEL SECURITY',
+        'CREATE POLICY "own_rows" ON public.orders__pgin_new AS PERMISSIVE FOR ALL TO "clerk" '
+        'USING ((clerk = CURRENT_USER))',
+        'CREATE TRIGGER orders_audit AFTER UPDATE ON public.orders__pgin_new FOR EACH ROW EXECUTE FUNCTION audit()',
+        'CREATE TRIGGER orders_sync AFTER INSERT ON public.orders__pgin_new FOR EACH ROW EXECUTE FUNCTION sync()',
+        'ALTER TABLE public.orders__pgin_new ENABLE REPLICA TRIGGER "orders_sync"',
+    ]
+# _____________________________
+
+
+def test_retarget_triggerdef():
+    triggerdef = (
+        'CREATE CONSTRAINT TRIGGER "Check On" AFTER INSERT OR UPDATE OF "on", note ON "Sales".orders '
+        'DEFERRABLE INITIALLY DEFERRED FOR EACH ROW WHEN ((new.note IS NOT NULL)) EXECUTE FUNCTION check_on()')
+    assert retarget_triggerdef(triggerdef, '"Sales".orders__pgin_new') == triggerdef.replace(
+        'ON "Sales".orders ', 'ON "Sales".orders__pgin_new ')
+
+    with pytest.raises(ValueError):
+        retarget_triggerdef('ALTER TABLE t ENABLE TRIGGER x', 't__pgin_new')
+# _____________________________
+
+
+def test_policy_statement():
+    policy = {
+        'policyname': 'Read Only',
+        'permissive': 'RESTRICTIVE',
+        'roles': ['public', 'Auditors'],
+        'cmd': 'INSERT',
+        'qual': None,
+        'with_check': 'false',
+    }
+    assert policy_statement(policy, 't__pgin_new') == (
+        'CREATE POLICY "Read Only" ON t__pgin_new AS RESTRICTIVE FOR INSERT TO PUBLIC, "Auditors" '
+        'WITH CHECK (false)')
+# _____________________________
+
+
+def test_acl_statements_grant_option_change():
+    source = [('clerk', 'SELECT', False, None)]
+    target = [('clerk', 'SELECT', True, None)]
+    assert acl_statements(source, target, 't') == ['REVOKE SELECT ON t FROM clerk', 'GRANT SELECT ON t TO clerk']
+    assert acl_statements(source, source, 't') == []
+# ==============================================================
@@ -0,0 +1,112 @@
+import psycopg2
+from click.testing import CliRunner
+from pgin.scripts import pgin
+from pgin.lib.throttle import ReplicationThrottle
+# ==============================================================
+
+
+class FakeDBA:
+    """
+    Answers each lag sample with the next of *lags*, raising it if it is an exception
+    """
+
+    def __init__(self, lags):
+        self.lags = list(lags)
+        self.samples = 0
+
+    def fetch_replication_lag(self):
+        self.samples += 1
+        lag = self.lags.pop(0)
+        if isinstance(lag, Exception):
+            raise lag
+        return lag
+# _____________________________
+
+
+def lag(nbytes=None, seconds=None):
+    return {'bytes': nbytes, 'seconds': seconds}
+# _____________________________
+
+
+def throttle(lags, **kwargs):
+    dba = FakeDBA(lags)
+    return dba, ReplicationThrottle(dba, check_interval=0, pause=0, **kwargs)
+# ==============================================================
+
+
+def test_disabled_does_not_sample():
+    dba, t = throttle([])
+    assert t.wait() == 0
+    assert dba.samples == 0
+# _____________________________
+
+
+def test_under_limit_does_not_pause():
+    dba, t = throttle([lag(100, 1.0)], max_lag_bytes=1000, max_lag_seconds=10)
+    assert t.wait() == 0
+    assert t.pauses == 0
+# _____________________________
+
+
+def test_pauses_until_under_resume_ratio():
+    dba, t = throttle([lag(2000), lag(800), lag(600), lag(400)], max_lag_bytes=1000)
+    t.wait()
+    assert t.pauses == 1
+    # 800 and 600 are under the limit but over half of it
+    assert dba.samples == 4
+# _____________________________
+
+
+def test_seconds_limit():
+    dba, t = throttle([lag(None, 20.0), lag(None, 2.0)], max_lag_seconds=10)
+    t.wait()
+    assert t.pauses == 1
+    assert dba.samples == 2
+# _____________________________
+
+
+def test_unknown_lag_does_not_throttle():
+    dba, t = throttle([lag()], max_lag_bytes=1000, max_lag_seconds=10)
+    assert not t.over(lag())
+    assert t.wait() == 0
+    assert t.pauses == 0
+# _____________________________
+
+
+def test_samples_once_per_interval():
+    dba, t = throttle([lag(100), lag(100)], max_lag_bytes=1000)
+    t.check_interval = 3600
+    t.wait()
+    t.wait()
+    assert dba.samples == 1
+# _____________________________
+
+
+def test_sample_error_while_paused_keeps_waiting():
+    dba, t = throttle([lag(2000), psycopg2.OperationalError('gone'), lag(800), lag(400)], max_lag_bytes=1000)
+    t.wait()
+    assert dba.samples == 4
+# _____________________________
+
+
+def test_sample_errors_in_a_row_resume():
+    dba, t = throttle(
+        [lag(2000), psycopg2.OperationalError('gone'), psycopg2.OperationalError('gone')],
+        max_lag_bytes=1000,
+        max_sample_errors=2
+    )
+    t.wait()
+    assert t.pauses == 1
+    assert dba.samples == 3
+# _____________________________
+
+
+def test_no_seconds_limit_on_standby(monkeypatch, tmp_path):
+    monkeypatch.setattr(pgin, 'find_conf_file', lambda: None)
+    result = CliRunner().invoke(pgin.cli, [
+        '--log-file', str(tmp_path / 'pgin.log'),
+        'deploy', '--max-replica-lag-seconds', '5', '--standby-dsn', 'host=standby1'
+    ])
+    assert result.exit_code == 2
+    assert '--max-replica-lag-bytes' in result.output
+# ==============================================================